@@ -6,44 +6,48 @@ from datetime import datetime
 import os
 import json
 
+from data import cache_store, http_transport, population_cube
+from data.cache_keys import adopt_legacy_entry, migrate_legacy_cache, query_digest, safe_endpoint
+
 
 class SCBService:
     def __init__(self, cache_dir="cache"):
         """Initialiserar SCB-tjänsten med cachefunktionalitet."""
         self.cache_dir = cache_dir
         os.makedirs(cache_dir, exist_ok=True)
+        migrate_legacy_cache(cache_dir)
+        self.cache = cache_store.get_store(cache_dir)
         self.base_url = "https://api.scb.se/OV0104/v1/doris/sv/ssd"
+        # Befolkning per ålder och kön delas med SCBConnector via befolkningskuben
+        self.population_cube = population_cube.get_cube(cache_dir, self.fetch_data)
 
     def _get_cache_path(self, endpoint, query_hash):
         """Skapar en sökväg för cachefilen baserat på endpoint och fråga."""
-        return os.path.join(self.cache_dir, f"{endpoint.replace('/', '_')}_{query_hash}.json")
+        return os.path.join(self.cache_dir, f"scb_{safe_endpoint(endpoint)}_{query_hash}.json")
 
     def _check_cache(self, cache_path, max_age_hours=24):
-        """Kontrollerar om cachefilen finns och är färsk."""
-        if not os.path.exists(cache_path):
-            return False
-
-        file_time = os.path.getmtime(cache_path)
-        file_age_hours = (datetime.now().timestamp() - file_time) / 3600
+        """Returnerar cachad data om den finns och är färsk, annars None."""
+        cached = self.cache.get("scb", os.path.basename(cache_path), max_age=max_age_hours * 3600)
+        if cached is None or cached.stale:
+            return None
+        return cached.value
 
-        return file_age_hours <= max_age_hours
-
-    def _query_hash(self, query):
-        """Skapar en hash av frågan för cache-identifiering."""
-        return str(hash(json.dumps(query, sort_keys=True)))
+    def _query_hash(self, endpoint, query):
+        """Skapar en stabil hash av endpoint och fråga för cache-identifiering."""
+        return query_digest(endpoint, query)
 
     def fetch_data(self, endpoint, query, max_cache_age_hours=24):
         """Hämtar data från SCB API med cache-stöd."""
-        query_hash = self._query_hash(query)
+        query_hash = self._query_hash(endpoint, query)
         cache_path = self._get_cache_path(endpoint, query_hash)
 
+        if not os.path.exists(cache_path):
+            adopt_legacy_entry(self.cache_dir, endpoint, query, cache_path)
+
         # Kontrollera cache
-        if self._check_cache(cache_path, max_cache_age_hours):
-            try:
-                with open(cache_path, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except Exception as e:
-                print(f"Cache-läsfel: {e}")
+        cached = self._check_cache(cache_path, max_cache_age_hours)
+        if cached is not None:
+            return cached
 
         # Hämta från API om cache saknas eller är gammal
         try:
@@ -51,7 +55,7 @@ class SCBService:
             print(f"[DEBUG] Skickar POST-förfrågan till URL: {url}")
             print(f"[DEBUG] Med query: {json.dumps(query, indent=2, ensure_ascii=False)}")
 
-            response = requests.post(url, json=query)
+            response = http_transport.post(url, json=query)
             print(f"[DEBUG] Statuskod från API: {response.status_code}")
 
             # Logga svaret även om det är ett fel
@@ -66,8 +70,7 @@ class SCBService:
             data = response.json()
 
             # Spara till cache
-            with open(cache_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False)
+            self.cache.put("scb", os.path.basename(cache_path), data)
 
             return data
 
@@ -84,30 +87,7 @@ class SCBService:
 
     def get_population_by_age_gender(self, region_code="1384", year="2023"):
         """Hämtar befolkningsdata per ålder och kön för en specifik region och år."""
-        endpoint = "BE/BE0101/BE0101A/BefolkningNy"
-
-        query = {
-            "query": [
-                {"code": "Region", "selection": {"filter": "item", "values": [region_code]}},
-                {"code": "Kon", "selection": {"filter": "item", "values": ["1", "2"]}},
-                {"code": "Alder", "selection": {"filter": "item", "values": [str(i) for i in range(0, 100)] + ["100+"]}},
-                {"code": "Tid", "selection": {"filter": "item", "values": [year]}}
-            ],
-            "response": {"format": "json"}
-        }
-
-        data = self.fetch_data(endpoint, query)
-
-        rows = data.get("data", [])
-        parsed = []
-        for row in rows:
-            # SCB returnerar: ['Region', 'Ålder', 'Kön', 'År']
-            ålder = row["key"][1]  # Ålder är index 1
-            kön = "Män" if row["key"][2] == "1" else "Kvinnor"  # Kön är index 2
-            antal = int(row["values"][0])
-            parsed.append({"Kön": kön, "Ålder": ålder, "Antal": antal})
-
-        df = pd.DataFrame(parsed)
+        df = self.population_cube.frame(region_code, [year])[["Kön", "Ålder", "Antal"]]
         if not df.empty:
             df["Ålder"] = df["Ålder"].replace("100+", "100").astype(int)
             df = df.sort_values(by="Ålder")
@@ -120,7 +100,7 @@ class SCBService:
 
         try:
             url = f"{self.base_url}/{endpoint}/region"
-            response = requests.get(url)
+            response = http_transport.get(url)
             response.raise_for_status()
             data = response.json()
 
@@ -140,28 +120,7 @@ class SCBService:
             current_year = datetime.now().year
             years = [str(year) for year in range(current_year-10, current_year)]
 
-        endpoint = "BE/BE0101/BE0101A/BefolkningNy"
-
-        query = {
-            "query": [
-                {"code": "Region", "selection": {"filter": "item", "values": [region_code]}},
-                {"code": "Kon", "selection": {"filter": "item", "values": ["1", "2"]}},
-                {"code": "Alder", "selection": {"filter": "item", "values": [str(i) for i in range(0, 100)] + ["100+"]}},
-                {"code": "Tid", "selection": {"filter": "item", "values": years}}
-            ],
-            "response": {"format": "json"}
-        }
-
-        data = self.fetch_data(endpoint, query)
-
-        rows = data.get("data", [])
-        parsed = []
-        for row in rows:
-            år = row["key"][3]
-            antal = int(row["values"][0])
-            parsed.append({"År": år, "Antal": antal})
-
-        df = pd.DataFrame(parsed)
+        df = self.population_cube.totals(region_code, years)[["År", "Antal"]]
 
         # Summera Män och Kvinnor för varje år
         df = df.groupby("År", as_index=False).sum()
@@ -0,0 +1,123 @@
+"""
+Indelning av ettåriga åldrar i åldersgrupper
+
+En indelning beskrivs av gruppernas nedre gränser. Av gränserna byggs en
+uppslagsarray från ålder till gruppindex en gång, så att indelningen sedan
+görs för alla rader (eller längs en arrays åldersaxel) i ett svep, för hur
+många år, regioner och kön som helst samtidigt.
+"""
+
+from typing import Dict, Iterable, List, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+MAX_AGE = 100  # SCB:s högsta ålderskod är "100+"
+
+
+class AgeBands:
+    """En uppsättning åldersgrupper med uppslagsarray ålder -> grupp"""
+
+    def __init__(self, lower_bounds: Sequence[int], labels: Optional[Sequence[str]] = None):
+        """
+        Args:
+            lower_bounds: Gruppernas nedre gränser i stigande ordning (den första ska vara 0)
+            labels: Etiketter per grupp (default: "a-b" och "a+" för den sista)
+        """
+        bounds = [int(b) for b in lower_bounds]
+        if not bounds or bounds[0] != 0 or any(b >= c for b, c in zip(bounds, bounds[1:])):
+            raise ValueError(f"Ogiltiga åldersgränser: {lower_bounds}")
+        if labels is None:
+            labels = [f"{b}-{c - 1}" if c - 1 > b else str(b) for b, c in zip(bounds, bounds[1:])]
+            labels.append(f"{bounds[-1]}+")
+        if len(labels) != len(bounds):
+            raise ValueError("En etikett per åldersgrupp krävs")
+
+        self.lower_bounds = bounds
+        self.labels = list(labels)
+        # lookup[ålder] = gruppindex för åldrarna 0..MAX_AGE
+        self.lookup = np.searchsorted(bounds, np.arange(MAX_AGE + 1), side="right") - 1
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def codes(self, ages: Iterable) -> np.ndarray:
+        """Gruppindex per ålder (-1 för koder som inte är en ålder, t.ex. "tot")"""
+        numbers = age_numbers(ages)
+        result = np.full(len(numbers), -1)
+        valid = numbers >= 0
+        result[valid] = self.lookup[np.minimum(numbers[valid], MAX_AGE)]
+        return result
+
+    def categorical(self, ages: Iterable) -> pd.Categorical:
+        """Åldersgrupp per ålder som ordnad kategori (sorteras efter ålder, inte text)"""
+        return pd.Categorical.from_codes(self.codes(ages), categories=self.labels, ordered=True)
+
+
+# Fördefinierade indelningar
+FIVE_YEAR = AgeBands(range(0, 100, 5))
+PLANNING = AgeBands([0, 6, 16, 20, 65, 80])  # Förskola, grundskola, gymnasium, arbetsför, äldre
+BAND_SETS: Dict[str, AgeBands] = {
+    "5år": FIVE_YEAR,
+    "planering": PLANNING,
+}
+
+
+def get_bands(bands: Union[str, AgeBands, Sequence[int]]) -> AgeBands:
+    """Indelning från namn i BAND_SETS, en AgeBands eller en lista med nedre gränser"""
+    if isinstance(bands, AgeBands):
+        return bands
+    if isinstance(bands, str):
+        if bands not in BAND_SETS:
+            raise ValueError(f"Okänd åldersindelning: {bands} (finns: {', '.join(BAND_SETS)})")
+        return BAND_SETS[bands]
+    return AgeBands(bands)
+
+
+def age_numbers(ages: Iterable) -> np.ndarray:
+    """Ålderskoder ("0".."99", "100+") som heltal, -1 för övriga koder"""
+    codes = pd.Series(np.asarray(list(ages), dtype=object)).astype(str).str.rstrip("+")
+    return pd.to_numeric(codes, errors="coerce").fillna(-1).astype(int).to_numpy()
+
+
+def bin_frame(df: pd.DataFrame, bands: Union[str, AgeBands, Sequence[int]] = FIVE_YEAR,
+              by: Optional[List[str]] = None, age_column: str = "Ålder",
+              value_column: str = "Antal", label_column: str = "Åldersgrupp") -> pd.DataFrame:
+    """
+    Summerar en DataFrame med ettåriga åldrar per åldersgrupp
+
+    Rader vars ålder inte är en ålder (t.ex. "tot") tas inte med.
+
+    Args:
+        df: Data med en rad per ålder (och t.ex. kön, år, region)
+        bands: Indelning (namn, AgeBands eller nedre gränser)
+        by: Kolumner att behålla (default: alla utom ålder och värde)
+        age_column: Kolumn med ålderskoder
+        value_column: Kolumn som summeras
+        label_column: Namn på kolumnen med åldersgrupp
+
+    Returns:
+        DataFrame med by-kolumnerna, label_column (ordnad kategori) och value_column
+    """
+    bands = get_bands(bands)
+    if by is None:
+        by = [c for c in df.columns if c not in (age_column, value_column)]
+
+    groups = bands.categorical(df[age_column])
+    keep = groups.codes >= 0
+    binned = df.loc[keep, by].assign(**{label_column: groups[keep], value_column: df.loc[keep, value_column]})
+    return (binned.groupby(by + [label_column], observed=True, sort=False)[value_column]
+            .sum().reset_index()
+            .sort_values(by + [label_column], kind="stable", ignore_index=True))
+
+
+def bin_array(values: np.ndarray, bands: Union[str, AgeBands, Sequence[int]] = FIVE_YEAR,
+              axis: int = 0) -> np.ndarray:
+    """
+    Summerar en array med åldrarna 0..MAX_AGE längs axis per åldersgrupp
+
+    Saknade värden räknas som 0. Summeringen görs med np.add.reduceat, så alla
+    övriga axlar (kön, år, region ...) behandlas i samma anrop.
+    """
+    bands = get_bands(bands)
+    return np.add.reduceat(np.nan_to_num(values), bands.lower_bounds, axis=axis)
@@ -0,0 +1,270 @@
+"""
+Stabila cache-nycklar för SCB-frågor
+
+Pythons inbyggda hash() saltas per process, så varje omstart eller ny worker
+skrev en ny cache-fil för samma fråga. Nycklarna byggs här istället från en
+SHA-256 av endpoint och en kanonisk JSON-form av frågan, vilket ger samma
+filnamn i alla processer.
+
+Modulen innehåller också migreringen av de gamla hash()-baserade filerna:
+dubbletter med identiskt innehåll slås ihop och registreras i ett litet index,
+och första uppslaget med den nya nyckeln får en kopia av filen. Repot har
+redan migrerade filer (scb_<endpoint>_legacy-<hash>.json och indexet), så en
+ny utcheckning startar med varm cache utan att filerna ändras.
+"""
+
+import copy
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Dict, List, Optional
+
+from data import cache_store
+
+LEGACY_INDEX_FILE = "scb_legacy_index.json"
+DIGEST_LENGTH = 32
+
+# Gamla filnamn: scb_<endpoint>_<hash()>.json (SCBConnector) och
+# <endpoint>_<hash()>.json (SCB_Dataservice). Endpoints börjar med SCB:s
+# ämnesområde (BE, BO, ...) och hash() ger alltid ett heltal.
+_LEGACY_PATTERN = re.compile(r"^(?:scb_)?(?P<endpoint>[A-Z]{2}(?:_[A-Za-z0-9]+)+)_(?P<hash>-?\d{1,20})\.json$")
+
+_lock = threading.Lock()
+_migrated_dirs = set()
+
+
+def safe_endpoint(endpoint: str) -> str:
+    """Gör om en endpoint till en filnamnsvänlig form"""
+    return endpoint.strip("/").replace("/", "_")
+
+
+def canonical_query(query: Dict) -> str:
+    """
+    Returnerar en kanonisk JSON-sträng för en PxWeb-fråga
+
+    Dimensionerna sorteras på kod eftersom PxWeb alltid svarar i tabellens
+    ordning oavsett i vilken ordning urvalen skickas.
+    """
+    normalized = copy.deepcopy(query)
+    selections = normalized.get("query")
+    if isinstance(selections, list):
+        normalized["query"] = sorted(selections, key=lambda s: str(s.get("code", "")))
+    return json.dumps(normalized, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+
+def query_digest(endpoint: str, query: Dict) -> str:
+    """Stabil digest av endpoint plus kanonisk fråga (samma i alla processer)"""
+    material = f"{endpoint.strip('/')}\n{canonical_query(query)}"
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()[:DIGEST_LENGTH]
+
+
+def cache_filename(endpoint: str, query: Dict, prefix: str = "scb") -> str:
+    """Filnamn för en cachad SCB-fråga"""
+    return f"{prefix}_{safe_endpoint(endpoint)}_{query_digest(endpoint, query)}.json"
+
+
+# ==================== MIGRERING AV GAMLA FILER ====================
+
+def _payload_signature(data: Dict) -> Optional[Dict]:
+    """Beskriver vilket urval ett sparat PxWeb-svar täcker"""
+    if not isinstance(data, dict):
+        return None
+    columns = data.get("columns")
+    rows = data.get("data")
+    if not isinstance(columns, list) or not isinstance(rows, list):
+        return None
+
+    dim_codes = [c.get("code") for c in columns if c.get("type") != "c"]
+    dims: Dict[str, set] = {code: set() for code in dim_codes}
+    for row in rows:
+        for code, value in zip(dim_codes, row.get("key", [])):
+            dims[code].add(value)
+
+    return {
+        "dims": {code: sorted(values) for code, values in dims.items()},
+        "contents": sorted(c.get("code") for c in columns if c.get("type") == "c"),
+        "rows": len(rows),
+    }
+
+
+def _index_path(cache_dir: str) -> str:
+    return os.path.join(cache_dir, LEGACY_INDEX_FILE)
+
+
+def _load_index(cache_dir: str) -> List[Dict]:
+    try:
+        with open(_index_path(cache_dir), "r", encoding="utf-8") as f:
+            return json.load(f).get("entries", [])
+    except (OSError, ValueError):
+        return []
+
+
+def _save_index(cache_dir: str, entries: List[Dict]):
+    path = _index_path(cache_dir)
+    if not entries:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return
+    cache_store.write_atomic(
+        path, json.dumps({"version": 1, "entries": entries}, ensure_ascii=False).encode("utf-8")
+    )
+
+
+def migrate_legacy_cache(cache_dir: str) -> Dict[str, int]:
+    """
+    Slår ihop gamla hash()-baserade cache-filer
+
+    Filer med identiskt innehåll för samma endpoint reduceras till en (den
+    senast skrivna), som döps om och registreras i ett index tillsammans med
+    vilket urval den täcker. Körs en gång per process och katalog. Flera
+    arbetsprocesser kan migrera samtidigt: filer som en annan process redan
+    flyttat eller tagit bort hoppas över.
+
+    Returns:
+        Dict med antal lästa, borttagna och behållna filer
+    """
+    stats = {"scanned": 0, "removed": 0, "kept": 0}
+
+    with _lock:
+        if cache_dir in _migrated_dirs:
+            return stats
+        _migrated_dirs.add(cache_dir)
+
+        try:
+            names = os.listdir(cache_dir)
+        except OSError:
+            return stats
+
+        groups: Dict[tuple, List[tuple]] = {}
+        for name in names:
+            match = _LEGACY_PATTERN.match(name)
+            if not match:
+                continue
+            path = os.path.join(cache_dir, name)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                mtime = os.path.getmtime(path)
+            except FileNotFoundError:
+                continue  # Redan migrerad av en annan process
+            except (OSError, ValueError) as e:
+                print(f"⚠️ Kunde inte läsa gammal cache-fil {name}: {e}")
+                continue
+
+            stats["scanned"] += 1
+            content = hashlib.sha256(
+                json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")
+            ).hexdigest()
+            key = (match.group("endpoint"), content)
+            groups.setdefault(key, []).append((mtime, path, data))
+
+        if not groups:
+            return stats
+
+        entries = _load_index(cache_dir)
+        known = {e["file"] for e in entries}
+
+        for (endpoint, content), files in groups.items():
+            files.sort(key=lambda f: f[0], reverse=True)
+            _, newest_path, data = files[0]
+            signature = _payload_signature(data)
+
+            for _, path, _ in files[1:]:
+                try:
+                    os.remove(path)
+                    stats["removed"] += 1
+                except OSError:
+                    pass
+
+            if signature is None:
+                continue
+
+            target_name = f"scb_{endpoint}_legacy-{content[:16]}.json"
+            try:
+                os.replace(newest_path, os.path.join(cache_dir, target_name))
+            except FileNotFoundError:
+                # En annan process hann flytta filen; den registreras ändå nedan
+                if not os.path.exists(os.path.join(cache_dir, target_name)):
+                    continue
+            except OSError as e:
+                print(f"⚠️ Kunde inte flytta gammal cache-fil: {e}")
+                continue
+            stats["kept"] += 1
+
+            if target_name not in known:
+                entries.append({"endpoint": endpoint, "file": target_name, **signature})
+                known.add(target_name)
+
+        try:
+            _save_index(cache_dir, entries)
+        except OSError as e:
+            print(f"⚠️ Kunde inte spara migreringsindex: {e}")
+
+    print(f"🔄 SCB-cache migrerad: {stats['scanned']} filer, {stats['removed']} dubbletter borttagna")
+    return stats
+
+
+def _signature_matches(query: Dict, entry: Dict) -> bool:
+    """
+    Kontrollerar om en fråga efterfrågar exakt det urval ett gammalt svar täcker
+
+    Svaret får inte ha fler (eller färre) dimensioner än frågan: en variabel
+    som frågan utelämnar men svaret innehåller ger annars fel data.
+    """
+    if query.get("response", {}).get("format", "json") != "json":
+        return False
+
+    codes = {selection.get("code") for selection in query.get("query", [])}
+    if "ContentsCode" not in codes or codes - {"ContentsCode"} != set(entry["dims"]):
+        return False
+
+    for selection in query.get("query", []):
+        code = selection.get("code")
+        spec = selection.get("selection", {})
+        filter_type = spec.get("filter", "item")
+        if filter_type != "item" and not filter_type.startswith("vs:"):
+            return False
+
+        values = set(spec.get("values", []))
+        if code == "ContentsCode":
+            if values != set(entry["contents"]):
+                return False
+        elif code not in entry["dims"] or values != set(entry["dims"][code]):
+            return False
+
+    return True
+
+
+def adopt_legacy_entry(cache_dir: str, endpoint: str, query: Dict, target_path: str) -> bool:
+    """
+    Låter en ny cache-nyckel ta över ett migrerat gammalt svar
+
+    Filen kopieras (med samma ändringstid, och därmed TTL) och både den och
+    indexet lämnas orörda, så att de versionshanterade filerna inte ändras.
+    Returnerar True om en fil kopierades.
+    """
+    with _lock:
+        entries = _load_index(cache_dir)
+        candidates = [
+            e for e in entries
+            if e["endpoint"] == safe_endpoint(endpoint) and _signature_matches(query, e)
+        ]
+        if not candidates:
+            return False
+
+        best = max(candidates, key=lambda e: e["rows"])
+        source = os.path.join(cache_dir, best["file"])
+        try:
+            with open(source, "rb") as f:
+                data = f.read()
+            mtime = os.path.getmtime(source)
+            cache_store.write_atomic(target_path, data)
+            os.utime(target_path, (mtime, mtime))
+        except OSError as e:
+            print(f"⚠️ Kunde inte kopiera migrerad cache-fil {best['file']}: {e}")
+            return False
+        return True
@@ -0,0 +1,619 @@
+"""
+Gemensam diskcache med budget, TTL per namnrymd och utrensning
+
+Tidigare skrev varje koppling egna JSON-filer i cache/ och inget togs
+någonsin bort. Här hanteras alla poster av ett och samma lager: ett index
+(cache_index.json) håller storlek, hämtningstid, senaste åtkomst och antal
+träffar per fil, så att uppslag inte kräver att katalogen listas. Poster
+äldre än namnrymdens retain-tid rensas, och när byte- eller antalsbudgeten
+överskrids vräks de minst använda posterna (LRU eller LFU). En bakgrundstråd
+gör utrensningen med jämna mellanrum.
+
+Poster äldre än namnrymdens ttl returneras fortfarande men markerade som
+inaktuella, så att anroparna kan servera dem medan de uppdateras.
+
+Indexet sparar också svarens validerare (ETag, Last-Modified) och en hash av
+innehållet. En uppdatering som besvaras med 304 förlänger posten utan att
+filen skrivs om, och en uppdatering med samma innehåll som förut (servrar
+utan validerare) känns igen på hashen.
+
+Posterna skrivs komprimerade: MAGIC, en formatversion och en kodningsbyte
+följt av nyttolasten, serialiserad med msgpack (annars kompakt JSON) och
+komprimerad med zstd (annars zlib). Filer utan MAGIC är äldre okomprimerad
+JSON och läses som förut tills de skrivs om. Filändelsen .json behålls så att
+cachenycklarna inte ändras.
+
+Flera arbetsprocesser kan dela katalogen. Varje process håller indexet i
+minnet, men innan den vräker poster eller skriver indexet tar den ett
+fillås (cache_index.json.lock), läser om indexet om en annan process skrivit
+det och slår ihop posterna. Därför försvinner inga poster som andra
+processer lagt till, och vräkningen räknar med hela katalogens storlek.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+INDEX_FILE = "cache_index.json"
+INDEX_LOCK_FILE = "cache_index.json.lock"
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+DEFAULT_MAX_ENTRIES = 5000
+INDEX_FLUSH_SECONDS = 10  # Åtkomststatistik skrivs till indexet högst så här ofta
+SWEEP_INTERVAL = 15 * 60
+
+# ttl: därefter inaktuell (serveras och uppdateras); retain: därefter borttagen
+NAMESPACES = {
+    "scb": {"ttl": 7 * 86400, "retain": 90 * 86400},
+    "kolada": {"ttl": 7 * 86400, "retain": 90 * 86400},
+    "snapshot": {"ttl": 86400, "retain": 7 * 86400},  # EnhancedDataManager
+}
+DEFAULT_NAMESPACE = {"ttl": 86400, "retain": 30 * 86400}
+
+# Filer i cache/ som hanteras här; övriga (metadata, kuber, Koladas lager,
+# migreringsindex, migrerade SCB-svar och gamla Koladafiler som importeras)
+# sköts av sina moduler
+MANAGED_PREFIXES = ("scb_", "kolada_", "kungsbacka_data_")
+UNMANAGED_PREFIXES = ("scb_meta_", "scb_legacy_index", "kolada_kpi_data_")
+
+
+def is_managed(name: str) -> bool:
+    """True om filen i cachekatalogen hör till den gemensamma cachen"""
+    # Migrerade SCB-svar (scb_<endpoint>_legacy-<hash>.json) versionshanteras
+    # och kopieras till nya nycklar, så de får aldrig vräkas
+    return (name.endswith(".json") and name.startswith(MANAGED_PREFIXES)
+            and not name.startswith(UNMANAGED_PREFIXES) and "_legacy-" not in name)
+
+
+def write_atomic(path: str, data: bytes):
+    """
+    Skriver en fil atomiskt via en unik temporärfil i samma katalog
+
+    Samtidiga skrivare (trådar eller processer) får var sin temporärfil, och
+    os.replace gör att läsare ser antingen den gamla eller den nya filen.
+
+    Raises:
+        OSError: om filen inte kunde skrivas (temporärfilen tas bort)
+    """
+    tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".",
+                                      prefix=f"{os.path.basename(path)}.", suffix=".tmp", delete=False)
+    try:
+        with tmp:
+            tmp.write(data)
+        os.replace(tmp.name, path)
+    except BaseException:
+        try:
+            os.remove(tmp.name)
+        except OSError:
+            pass
+        raise
+
+
+# Filhuvud: MAGIC + FORMAT_VERSION + kodning (serialisering << 4 | komprimering)
+MAGIC = b"KBC"
+FORMAT_VERSION = 1
+SERIALIZER_JSON = 0
+SERIALIZER_MSGPACK = 1
+COMPRESSION_ZLIB = 0
+COMPRESSION_ZSTD = 1
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def _serialize(value: Any) -> Tuple[int, bytes]:
+    """Värdet som (serialisering, byte), med msgpack om det finns"""
+    if msgpack is not None:
+        return SERIALIZER_MSGPACK, msgpack.packb(value, use_bin_type=True)
+    return SERIALIZER_JSON, json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _pack(serializer: int, payload: bytes) -> bytes:
+    """Komprimerar en serialiserad nyttolast och lägger till filhuvudet"""
+    if zstandard is not None:
+        compression = COMPRESSION_ZSTD
+        body = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(payload)
+    else:
+        compression = COMPRESSION_ZLIB
+        body = zlib.compress(payload, ZLIB_LEVEL)
+    return MAGIC + bytes([FORMAT_VERSION, serializer << 4 | compression]) + body
+
+
+def dumps(value: Any) -> bytes:
+    """Ett JSON-kompatibelt värde i cachens binära format"""
+    return _pack(*_serialize(value))
+
+
+def loads(data: bytes) -> Any:
+    """
+    Avkodar en post i cachens format, eller äldre okomprimerad JSON
+
+    Raises:
+        ValueError: om posten är skadad eller skriven i ett format som inte
+            kan läsas här (okänd version, eller zstd/msgpack saknas)
+    """
+    if not data.startswith(MAGIC):
+        return json.loads(data.decode("utf-8"))
+    if len(data) < len(MAGIC) + 2 or data[len(MAGIC)] != FORMAT_VERSION:
+        raise ValueError("Okänd version av cacheformatet")
+
+    encoding = data[len(MAGIC) + 1]
+    serializer, compression = encoding >> 4, encoding & 0x0F
+    body = data[len(MAGIC) + 2:]
+    try:
+        if compression == COMPRESSION_ZSTD and zstandard is not None:
+            payload = zstandard.ZstdDecompressor().decompress(body)
+        elif compression == COMPRESSION_ZLIB:
+            payload = zlib.decompress(body)
+        else:
+            raise ValueError(f"Komprimeringen {compression} stöds inte här")
+
+        if serializer == SERIALIZER_MSGPACK and msgpack is not None:
+            return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+        if serializer == SERIALIZER_JSON:
+            return json.loads(payload.decode("utf-8"))
+        raise ValueError(f"Serialiseringen {serializer} stöds inte här")
+    except ValueError:
+        raise
+    except Exception as e:
+        # zlib.error, zstd- och msgpack-fel
+        raise ValueError(f"Skadad cachepost: {e}") from e
+
+
+def content_digest(value: Any) -> str:
+    """Hash av ett JSON-värde (för att känna igen oförändrade svar)"""
+    return hashlib.sha256(json.dumps(value, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class CacheEntry(NamedTuple):
+    value: Any
+    fetched_at: float
+    stale: bool
+
+
+def namespace_of(name: str) -> str:
+    """Namnrymd för en fil som inte finns i indexet (t.ex. äldre filer)"""
+    if name.startswith("kolada_"):
+        return "kolada"
+    if name.startswith("kungsbacka_data_"):
+        return "snapshot"
+    return "scb"
+
+
+class CacheStore:
+    """Indexerad diskcache i en katalog"""
+
+    def __init__(self, cache_dir: str = "cache", max_bytes: int = DEFAULT_MAX_BYTES,
+                 max_entries: int = DEFAULT_MAX_ENTRIES, policy: str = "lru"):
+        """
+        Args:
+            cache_dir: Katalog för filerna och indexet
+            max_bytes: Största sammanlagda storlek för cachens filer
+            max_entries: Största antal filer
+            policy: "lru" (äldst åtkomst vräks först) eller "lfu" (minst antal träffar först)
+        """
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Okänd vräkningspolicy: {policy}")
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._flushed_at = 0.0
+        self._evictions = 0
+        self._revalidated = 0
+        self._unchanged = 0
+        self._sweeper: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._index_seen: Optional[Tuple[int, int]] = None  # (mtime_ns, storlek) när indexet senast lästes
+        self._index_lock_depth = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        with self._index_lock():
+            self._entries = self._load_index()
+
+    # ---- index ----
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, name)
+
+    def _load_index(self) -> Dict[str, Dict]:
+        """Läser indexet och stämmer av det mot katalogen (en gång per process)"""
+        entries = self._read_index() or {}
+
+        on_disk = {}
+        with os.scandir(self.cache_dir) as it:
+            for item in it:
+                if item.is_file() and is_managed(item.name):
+                    on_disk[item.name] = item.stat()
+
+        reconciled = {}
+        for name, stat in on_disk.items():
+            entry = entries.get(name)
+            if entry is None or entry.get("size") != stat.st_size:
+                entry = self._describe(name, stat)
+            reconciled[name] = entry
+        if reconciled.keys() != entries.keys():
+            self._dirty = True
+        return reconciled
+
+    def _read_index(self) -> Optional[Dict[str, Dict]]:
+        """Indexet på disken, eller None om det saknas, är oläsbart eller redan lästs"""
+        path = self._path(INDEX_FILE)
+        try:
+            stat = os.stat(path)
+            seen = (stat.st_mtime_ns, stat.st_size)
+            if seen == self._index_seen:
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._index_seen = seen
+        return entries if isinstance(entries, dict) else None
+
+    @contextmanager
+    def _index_lock(self):
+        """
+        Fillås kring läsning och skrivning av indexet (anropas med låset taget)
+
+        Låset är återinträdbart inom processen, eftersom flock på en ny
+        filreferens annars skulle vänta på processens eget lås.
+        """
+        if fcntl is None or self._index_lock_depth:
+            self._index_lock_depth += 1
+            try:
+                yield
+            finally:
+                self._index_lock_depth -= 1
+            return
+
+        with open(self._path(INDEX_LOCK_FILE), "a+") as handle:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+            self._index_lock_depth += 1
+            try:
+                yield
+            finally:
+                self._index_lock_depth -= 1
+                fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+    def _merge_index(self):
+        """
+        Slår ihop indexet på disken med processens (anropas med båda låsen tagna)
+
+        Poster som bara finns på ena hållet behålls om filen finns kvar (den
+        andra processen har lagt till eller vräkt den). För poster som finns
+        på båda hållen gäller den senast hämtade, med senaste åtkomst och
+        flest träffar från båda.
+        """
+        disk = self._read_index()
+        if disk is None:
+            return
+
+        merged = {}
+        for name in self._entries.keys() | disk.keys():
+            ours, theirs = self._entries.get(name), disk.get(name)
+            if ours is None or theirs is None:
+                if os.path.exists(self._path(name)):
+                    merged[name] = ours or theirs
+                continue
+            newest = dict(theirs if theirs.get("fetched_at", 0) > ours.get("fetched_at", 0) else ours)
+            newest["accessed"] = max(ours.get("accessed", 0), theirs.get("accessed", 0))
+            newest["hits"] = max(ours.get("hits", 0), theirs.get("hits", 0))
+            merged[name] = newest
+        self._entries = merged
+
+    @staticmethod
+    def _describe(name: str, stat: os.stat_result) -> Dict:
+        """Indexpost för en fil som skrivits utanför cachen (t.ex. migrerad)"""
+        return {
+            "ns": namespace_of(name),
+            "size": stat.st_size,
+            "fetched_at": stat.st_mtime,
+            "accessed": stat.st_mtime,
+            "hits": 0,
+        }
+
+    def _flush(self, force: bool = False):
+        """Slår ihop och skriver indexet om det ändrats (anropas med låset taget)"""
+        if not self._dirty or (not force and time.time() - self._flushed_at < INDEX_FLUSH_SECONDS):
+            return
+        path = self._path(INDEX_FILE)
+        try:
+            with self._index_lock():
+                self._merge_index()
+                write_atomic(path, json.dumps(self._entries, separators=(",", ":")).encode("utf-8"))
+                stat = os.stat(path)
+                self._index_seen = (stat.st_mtime_ns, stat.st_size)
+            self._dirty = False
+            self._flushed_at = time.time()
+        except OSError as e:
+            print(f"⚠️ Kunde inte spara cacheindex: {e}")
+
+    def _lookup(self, name: str) -> Optional[Dict]:
+        """Indexposten, eller en ny post om filen lagts dit utanför cachen"""
+        entry = self._entries.get(name)
+        if entry is None:
+            try:
+                stat = os.stat(self._path(name))
+            except OSError:
+                return None
+            entry = self._entries[name] = self._describe(name, stat)
+            self._dirty = True
+        return entry
+
+    # ---- uppslag ----
+
+    @staticmethod
+    def ttl(namespace: str) -> float:
+        return NAMESPACES.get(namespace, DEFAULT_NAMESPACE)["ttl"]
+
+    def contains(self, name: str) -> bool:
+        with self._lock:
+            return self._lookup(name) is not None
+
+    def get(self, namespace: str, name: str, max_age: Optional[float] = None) -> Optional[CacheEntry]:
+        """
+        Läser en post
+
+        Args:
+            namespace: Postens namnrymd (styr ttl)
+            name: Filnamn i cachekatalogen
+            max_age: Ålder i sekunder då posten räknas som inaktuell (default: namnrymdens ttl)
+
+        Returns:
+            CacheEntry med värde, hämtningstid och om posten är inaktuell, eller None
+        """
+        with self._lock:
+            entry = self._lookup(name)
+            if entry is None:
+                return None
+            fetched_at = entry["fetched_at"]
+
+        try:
+            with open(self._path(name), "rb") as f:
+                value = loads(f.read())
+        except FileNotFoundError:
+            with self._lock:
+                self._entries.pop(name, None)
+                self._dirty = True
+            return None
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Cache-läsfel: {e}")
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry["accessed"] = now
+            entry["hits"] = entry.get("hits", 0) + 1
+            self._dirty = True
+            self._flush()
+
+        max_age = self.ttl(namespace) if max_age is None else max_age
+        return CacheEntry(value, fetched_at, now - fetched_at >= max_age)
+
+    def put(self, namespace: str, name: str, value: Any, fetched_at: Optional[float] = None,
+            validators: Optional[Dict[str, str]] = None) -> bool:
+        """
+        Skriver en post atomiskt och vräker poster om budgeten överskrids
+
+        Har posten redan samma innehåll (samma hash av den serialiserade
+        nyttolasten) skrivs filen inte om, utan bara hämtningstiden och
+        validerarna uppdateras.
+
+        Args:
+            namespace: Postens namnrymd
+            name: Filnamn i cachekatalogen
+            value: JSON-serialiserbart värde
+            fetched_at: Hämtningstid (default: nu)
+            validators: ETag/Last-Modified från svaret (se http_transport.response_validators)
+
+        Returns:
+            True om innehållet ändrats (eller posten är ny)
+        """
+        path = self._path(name)
+        now = time.time()
+        try:
+            serializer, payload = _serialize(value)
+        except (TypeError, ValueError) as e:
+            print(f"⚠️ Cache-skrivfel: {e}")
+            return True
+        digest = hashlib.sha256(payload).hexdigest()
+
+        with self._lock:
+            previous = self._entries.get(name)
+            if previous is not None and previous.get("digest") == digest and os.path.exists(path):
+                # Ingen ändring sedan förra hämtningen: förläng bara posten
+                previous["fetched_at"] = fetched_at if fetched_at is not None else now
+                previous["accessed"] = now
+                previous["validators"] = validators or {}
+                self._unchanged += 1
+                self._dirty = True
+                self._flush()
+                return False
+
+        data = _pack(serializer, payload)
+        try:
+            write_atomic(path, data)
+        except OSError as e:
+            print(f"⚠️ Cache-skrivfel: {e}")
+            return True
+
+        with self._lock:
+            previous = self._entries.get(name, {})
+            self._entries[name] = {
+                "ns": namespace,
+                "size": len(data),
+                "fetched_at": fetched_at if fetched_at is not None else now,
+                "accessed": now,
+                "hits": previous.get("hits", 0),
+                "digest": digest,
+                "validators": validators or {},
+            }
+            self._dirty = True
+            self._evict(protect=name)
+            self._flush()
+        return True
+
+    def validators(self, name: str) -> Dict[str, str]:
+        """Sparade ETag/Last-Modified för en post (tomt om de saknas)"""
+        with self._lock:
+            entry = self._entries.get(name)
+            return dict(entry.get("validators") or {}) if entry else {}
+
+    def revalidated(self, name: str, validators: Optional[Dict[str, str]] = None) -> bool:
+        """
+        Förlänger en post efter ett 304-svar, utan att filen skrivs om
+
+        Args:
+            name: Filnamn i cachekatalogen
+            validators: Validerare från 304-svaret (behåller de gamla om tomt)
+
+        Returns:
+            False om posten inte längre finns (den måste då hämtas på nytt)
+        """
+        with self._lock:
+            entry = self._lookup(name)
+            if entry is None:
+                return False
+            entry["fetched_at"] = time.time()
+            if validators:
+                entry["validators"] = {**entry.get("validators", {}), **validators}
+            self._revalidated += 1
+            self._dirty = True
+            self._flush()
+            return True
+
+    def delete(self, name: str):
+        with self._lock:
+            self._remove(name)
+            self._flush()
+
+    def _remove(self, name: str):
+        """Tar bort fil och indexpost (anropas med låset taget)"""
+        self._entries.pop(name, None)
+        self._dirty = True
+        try:
+            os.remove(self._path(name))
+        except OSError:
+            pass
+
+    # ---- utrensning ----
+
+    def _evict(self, protect: Optional[str] = None):
+        """
+        Vräker poster tills budgeten håller (anropas med låset taget)
+
+        Andra processers poster slås först in från indexet på disken, så att
+        budgeten gäller hela katalogen.
+        """
+        with self._index_lock():
+            self._merge_index()
+            total = sum(e["size"] for e in self._entries.values())
+            if total <= self.max_bytes and len(self._entries) <= self.max_entries:
+                return
+
+            if self.policy == "lfu":
+                key = lambda item: (item[1].get("hits", 0), item[1]["accessed"])
+            else:
+                key = lambda item: item[1]["accessed"]
+
+            for name, entry in sorted(self._entries.items(), key=key):
+                if total <= self.max_bytes and len(self._entries) <= self.max_entries:
+                    break
+                if name == protect:
+                    continue
+                total -= entry["size"]
+                self._remove(name)
+                self._evictions += 1
+
+    def sweep(self) -> int:
+        """
+        Tar bort poster äldre än namnrymdens retain-tid och vräker över budget
+
+        Returns:
+            Antal borttagna poster
+        """
+        now = time.time()
+        with self._lock, self._index_lock():
+            self._merge_index()
+            before = len(self._entries)
+            for name, entry in list(self._entries.items()):
+                retain = NAMESPACES.get(entry["ns"], DEFAULT_NAMESPACE)["retain"]
+                if now - entry["fetched_at"] > retain or not os.path.exists(self._path(name)):
+                    # Filer som flyttats eller tagits bort utanför cachen släpps också
+                    self._remove(name)
+            self._evict()
+            self._flush(force=True)
+            return before - len(self._entries)
+
+    def start_sweeper(self, interval: float = SWEEP_INTERVAL):
+        """Startar bakgrundsutrensningen (en tråd per cache)"""
+        with self._lock:
+            if self._sweeper is not None:
+                return
+
+            def run():
+                while not self._stop.wait(interval):
+                    try:
+                        removed = self.sweep()
+                        if removed:
+                            print(f"🔄 Cache-utrensning: {removed} poster borttagna")
+                    except Exception as e:
+                        print(f"⚠️ Cache-utrensning misslyckades: {e}")
+
+            self._sweeper = threading.Thread(target=run, name="cache-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def stats(self) -> Dict:
+        """Storlek, antal och vräkningar, totalt och per namnrymd"""
+        with self._lock:
+            per_namespace: Dict[str, Dict] = {}
+            for entry in self._entries.values():
+                ns = per_namespace.setdefault(entry["ns"], {"entries": 0, "bytes": 0})
+                ns["entries"] += 1
+                ns["bytes"] += entry["size"]
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(e["size"] for e in self._entries.values()),
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "evictions": self._evictions,
+                "revalidated": self._revalidated,
+                "unchanged": self._unchanged,
+                "namespaces": per_namespace,
+            }
+
+
+_stores: Dict[str, CacheStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(cache_dir: str = "cache") -> CacheStore:
+    """Processgemensam cache för en katalog, med utrensning i bakgrunden"""
+    key = os.path.abspath(cache_dir)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = CacheStore(cache_dir)
+            store.start_sweeper()
+        return store
@@ -0,0 +1,223 @@
+"""
+Kretsbrytare per endpoint och negativ cache för misslyckade anrop
+
+Ett anrop mot en endpoint som är nere eller har flyttats kostade tidigare
+hela timeouten (30–60 s) vid varje omkörning av sidan. Här minns transporten
+fel på två sätt:
+
+- Negativ cache: ett identiskt anrop som nyss gav 4xx, 5xx eller timeout
+  besvaras direkt med ett nytt svar med samma status och innehåll (eller
+  ett fel) tills posten gått ut.
+- Kretsbrytare: efter FAILURE_THRESHOLD fel i rad (5xx, timeout eller
+  anslutningsfel) öppnas brytaren för endpointen och alla anrop mot den
+  avvisas direkt. När nedkylningen gått ut släpps ett provanrop igenom
+  (halvöppen); lyckas det stängs brytaren, annars öppnas den igen med
+  dubbel nedkylning.
+
+4xx räknas inte som fel för brytaren, eftersom servern svarade.
+"""
+
+import threading
+import time
+from typing import Dict, Hashable, List, Optional
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+CLOSED = "stängd"
+OPEN = "öppen"
+HALF_OPEN = "halvöppen"
+
+FAILURE_THRESHOLD = 3
+COOLDOWN = 30.0
+MAX_COOLDOWN = 600.0
+NEGATIVE_TTL_CLIENT_ERROR = 300.0  # 4xx: frågan eller endpointen är fel, ändras sällan snabbt
+NEGATIVE_TTL_SERVER_ERROR = 30.0  # 5xx och timeouts: kan vara tillfälligt
+MAX_NEGATIVE_ENTRIES = 1000
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Anropet avvisades utan att skickas (öppen brytare eller nyligen misslyckat)"""
+
+
+class _StoredResponse:
+    """Status, huvuden och innehåll för ett felsvar i den negativa cachen"""
+
+    __slots__ = ("status_code", "headers", "content", "url", "reason", "encoding")
+
+    def __init__(self, response: requests.Response):
+        self.status_code = response.status_code
+        self.headers = dict(response.headers)
+        self.content = response.content
+        self.url = response.url
+        self.reason = response.reason
+        self.encoding = response.encoding
+
+    def to_response(self) -> requests.Response:
+        """Ett nytt Response-objekt, så att anroparna inte delar (och ändrar) samma svar"""
+        response = requests.Response()
+        response.status_code = self.status_code
+        response.headers = CaseInsensitiveDict(self.headers)
+        response._content = self.content
+        response.url = self.url
+        response.reason = self.reason
+        response.encoding = self.encoding
+        return response
+
+
+class _Endpoint:
+    """Brytarens tillstånd för en endpoint (skyddas av registrets lås)"""
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.cooldown = COOLDOWN
+        self.open_until = 0.0
+        self.probing = False
+        self.last_error = ""
+        self.rejected = 0
+
+
+class CircuitBreakers:
+    """Processgemensamma brytare och negativ cache, nycklade per endpoint och anrop"""
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, cooldown: float = COOLDOWN,
+                 max_cooldown: float = MAX_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._endpoints: Dict[str, _Endpoint] = {}
+        self._negative: Dict[Hashable, tuple] = {}  # anrop -> (går ut, svar eller fel)
+        self._lock = threading.Lock()
+
+    def _endpoint(self, endpoint: str) -> _Endpoint:
+        state = self._endpoints.get(endpoint)
+        if state is None:
+            state = self._endpoints[endpoint] = _Endpoint()
+            state.cooldown = self.cooldown
+        return state
+
+    def before(self, endpoint: str, key: Hashable) -> Optional[requests.Response]:
+        """
+        Avgör om ett anrop får skickas
+
+        Returns:
+            Ett sparat felsvar för identiska anrop som nyss misslyckats, eller
+            None om anropet ska skickas (som provanrop om brytaren är halvöppen)
+
+        Raises:
+            CircuitOpenError: om brytaren är öppen eller anropet nyss gav timeout
+                eller anslutningsfel
+        """
+        now = time.monotonic()
+        with self._lock:
+            negative = self._negative.get(key)
+            if negative is not None:
+                expires, outcome = negative
+                if now < expires:
+                    if isinstance(outcome, _StoredResponse):
+                        return outcome.to_response()
+                    raise CircuitOpenError(
+                        f"{endpoint}: {outcome} (nyligen misslyckat, nytt försök om {expires - now:.0f} s)"
+                    )
+                del self._negative[key]
+
+            state = self._endpoint(endpoint)
+            if state.state == CLOSED:
+                return None
+            if state.state == OPEN and now >= state.open_until:
+                state.state = HALF_OPEN
+            if state.state == HALF_OPEN and not state.probing:
+                state.probing = True
+                return None
+            state.rejected += 1
+            wait = max(0.0, state.open_until - now)
+            raise CircuitOpenError(f"{endpoint} svarar inte ({state.last_error}), nytt försök om {wait:.0f} s")
+
+    def record_response(self, endpoint: str, key: Hashable, response: requests.Response):
+        """Registrerar ett svar: 5xx är fel, 4xx (utom 429) sparas negativt, övrigt lyckat"""
+        status = response.status_code
+        if status >= 500:
+            self._failure(endpoint, key, _StoredResponse(response), f"HTTP {status}")
+            return
+        stored = _StoredResponse(response) if 400 <= status < 500 and status != 429 else None
+        with self._lock:
+            if stored is not None:
+                self._remember(key, stored, NEGATIVE_TTL_CLIENT_ERROR)
+            self._success(self._endpoint(endpoint))
+
+    def record_error(self, endpoint: str, key: Hashable, error: Exception):
+        """Registrerar en timeout eller ett anslutningsfel"""
+        self._failure(endpoint, key, error, type(error).__name__)
+
+    def release(self, endpoint: str):
+        """Släpper provanropet utan utfall (t.ex. vid ett fel i den egna koden)"""
+        with self._lock:
+            self._endpoint(endpoint).probing = False
+
+    def _failure(self, endpoint: str, key: Hashable, outcome, description: str):
+        now = time.monotonic()
+        with self._lock:
+            self._remember(key, outcome, NEGATIVE_TTL_SERVER_ERROR)
+            state = self._endpoint(endpoint)
+            state.failures += 1
+            state.last_error = description
+            if state.state == HALF_OPEN:
+                # Provanropet misslyckades: öppna igen med längre nedkylning
+                state.cooldown = min(state.cooldown * 2, self.max_cooldown)
+                self._open(state, now)
+            elif state.state == CLOSED and state.failures >= self.failure_threshold:
+                self._open(state, now)
+            print(f"⚠️ {endpoint}: {description} ({state.failures} fel i rad, brytaren {state.state})")
+
+    def _open(self, state: _Endpoint, now: float):
+        state.state = OPEN
+        state.open_until = now + state.cooldown
+        state.probing = False
+
+    def _success(self, state: _Endpoint):
+        state.state = CLOSED
+        state.failures = 0
+        state.cooldown = self.cooldown
+        state.probing = False
+
+    def _remember(self, key: Hashable, outcome, ttl: float):
+        """Sparar ett negativt utfall (anropas med låset taget)"""
+        now = time.monotonic()
+        if len(self._negative) >= MAX_NEGATIVE_ENTRIES:
+            self._negative = {k: v for k, v in self._negative.items() if v[0] > now}
+            if len(self._negative) >= MAX_NEGATIVE_ENTRIES:
+                self._negative.pop(min(self._negative, key=lambda k: self._negative[k][0]))
+        self._negative[key] = (now + ttl, outcome)
+
+    def reset(self, endpoint: Optional[str] = None):
+        """Stänger en brytare (eller alla) och tömmer den negativa cachen"""
+        with self._lock:
+            if endpoint is None:
+                self._endpoints.clear()
+            else:
+                self._endpoints.pop(endpoint, None)
+            self._negative.clear()
+
+    def snapshot(self) -> List[Dict]:
+        """Tillstånd per endpoint som haft fel, för visning"""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "endpoint": endpoint,
+                    "state": state.state,
+                    "failures": state.failures,
+                    "retry_in": max(0.0, state.open_until - now) if state.state == OPEN else 0.0,
+                    "rejected": state.rejected,
+                    "last_error": state.last_error,
+                }
+                for endpoint, state in sorted(self._endpoints.items())
+                if state.failures or state.state != CLOSED
+            ]
+
+    def negative_entries(self) -> int:
+        """Antal anrop som just nu besvaras ur den negativa cachen"""
+        now = time.monotonic()
+        with self._lock:
+            return sum(1 for expires, _ in self._negative.values() if expires > now)
@@ -0,0 +1,261 @@
+"""
+Gemensam HTTP-transport för alla datakopplingar
+
+Istället för fristående requests.get/requests.post (ny TCP- och TLS-handskakning
+per anrop) delar alla kopplingar här på en Session per värd med keep-alive och
+en anslutningspool. Modulen har också en begränsad trådpool för parallella
+anrop, en gräns för samtidiga anrop per värd och enhetliga timeouts.
+
+Anrop mot värdar med kvoter (SCB) går genom en gemensam token bucket med
+prioritetskö, och 429-svar med Retry-After pausar värden och försöks igen
+istället för att bli fel. Endpoints som inte svarar stängs av en kretsbrytare
+och nyss misslyckade anrop besvaras ur en negativ cache (se circuit_breaker).
+"""
+
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Iterable, List, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from data.circuit_breaker import CircuitBreakers, CircuitOpenError
+from data.rate_limit import BACKGROUND, INTERACTIVE, TokenBucketScheduler
+
+USER_AGENT = "Kungsbacka-Dashboard/2.0"
+
+# (anslutning, läsning) i sekunder
+DEFAULT_TIMEOUT = (5, 30)
+
+POOL_SIZE = 8
+MAX_WORKERS = 8
+
+# Max antal samtidiga anrop per värd (SCB är strängast)
+HOST_CONCURRENCY = {
+    "api.scb.se": 2,
+}
+DEFAULT_HOST_CONCURRENCY = 4
+
+# Kvoter per värd: (antal anrop, per antal sekunder)
+RATE_LIMITS = {
+    "api.scb.se": (10, 10.0),
+}
+MAX_RATE_LIMIT_RETRIES = 3
+DEFAULT_RETRY_AFTER = 10.0
+
+# Antal sökvägssegment som utgör en endpoint för kretsbrytaren (default: hela
+# sökvägen). Koladas sökvägar innehåller id:n, så brytaren gäller hela /v2/data/kpi.
+ENDPOINT_SEGMENTS = {
+    "api.kolada.se": 3,
+}
+
+_lock = threading.Lock()
+_sessions: Dict[str, requests.Session] = {}
+_host_slots: Dict[str, threading.BoundedSemaphore] = {}
+_executor: Optional[ThreadPoolExecutor] = None
+_WORKER_PREFIX = "http-transport"
+_scheduler = TokenBucketScheduler(RATE_LIMITS)
+_breakers = CircuitBreakers()
+_context = threading.local()
+
+
+def _host(url: str) -> str:
+    return urlsplit(url).netloc.lower()
+
+
+def get_session(url: str) -> requests.Session:
+    """Returnerar den delade Session-instansen för URL:ens värd"""
+    host = _host(url)
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({"User-Agent": USER_AGENT})
+            _sessions[host] = session
+        return session
+
+
+def _host_slot(host: str) -> threading.BoundedSemaphore:
+    with _lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = threading.BoundedSemaphore(HOST_CONCURRENCY.get(host, DEFAULT_HOST_CONCURRENCY))
+            _host_slots[host] = slot
+        return slot
+
+
+def endpoint_of(url: str) -> str:
+    """Endpoint (värd och sökväg) som kretsbrytaren räknar fel för"""
+    parts = urlsplit(url)
+    segments = [s for s in parts.path.split("/") if s]
+    depth = ENDPOINT_SEGMENTS.get(parts.netloc.lower())
+    if depth is not None:
+        segments = segments[:depth]
+    return f"{parts.netloc.lower()}/{'/'.join(segments)}"
+
+
+def _request_key(method: str, url: str, kwargs: Dict) -> str:
+    """Nyckel för identiska anrop i den negativa cachen"""
+    payload = json.dumps([method, url, kwargs.get("params"), kwargs.get("json"), kwargs.get("data")],
+                         sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+@contextmanager
+def priority(level: int):
+    """Sätter prioritet för anrop från aktuell tråd (INTERACTIVE eller BACKGROUND)"""
+    previous = getattr(_context, "priority", INTERACTIVE)
+    _context.priority = level
+    try:
+        yield
+    finally:
+        _context.priority = previous
+
+
+def _retry_after(response: requests.Response) -> float:
+    """Sekunder att vänta enligt Retry-After (sekunder eller HTTP-datum)"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return DEFAULT_RETRY_AFTER
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+def request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Skickar ett anrop via värdens delade Session
+
+    Tar samma argument som requests.request. Timeout sätts till DEFAULT_TIMEOUT
+    om den inte anges, och antalet samtidiga anrop per värd begränsas. För
+    värdar i RATE_LIMITS väntar anropet på en token, och vid 429 pausas
+    värden enligt Retry-After innan anropet görs om.
+
+    Ett identiskt anrop som nyss gav 4xx/5xx får samma svar direkt, och mot
+    en endpoint vars kretsbrytare är öppen skickas inget anrop alls.
+
+    Raises:
+        CircuitOpenError: om brytaren är öppen eller anropet nyss gav timeout
+            eller anslutningsfel
+    """
+    kwargs.setdefault("timeout", DEFAULT_TIMEOUT)
+    host = _host(url)
+    endpoint = endpoint_of(url)
+    key = _request_key(method, url, kwargs)
+    remembered = _breakers.before(endpoint, key)
+    if remembered is not None:
+        return remembered
+
+    session = get_session(url)
+    level = getattr(_context, "priority", INTERACTIVE)
+    try:
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            _scheduler.acquire(host, level)
+            with _host_slot(host):
+                response = session.request(method, url, **kwargs)
+            if response.status_code != 429 or attempt == MAX_RATE_LIMIT_RETRIES:
+                break
+            wait = _retry_after(response)
+            print(f"⚠️ {host} begränsar anrop (429), väntar {wait:.0f} s")
+            _scheduler.pause(host, wait)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+        _breakers.record_error(endpoint, key, e)
+        raise
+    except BaseException:
+        _breakers.release(endpoint)
+        raise
+    _breakers.record_response(endpoint, key, response)
+    return response
+
+
+def conditional_headers(validators: Optional[Dict]) -> Dict[str, str]:
+    """
+    If-None-Match/If-Modified-Since för validerare från ett tidigare svar
+
+    Bara för GET: på POST betyder en matchande If-None-Match 412, inte 304.
+    """
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def response_validators(response: requests.Response) -> Dict[str, str]:
+    """ETag och Last-Modified ur ett svar (de som finns)"""
+    validators = {}
+    if response.headers.get("ETag"):
+        validators["etag"] = response.headers["ETag"]
+    if response.headers.get("Last-Modified"):
+        validators["last_modified"] = response.headers["Last-Modified"]
+    return validators
+
+
+def breaker_status() -> List[Dict]:
+    """Kretsbrytarnas tillstånd per endpoint som haft fel"""
+    return _breakers.snapshot()
+
+
+def negative_cache_size() -> int:
+    """Antal anrop som just nu besvaras ur den negativa cachen"""
+    return _breakers.negative_entries()
+
+
+def reset_breakers(endpoint: Optional[str] = None):
+    """Stänger en kretsbrytare (eller alla) och tömmer den negativa cachen"""
+    _breakers.reset(endpoint)
+
+
+def queue_depth() -> Dict[str, int]:
+    """Antal anrop som väntar på token per begränsad värd"""
+    return _scheduler.queue_depth()
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """GET via den delade transporten"""
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    """POST via den delade transporten"""
+    return request("POST", url, **kwargs)
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Delad trådpool för parallella anrop"""
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix=_WORKER_PREFIX)
+        return _executor
+
+
+def map_concurrent(func: Callable, items: Iterable) -> List:
+    """
+    Kör func för varje element parallellt och returnerar resultaten i ordning
+
+    Ett enda element, eller ett anrop inifrån trådpoolen (för att undvika att
+    poolen väntar på sig själv), körs direkt i anropande tråd. Undantag från
+    något anrop kastas vidare när resultaten samlas in.
+    """
+    items = list(items)
+    if len(items) <= 1 or threading.current_thread().name.startswith(_WORKER_PREFIX):
+        return [func(item) for item in items]
+    futures = [get_executor().submit(func, item) for item in items]
+    return [future.result() for future in futures]
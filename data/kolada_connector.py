@@ -3,14 +3,20 @@ Kolada API Connector - Hämtar kommunala nyckeltal från Kolada
 API Dokumentation: https://www.kolada.se/appspecific/rkalagret/api.html
 """
 
-import requests
 import pandas as pd
 import streamlit as st
 from typing import List, Dict, Optional
 import json
 import os
+import time
 from datetime import datetime, timedelta
 
+from data import cache_store, http_transport, revalidate, single_flight
+from data.cache_store import CacheEntry
+from data.kolada_store import PANEL_KEY, KoladaStore
+from data.kpi_index import KPIIndex
+from data.memo import LRUMemo
+
 class KoladaConnector:
     """
     Klass för att hämta data från Kolada API
@@ -20,6 +26,17 @@ class KoladaConnector:
     BASE_URL = "http://api.kolada.se/v2"
     CACHE_DIR = "cache"
     CACHE_DURATION_DAYS = 7  # Cache i 7 dagar
+    STORE_FILE = "kolada.sqlite"
+    
+    # Tolkade serier delas mellan alla sessioner i processen
+    _memo = LRUMemo(maxsize=1024)
+    MAX_URL_LENGTH = 2000  # Gräns för batchade anrop med kommaseparerade id:n
+    INCREMENTAL_REFRESH = True  # Uppdatera inaktuella serier med bara de senaste åren
+    STALE_WHILE_REVALIDATE = True  # Servera inaktuell data direkt och uppdatera i bakgrunden
+    STALE_RECHECK_SECONDS = 60  # Hur länge inaktuella serier hålls i minnescachen
+    CATALOG_DURATION_DAYS = 30  # KPI-katalogen ändras sällan
+    NATIONAL_PANEL_YEARS = 10  # Antal år som hämtas för rikspaneler
+    LIKNANDE_ANTAL = 10  # Antal kommuner i gruppen "liknande kommuner"
     
     # Kungsbacka kommun kod
     KUNGSBACKA_KOD = "1384"
@@ -194,6 +211,16 @@ class KoladaConnector:
         # Skapa cache-katalog om den inte finns
         if not os.path.exists(self.CACHE_DIR):
             os.makedirs(self.CACHE_DIR)
+        
+        # KPI-värden lagras i en SQLite-fil istället för en JSON-fil per par
+        self.store = KoladaStore(os.path.join(self.CACHE_DIR, self.STORE_FILE))
+        self.cache = cache_store.get_store(self.CACHE_DIR)
+        self._flight = single_flight.get_flight(self.CACHE_DIR, "kolada")
+        self.store.import_legacy_json(self.CACHE_DIR)
+        
+        # Sökindex över KPI-katalogen, byggs vid första sökningen
+        self._index = None
+        self._index_generation = -1
     
     def get_kommun_namn(self, kommun_kod: str) -> str:
         """
@@ -212,36 +239,19 @@ class KoladaConnector:
         """Genererar filsökväg för cache"""
         return os.path.join(self.CACHE_DIR, f"kolada_{cache_key}.json")
     
-    def _is_cache_valid(self, cache_path: str) -> bool:
-        """Kontrollerar om cache är giltig (inte för gammal)"""
-        if not os.path.exists(cache_path):
-            return False
-        
-        file_time = datetime.fromtimestamp(os.path.getmtime(cache_path))
-        age = datetime.now() - file_time
-        return age < timedelta(days=self.CACHE_DURATION_DAYS)
-    
-    def _load_from_cache(self, cache_key: str) -> Optional[Dict]:
-        """Laddar data från cache om den finns och är giltig"""
-        cache_path = self._get_cache_path(cache_key)
-        
-        if self._is_cache_valid(cache_path):
-            try:
-                with open(cache_path, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-            except Exception as e:
-                print(f"Cache-läsfel: {e}")
-                return None
-        return None
+    def _load_from_cache(self, cache_key: str, allow_stale: bool = False) -> Optional[CacheEntry]:
+        """Läser en post ur den gemensamma cachen om den är giltig (eller inaktuell, om allow_stale)"""
+        cached = self.cache.get(
+            "kolada", os.path.basename(self._get_cache_path(cache_key)),
+            max_age=self.CACHE_DURATION_DAYS * 86400
+        )
+        if cached is None or (cached.stale and not allow_stale):
+            return None
+        return cached
     
     def _save_to_cache(self, cache_key: str, data: Dict):
-        """Sparar data till cache"""
-        cache_path = self._get_cache_path(cache_key)
-        try:
-            with open(cache_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"Cache-skrivfel: {e}")
+        """Sparar data i den gemensamma cachen"""
+        self.cache.put("kolada", os.path.basename(self._get_cache_path(cache_key)), data)
     
     def get_kpi_metadata(self, kpi_id: str) -> Optional[Dict]:
         """
@@ -253,31 +263,393 @@ class KoladaConnector:
         Returns:
             Dict med KPI-information
         """
+        catalog_entry = self.store.catalog_entry(kpi_id)
+        if catalog_entry:
+            return catalog_entry
+        
         cache_key = f"kpi_meta_{kpi_id}"
-        cached = self._load_from_cache(cache_key)
-        if cached:
-            return cached
+        cached = self._load_from_cache(cache_key, allow_stale=self.STALE_WHILE_REVALIDATE)
+        if cached and cached.value:
+            if cached.stale:
+                revalidate.refresh_in_background(
+                    self._get_cache_path(cache_key), lambda: self._fetch_kpi_metadata(kpi_id)
+                )
+            return cached.value
         
         try:
-            response = requests.get(f"{self.BASE_URL}/kpi/{kpi_id}")
-            response.raise_for_status()
-            data = response.json()
-            
-            if data.get('values'):
-                kpi_info = data['values'][0]
-                self._save_to_cache(cache_key, kpi_info)
-                return kpi_info
+            return self._fetch_kpi_metadata(kpi_id)
         except Exception as e:
             st.error(f"Kunde inte hämta KPI-metadata: {e}")
         return None
     
-    def get_kpi_data(self, kpi_id: str, kommun_kod: str = None) -> pd.DataFrame:
+    def _fetch_kpi_metadata(self, kpi_id: str) -> Optional[Dict]:
+        """Hämtar metadata för en KPI från API:t och sparar den i cachen"""
+        response = http_transport.get(f"{self.BASE_URL}/kpi/{kpi_id}")
+        response.raise_for_status()
+        data = response.json()
+        
+        if data.get('values'):
+            kpi_info = data['values'][0]
+            self._save_to_cache(f"kpi_meta_{kpi_id}", kpi_info)
+            return kpi_info
+        return None
+    
+    def _parse_kpi_values(self, values: List[Dict]) -> List[tuple]:
+        """
+        Plattar ut ett Kolada-svar till rader i långt format
+        
+        Returns:
+            Lista med tupler (kpi, kommun, period, kön, värde) för alla kön
+        """
+        rows = []
+        for item in values:
+            # Period är på denna nivå, inte i values
+            period = int(item['period'])
+            for value_data in item['values']:
+                rows.append((
+                    item['kpi'],
+                    item['municipality'],
+                    period,
+                    value_data.get('gender', 'T'),
+                    value_data.get('value')
+                ))
+        return rows
+    
+    def _chunk_ids(self, ids: List[str], reserved: int) -> List[List[str]]:
+        """Delar upp id:n i grupper så att URL:en håller sig under MAX_URL_LENGTH"""
+        budget = self.MAX_URL_LENGTH - reserved
+        chunks, current, length = [], [], 0
+        for id_ in ids:
+            extra = len(id_) + (1 if current else 0)
+            if current and length + extra > budget:
+                chunks.append(current)
+                current, length = [], 0
+                extra = len(id_)
+            current.append(id_)
+            length += extra
+        if current:
+            chunks.append(current)
+        return chunks
+    
+    def _batch_urls(self, kpi_ids: List[str], kommun_koder: List[str],
+                    years: Optional[List[int]] = None) -> List[str]:
+        """
+        Bygger URL:er för alla kombinationer av KPI:er och kommuner
+        
+        Kolada v2 tar kommaseparerade listor i /data/kpi/{ids}/municipality/{ids}.
+        Listorna delas upp så att varje URL håller sig under MAX_URL_LENGTH.
+        
+        Args:
+            kpi_ids: KPI-ID:n
+            kommun_koder: Kommunkoder
+            years: Begränsa till dessa år via /year/{år} (default: alla år)
+        """
+        urls = []
+        suffix = f"/year/{','.join(str(y) for y in years)}" if years else ""
+        base = f"{self.BASE_URL}/data/kpi//municipality/{suffix}"
+        muni_chunks = self._chunk_ids(kommun_koder, len(base) + self.MAX_URL_LENGTH // 2)
+        
+        for muni_chunk in muni_chunks:
+            muni_part = ",".join(muni_chunk)
+            for kpi_chunk in self._chunk_ids(kpi_ids, len(base) + len(muni_part)):
+                urls.append(f"{self.BASE_URL}/data/kpi/{','.join(kpi_chunk)}/municipality/{muni_part}{suffix}")
+        return urls
+    
+    def _fetch_values(self, url: str) -> List[Dict]:
+        """Hämtar alla värden för en URL och följer next_page vid paginering"""
+        return self._fetch_values_conditional(url)[0]
+    
+    def _fetch_values_conditional(self, url: str, validators: Dict = None) -> tuple:
+        """
+        Som _fetch_values, men villkorligt med ETag/Last-Modified från förra svaret
+        
+        Bara första sidan frågas villkorligt; är den oförändrad antas hela svaret vara det.
+        
+        Returns:
+            (värden, validerare), där värdena är None om Kolada svarade 304
+        """
+        response = http_transport.get(url, headers=http_transport.conditional_headers(validators))
+        if response.status_code == 304:
+            return None, {**(validators or {}), **http_transport.response_validators(response)}
+        response.raise_for_status()
+        received = http_transport.response_validators(response)
+        
+        values = []
+        while True:
+            data = response.json()
+            values.extend(data.get('values', []))
+            url = data.get('next_page')
+            if not url:
+                return values, received
+            response = http_transport.get(url)
+            response.raise_for_status()
+    
+    def _ensure_series(self, kpi_ids: List[str], kommun_koder: List[str]):
+        """Ser till att alla kombinationer av kpi_ids och kommun_koder finns i lagret"""
+        self._ensure_pairs([(k, m) for m in dict.fromkeys(kommun_koder) for k in dict.fromkeys(kpi_ids)])
+    
+    def _ensure_pairs(self, pairs: List[tuple]):
+        """
+        Ser till att alla (kpi, kommun)-par finns i lagret och är färska
+        
+        Par som hämtats inom CACHE_DURATION_DAYS hoppas över. Med
+        STALE_WHILE_REVALIDATE serveras inaktuella serier som redan finns i
+        lagret direkt och uppdateras i bakgrunden, så att bara serier som
+        aldrig hämtats väntar på nätverket.
+        """
+        pairs = list(dict.fromkeys(pairs))
+        fresh = self.store.fresh_pairs(pairs, self.CACHE_DURATION_DAYS * 86400)
+        stale = [pair for pair in pairs if pair not in fresh]
+        if not stale:
+            return
+        
+        if self.STALE_WHILE_REVALIDATE:
+            stored = self.store.fetched_at(stale)
+            background = [pair for pair in stale if pair in stored]
+            stale = [pair for pair in stale if pair not in stored]
+            if background:
+                revalidate.refresh_many_in_background(
+                    background,
+                    lambda claimed: self._fetch_pairs_shared(claimed, report=lambda msg: print(f"⚠️ {msg}"))
+                )
+        
+        if stale:
+            self._fetch_pairs_shared(stale, report=st.error)
+    
+    def _fetch_pairs_shared(self, pairs: List[tuple], report):
+        """
+        Hämtar par med _fetch_pairs, sammanslaget med pågående hämtningar
+        
+        Par som en annan session redan hämtar väntas in istället för att
+        hämtas igen, och par som en annan arbetsprocess hunnit uppdatera
+        medan fillåset väntade hoppas över.
+        """
+        def still_stale(claimed):
+            fresh = self.store.fresh_pairs(claimed, self.CACHE_DURATION_DAYS * 86400)
+            return [pair for pair in claimed if pair not in fresh]
+        
+        self._flight.do_many(pairs, lambda claimed: self._fetch_pairs(claimed, report=report),
+                             recheck=still_stale)
+    
+    def _fetch_pairs(self, stale: List[tuple], report):
+        """
+        Hämtar (kpi, kommun)-par från API:t och skriver dem till lagret
+        
+        Serier som aldrig hämtats laddas ner i sin helhet. Inaktuella serier
+        uppdateras inkrementellt: bara perioder från och med seriens senaste
+        lagrade år (high water mark) hämtas via /year/{år}, eftersom äldre år
+        inte ändras. Senaste året hämtas om eftersom Kolada kan revidera
+        preliminära värden. Allt hämtas i så få anrop som möjligt och skrivs
+        till lagret i en transaktion per läge.
+        
+        Args:
+            stale: Par att hämta
+            report: Funktion som tar emot felmeddelanden (st.error eller print)
+        """
+        high_water = self.store.high_water(stale) if self.INCREMENTAL_REFRESH else {}
+        
+        # (första år eller None för hela serien) -> kommun -> KPI:er att hämta
+        missing = {}
+        for kpi_id, kommun_kod in stale:
+            from_year = high_water.get((kpi_id, kommun_kod))
+            missing.setdefault(from_year, {}).setdefault(kommun_kod, []).append(kpi_id)
+        
+        # Kommuner som saknar samma KPI:er kan hämtas i ett gemensamt anrop
+        current_year = datetime.now().year
+        jobs = []
+        for from_year, by_kommun in missing.items():
+            batches = {}
+            for kommun_kod, kpis in by_kommun.items():
+                batches.setdefault(tuple(sorted(kpis)), []).append(kommun_kod)
+            years = list(range(from_year, current_year + 1)) if from_year is not None else None
+            for kpis, kommuner in batches.items():
+                url_pairs = [(k, m) for m in kommuner for k in kpis]
+                urls = self._batch_urls(list(kpis), kommuner, years)
+                for url in urls:
+                    jobs.append((url, url_pairs, from_year, len(urls) == 1))
+        
+        # Anrop vars alla par redan finns i lagret frågas villkorligt, så att
+        # oförändrade svar (304 eller samma innehållshash) bara förlänger paren.
+        # Batchar som delats på flera URL:er hämtas alltid hela, eftersom
+        # paren då ersätts med raderna från alla URL:erna tillsammans.
+        stored = self.store.fetched_at(stale)
+        known = self.store.validators(job[0] for job in jobs)
+        
+        def fetch(job):
+            url, url_pairs, _, whole_batch = job
+            previous = known.get(url) if whole_batch and all(pair in stored for pair in url_pairs) else None
+            # Fel fångas här eftersom st.error inte kan anropas från trådpoolen
+            try:
+                values, received = self._fetch_values_conditional(url, previous)
+            except Exception as e:
+                return e
+            if values is not None:
+                received["digest"] = cache_store.content_digest(values)
+                if previous and previous.get("digest") == received["digest"]:
+                    values = None
+            return values, received
+        
+        full_pairs, full_rows = [], []
+        delta = {}  # första år -> (par, rader)
+        unchanged, validators = [], {}
+        for (url, url_pairs, from_year, _), outcome in zip(jobs, http_transport.map_concurrent(fetch, jobs)):
+            if isinstance(outcome, Exception):
+                report(f"Kunde inte hämta KPI-data: {outcome}")
+                continue
+            outcome, validators[url] = outcome
+            if outcome is None:
+                unchanged.extend(url_pairs)
+            elif from_year is None:
+                full_pairs.extend(url_pairs)
+                full_rows.extend(self._parse_kpi_values(outcome))
+            else:
+                delta_pairs, delta_rows = delta.setdefault(from_year, ([], []))
+                delta_pairs.extend(url_pairs)
+                delta_rows.extend(self._parse_kpi_values(outcome))
+        
+        if full_pairs:
+            self.store.replace_series(full_pairs, full_rows)
+        for from_year, (delta_pairs, delta_rows) in delta.items():
+            self.store.merge_series(delta_pairs, delta_rows, from_year)
+        if unchanged:
+            self.store.touch_series(unchanged)
+        if validators:
+            self.store.save_validators(validators)
+    
+    def _get_series_frames(self, kpi_ids: List[str], kommun_koder: List[str],
+                           gender: str = 'T') -> Dict[tuple, pd.DataFrame]:
+        """Returnerar en DataFrame per kombination av kpi_ids och kommun_koder"""
+        return self._get_pair_frames(
+            [(k, m) for m in dict.fromkeys(kommun_koder) for k in dict.fromkeys(kpi_ids)], gender
+        )
+    
+    def _get_pair_frames(self, pairs: List[tuple], gender: str = 'T') -> Dict[tuple, pd.DataFrame]:
+        """
+        Returnerar en DataFrame per (kpi, kommun), via minnescachen när det går
+        
+        Poster i minnescachen gäller så länge seriens version i lagret är
+        oförändrad och TTL:en inte passerats, så varma omkörningar gör bara
+        en versionsfråga mot lagret istället för att läsa värdena. Versionen
+        räknas upp vid varje skrivning, även i andra processer.
+        
+        Missar hämtas och läses från lagret i en gemensam omgång.
+        Alla kön lagras från samma nedladdning, så gender är bara ett urval.
+        """
+        pairs = list(dict.fromkeys(pairs))
+        frames = {}
+        misses = []
+        versions = self.store.generations(pairs)
+        for pair in pairs:
+            df = self._memo.get((*pair, gender), versions[pair])
+            if df is not None:
+                frames[pair] = df
+            else:
+                misses.append(pair)
+        
+        if not misses:
+            return frames
+        
+        miss_kpis = list(dict.fromkeys(p[0] for p in misses))
+        miss_kommuner = list(dict.fromkeys(p[1] for p in misses))
+        self._ensure_pairs(misses)
+        
+        # Versionen läses före värdena, så att en samtidig skrivning ger en
+        # för gammal version (ny läsning nästa gång) och aldrig tvärtom
+        versions = self.store.generations(misses)
+        df = self.store.query(miss_kpis, miss_kommuner, gender)
+        groups = {key: group.reset_index(drop=True) for key, group in df.groupby(['kpi', 'kommun'], sort=False)}
+        fetched_at = self.store.fetched_at(misses)
+        ttl = self.CACHE_DURATION_DAYS * 86400
+        # Inaktuella serier hålls kort i minnet; bakgrundsuppdateringen
+        # ogiltigförklarar dem ändå genom att räkna upp versionen
+        stale_until = time.time() + self.STALE_RECHECK_SECONDS if self.STALE_WHILE_REVALIDATE else 0
+        
+        for pair in misses:
+            frame = groups.get(pair, df.iloc[0:0])
+            frames[pair] = frame
+            if pair in fetched_at:
+                expires_at = max(fetched_at[pair] + ttl, stale_until)
+                self._memo.put((*pair, gender), versions[pair], frame, expires_at)
+        
+        return frames
+    
+    def prefetch(self, manifest: List[Dict]) -> int:
+        """
+        Hämtar alla serier som en sida behöver i en gemensam omgång
+        
+        Manifestet är en lista med grupper {"kpis": [...], "kommuner": [...]};
+        utelämnas kommuner används Kungsbacka. Alla par slås ihop och saknade
+        serier hämtas batchat och parallellt, så att sidans efterföljande
+        anrop (get_latest_value, get_trend_data, compare_municipalities)
+        besvaras från minnescachen.
+        
+        Args:
+            manifest: Lista med KPI-grupper och kommuner
+            
+        Returns:
+            Antal (kpi, kommun)-par som har data
+        """
+        pairs = [
+            (kpi_id, kommun_kod)
+            for group in manifest
+            for kommun_kod in group.get("kommuner", [self.KUNGSBACKA_KOD])
+            for kpi_id in group["kpis"]
+        ]
+        frames = self._get_pair_frames(pairs)
+        return sum(1 for df in frames.values() if not df.empty)
+    
+    def data_age(self, kpi_id: str, kommun_kod: str = None) -> Optional[Dict]:
+        """
+        Hur gammal en lagrad serie är
+        
+        Returns:
+            Dict med fetched_at, age_seconds, stale och refreshing, eller None
+            om serien aldrig hämtats
+        """
+        if kommun_kod is None:
+            kommun_kod = self.KUNGSBACKA_KOD
+        
+        pair = (kpi_id, kommun_kod)
+        fetched_at = self.store.fetched_at([pair]).get(pair)
+        if fetched_at is None:
+            return None
+        
+        age = time.time() - fetched_at
+        return {
+            'fetched_at': fetched_at,
+            'age_seconds': age,
+            'stale': age >= self.CACHE_DURATION_DAYS * 86400,
+            'refreshing': revalidate.is_refreshing(pair),
+        }
+    
+    def memo_stats(self) -> Dict:
+        """Träffar och missar i minnescachen för KPI-serier"""
+        return self._memo.stats()
+    
+    def get_kpi_data_batch(self, kpi_ids: List[str], kommun_koder: List[str],
+                           gender: str = 'T') -> Dict[tuple, pd.DataFrame]:
+        """
+        Hämtar KPI-data för alla kombinationer av KPI:er och kommuner
+        
+        Args:
+            kpi_ids: Lista med KPI-ID:n
+            kommun_koder: Lista med kommunkoder
+            gender: Kön (T = totalt, K = kvinnor, M = män)
+        
+        Returns:
+            Dict med (kpi, kommun) som nyckel och DataFrame som värde
+        """
+        frames = self._get_series_frames(kpi_ids, kommun_koder, gender)
+        return {pair: df.copy() for pair, df in frames.items() if not df.empty}
+    
+    def get_kpi_data(self, kpi_id: str, kommun_kod: str = None, gender: str = 'T') -> pd.DataFrame:
         """
         Hämtar KPI-data för en eller flera kommuner
         
         Args:
             kpi_id: KPI-ID (t.ex. "N01951")
             kommun_kod: Kommunkod (default: Kungsbacka)
+            gender: Kön (T = totalt, K = kvinnor, M = män)
         
         Returns:
             DataFrame med KPI-data
@@ -285,44 +657,36 @@ class KoladaConnector:
         if kommun_kod is None:
             kommun_kod = self.KUNGSBACKA_KOD
         
-        cache_key = f"kpi_data_{kpi_id}_{kommun_kod}"
-        cached = self._load_from_cache(cache_key)
-        if cached:
-            return pd.DataFrame(cached)
+        frames = self._get_series_frames([kpi_id], [kommun_kod], gender)
+        return frames[(kpi_id, kommun_kod)].copy()
+    
+    def get_kpi_data_by_gender(self, kpi_id: str, kommun_kod: str = None) -> pd.DataFrame:
+        """
+        Hämtar KPI-data uppdelat på kön
         
-        try:
-            url = f"{self.BASE_URL}/data/kpi/{kpi_id}/municipality/{kommun_kod}"
-            response = requests.get(url)
-            response.raise_for_status()
-            data = response.json()
-            
-            if data.get('values'):
-                # Skapa DataFrame
-                rows = []
-                for item in data['values']:
-                    # Period är på denna nivå, inte i values
-                    period = item['period']
-                    
-                    # Hitta värdet för totalt (gender = "T")
-                    for value_data in item['values']:
-                        if value_data.get('gender') == 'T':  # T = Total
-                            rows.append({
-                                'kpi': item['kpi'],
-                                'kommun': item['municipality'],
-                                'år': period,
-                                'värde': value_data['value']
-                            })
-                            break  # Vi vill bara totalen
-                
-                df = pd.DataFrame(rows)
-                
-                # Spara till cache
-                self._save_to_cache(cache_key, df.to_dict('records'))
-                return df
-        except Exception as e:
-            st.error(f"Kunde inte hämta KPI-data: {e}")
+        Alla kön kommer från samma lagrade nedladdning, så inga extra anrop görs.
         
-        return pd.DataFrame()
+        Args:
+            kpi_id: KPI-ID
+            kommun_kod: Kommunkod (default: Kungsbacka)
+        
+        Returns:
+            DataFrame med år som index och kolumnerna T, K och M (de som finns),
+            tom om KPI:n saknar data
+        """
+        if kommun_kod is None:
+            kommun_kod = self.KUNGSBACKA_KOD
+        
+        # Första anropet hämtar serien, övriga kön läses sedan ur lagret
+        columns = {}
+        for gender in ['T', 'K', 'M']:
+            df = self._get_series_frames([kpi_id], [kommun_kod], gender)[(kpi_id, kommun_kod)]
+            if not df.empty:
+                columns[gender] = df.set_index('år')['värde']
+        
+        if not columns:
+            return pd.DataFrame()
+        return pd.DataFrame(columns).sort_index()
     
     def get_multiple_kpis(self, kpi_ids: List[str], kommun_kod: str = None) -> Dict[str, pd.DataFrame]:
         """
@@ -335,14 +699,19 @@ class KoladaConnector:
         Returns:
             Dict med KPI-ID som nyckel och DataFrame som värde
         """
+        if kommun_kod is None:
+            kommun_kod = self.KUNGSBACKA_KOD
+        
+        batch = self.get_kpi_data_batch(kpi_ids, [kommun_kod])
         result = {}
         for kpi_id in kpi_ids:
-            df = self.get_kpi_data(kpi_id, kommun_kod)
-            if not df.empty:
+            df = batch.get((kpi_id, kommun_kod))
+            if df is not None and not df.empty:
                 result[kpi_id] = df
         return result
     
-    def compare_municipalities(self, kpi_id: str, kommun_koder: List[str] = None, year: str = None) -> pd.DataFrame:
+    def compare_municipalities(self, kpi_id: str, kommun_koder: List[str] = None, year: str = None,
+                               gender: str = 'T') -> pd.DataFrame:
         """
         Jämför en KPI mellan flera kommuner
         
@@ -350,6 +719,7 @@ class KoladaConnector:
             kpi_id: KPI-ID
             kommun_koder: Lista med kommunkoder (default: jämförelsekommuner)
             year: Årtal (default: senaste tillgängliga)
+            gender: Kön (T = totalt, K = kvinnor, M = män)
         
         Returns:
             DataFrame med jämförelsedata
@@ -357,15 +727,8 @@ class KoladaConnector:
         if kommun_koder is None:
             kommun_koder = list(self.JAMFORELSE_KOMMUNER.keys())
         
-        all_data = []
-        
-        for kod in kommun_koder:
-            df = self.get_kpi_data(kpi_id, kod)
-            if not df.empty:
-                # Lägg till kommunnamn (använd ny funktion som söker i alla listor)
-                df['kommun_namn'] = self.get_kommun_namn(kod)
-                all_data.append(df)
-        
+        frames = self._get_series_frames([kpi_id], kommun_koder, gender)
+        all_data = [df for df in frames.values() if not df.empty]
         if not all_data:
             return pd.DataFrame()
         
@@ -373,37 +736,42 @@ class KoladaConnector:
         
         # Filtrera på år om specificerat
         if year:
-            combined = combined[combined['år'] == year]
+            combined = combined[combined['år'] == int(year)]
         else:
             # Ta senaste året för varje kommun
             latest_year = combined['år'].max()
             combined = combined[combined['år'] == latest_year]
         
+        # Lägg till kommunnamn (använd ny funktion som söker i alla listor)
+        combined = combined.reset_index(drop=True)
+        combined['kommun_namn'] = combined['kommun'].map(self.get_kommun_namn)
         return combined
     
-    def get_latest_value(self, kpi_id: str, kommun_kod: str = None) -> Optional[Dict]:
+    def get_latest_value(self, kpi_id: str, kommun_kod: str = None, gender: str = 'T') -> Optional[Dict]:
         """
         Hämtar senaste värdet för en KPI
         
         Args:
             kpi_id: KPI-ID
             kommun_kod: Kommunkod (default: Kungsbacka)
+            gender: Kön (T = totalt, K = kvinnor, M = män)
         
         Returns:
             Dict med senaste värdet och årtal
         """
-        df = self.get_kpi_data(kpi_id, kommun_kod)
+        df = self.get_kpi_data(kpi_id, kommun_kod, gender)
         if df.empty:
             return None
         
-        latest = df.nlargest(1, 'år').iloc[0]
+        latest = df.loc[df['år'].idxmax()]
         return {
             'värde': latest['värde'],
             'år': latest['år'],
             'kpi': latest['kpi']
         }
     
-    def get_trend_data(self, kpi_id: str, kommun_kod: str = None, years: int = 10) -> pd.DataFrame:
+    def get_trend_data(self, kpi_id: str, kommun_kod: str = None, years: int = 10,
+                       gender: str = 'T') -> pd.DataFrame:
         """
         Hämtar trenddata för de senaste X åren
         
@@ -411,11 +779,12 @@ class KoladaConnector:
             kpi_id: KPI-ID
             kommun_kod: Kommunkod (default: Kungsbacka)
             years: Antal år bakåt
+            gender: Kön (T = totalt, K = kvinnor, M = män)
         
         Returns:
             DataFrame med trenddata
         """
-        df = self.get_kpi_data(kpi_id, kommun_kod)
+        df = self.get_kpi_data(kpi_id, kommun_kod, gender)
         if df.empty:
             return pd.DataFrame()
         
@@ -432,7 +801,7 @@ class KoladaConnector:
             DataFrame med alla kommuner
         """
         try:
-            response = requests.get(f"{_self.BASE_URL}/municipality")
+            response = http_transport.get(f"{_self.BASE_URL}/municipality")
             response.raise_for_status()
             data = response.json()
             
@@ -443,6 +812,186 @@ class KoladaConnector:
         
         return pd.DataFrame()
     
+    # === RIKSJÄMFÖRELSE ===
+    
+    @staticmethod
+    def _is_kommun(kod: str) -> bool:
+        """Kommunkoder har fyra siffror; riket och regioner börjar med 00"""
+        return len(kod) == 4 and kod.isdigit() and not kod.startswith("00")
+    
+    def _panel_from_year(self) -> int:
+        return datetime.now().year - self.NATIONAL_PANEL_YEARS + 1
+    
+    def _fetch_panel(self, kpi_id: str, from_year: int):
+        """Hämtar en KPI för alla kommuner och år från from_year i ett anrop"""
+        years = ",".join(str(y) for y in range(from_year, datetime.now().year + 1))
+        values = self._fetch_values(f"{self.BASE_URL}/data/kpi/{kpi_id}/year/{years}")
+        rows = [row for row in self._parse_kpi_values(values) if self._is_kommun(row[1])]
+        pairs = list(dict.fromkeys((row[0], row[1]) for row in rows))
+        self.store.merge_series(pairs, rows, from_year)
+        self.store.mark_panel(kpi_id, from_year)
+    
+    def _ensure_panel(self, kpi_id: str):
+        """Ser till att KPI:ns rikspanel finns i lagret (inaktuell panel uppdateras i bakgrunden)"""
+        from_year = self._panel_from_year()
+        state = self.store.panel_state(kpi_id)
+        if state is not None and state[0] <= from_year:
+            if time.time() - state[1] < self.CACHE_DURATION_DAYS * 86400:
+                return
+            if self.STALE_WHILE_REVALIDATE:
+                revalidate.refresh_in_background(
+                    (kpi_id, PANEL_KEY), lambda: self._fetch_panel(kpi_id, from_year)
+                )
+                return
+        self._fetch_panel(kpi_id, from_year)
+    
+    def _get_panel_frame(self, kpi_id: str) -> pd.DataFrame:
+        """Alla kommuners värden för en KPI (långt format), via minnescachen"""
+        key = (kpi_id, PANEL_KEY)
+        df = self._memo.get(key, self.store.generation(*key))
+        if df is not None:
+            return df
+        
+        self._ensure_panel(kpi_id)
+        version = self.store.generation(*key)
+        df = self.store.query([kpi_id], None)
+        df = df[(df['år'] >= self._panel_from_year()) & df['kommun'].map(self._is_kommun)].reset_index(drop=True)
+        
+        state = self.store.panel_state(kpi_id)
+        if state is not None:
+            expires_at = state[1] + self.CACHE_DURATION_DAYS * 86400
+            if self.STALE_WHILE_REVALIDATE:
+                expires_at = max(expires_at, time.time() + self.STALE_RECHECK_SECONDS)
+            self._memo.put(key, version, df, expires_at)
+        return df
+    
+    def _kommun_namn_map(self) -> Dict[str, str]:
+        """Kommunnamn för alla kommuner (från Kolada, med de inbyggda listorna som reserv)"""
+        municipalities = self.get_all_municipalities()
+        if not municipalities.empty and {'id', 'title'} <= set(municipalities.columns):
+            return dict(zip(municipalities['id'], municipalities['title']))
+        return {}
+    
+    def get_national_panel(self, kpi_id: str, year: str = None, higher_is_better: bool = True) -> pd.DataFrame:
+        """
+        Hämtar en KPI för alla Sveriges kommuner med rangordning
+        
+        Hela panelen (alla kommuner, NATIONAL_PANEL_YEARS år) hämtas i ett
+        anrop via /data/kpi/{id}/year/{år} och lagras lokalt.
+        
+        Args:
+            kpi_id: KPI-ID
+            year: Årtal (default: senaste år med data för minst hälften av kommunerna)
+            higher_is_better: False för KPI:er där lägre värde är bättre (t.ex. arbetslöshet)
+        
+        Returns:
+            DataFrame med kommun, kommun_namn, år, värde, rank (1 = bäst) och
+            percentil (andel kommuner med samma eller sämre värde, %)
+        """
+        try:
+            df = self._get_panel_frame(kpi_id)
+        except Exception as e:
+            st.error(f"Kunde inte hämta riksdata: {e}")
+            return pd.DataFrame()
+        
+        df = df.dropna(subset=['värde'])
+        if df.empty:
+            return pd.DataFrame()
+        
+        if year:
+            df = df[df['år'] == int(year)]
+        else:
+            counts = df.groupby('år').size()
+            df = df[df['år'] == counts[counts >= counts.max() / 2].index.max()]
+        
+        df = df.reset_index(drop=True)
+        df['rank'] = df['värde'].rank(ascending=not higher_is_better, method='min').astype(int)
+        df['percentil'] = df['värde'].rank(ascending=higher_is_better, pct=True) * 100
+        
+        names = self._kommun_namn_map()
+        df['kommun_namn'] = df['kommun'].map(lambda kod: names.get(kod) or self.get_kommun_namn(kod))
+        return df.sort_values('rank').reset_index(drop=True)
+    
+    def get_similar_municipalities(self, kommun_kod: str = None, antal: int = None) -> List[str]:
+        """
+        Kommuner med mest lika folkmängd (N01951), närmast först
+        
+        Args:
+            kommun_kod: Kommunkod (default: Kungsbacka)
+            antal: Antal kommuner (default: LIKNANDE_ANTAL)
+        """
+        if kommun_kod is None:
+            kommun_kod = self.KUNGSBACKA_KOD
+        if antal is None:
+            antal = self.LIKNANDE_ANTAL
+        
+        panel = self.get_national_panel("N01951")
+        if panel.empty or kommun_kod not in set(panel['kommun']):
+            return []
+        
+        population = panel.set_index('kommun')['värde']
+        distance = (population - population[kommun_kod]).abs().drop(kommun_kod)
+        return list(distance.nsmallest(antal).index)
+    
+    def get_group_medians(self, kpi_id: str, year: str = None, kommun_kod: str = None) -> Dict[str, float]:
+        """
+        Medianvärden för riket, Halland, Göteborgsregionen och liknande kommuner
+        
+        Args:
+            kpi_id: KPI-ID
+            year: Årtal (default: samma som get_national_panel)
+            kommun_kod: Kommun som "liknande kommuner" utgår från (default: Kungsbacka)
+        
+        Returns:
+            Dict med gruppnamn -> median
+        """
+        panel = self.get_national_panel(kpi_id, year)
+        if panel.empty:
+            return {}
+        
+        values = panel.set_index('kommun')['värde']
+        groups = {
+            'Riket': list(values.index),
+            'Halland': list(self.HALLAND_KOMMUNER.keys()),
+            'Göteborgsregionen': list(self.GOTEBORGSREGIONEN_KOMMUNER.keys()),
+            'Liknande kommuner': self.get_similar_municipalities(kommun_kod),
+        }
+        
+        medians = {}
+        for name, koder in groups.items():
+            group_values = values.reindex(koder).dropna()
+            if not group_values.empty:
+                medians[name] = float(group_values.median())
+        return medians
+    
+    def get_national_position(self, kpi_id: str, kommun_kod: str = None, year: str = None,
+                              higher_is_better: bool = True) -> Optional[Dict]:
+        """
+        En kommuns placering bland alla Sveriges kommuner
+        
+        Returns:
+            Dict med värde, år, rank, antal, percentil och gruppmedianer
+        """
+        if kommun_kod is None:
+            kommun_kod = self.KUNGSBACKA_KOD
+        
+        panel = self.get_national_panel(kpi_id, year, higher_is_better)
+        row = panel[panel['kommun'] == kommun_kod]
+        if row.empty:
+            return None
+        
+        row = row.iloc[0]
+        return {
+            'kpi': kpi_id,
+            'kommun': kommun_kod,
+            'värde': row['värde'],
+            'år': row['år'],
+            'rank': int(row['rank']),
+            'antal': len(panel),
+            'percentil': float(row['percentil']),
+            'medianer': self.get_group_medians(kpi_id, row['år'], kommun_kod),
+        }
+    
     # === ARBETSMARKNAD FUNKTIONER ===
     
     def get_arbetsmarknad_data(self, kommun_kod: str = None) -> Dict[str, pd.DataFrame]:
@@ -589,19 +1138,9 @@ class KoladaConnector:
     
     # === SMART SÖKNING ===
     
-    def search_kpi_by_keywords(self, keywords: List[str]) -> List[Dict]:
-        """
-        Söker efter KPI:er baserat på nyckelord
-        
-        Args:
-            keywords: Lista med sökord (t.ex. ["skola", "betyg"])
-        
-        Returns:
-            Lista med matchande KPI:er med ID, titel och beskrivning
-        """
+    def _curated_kpis(self) -> Dict[str, str]:
+        """Alla KPI:er från de handplockade kategorierna"""
         all_kpis = {}
-        
-        # Samla alla KPI:er från alla kategorier
         for category_dict in [
             self.VIKTIGA_KPIER,
             self.ARBETSMARKNAD_KPIER,
@@ -614,25 +1153,72 @@ class KoladaConnector:
             self.SOCIAL_KPIER
         ]:
             all_kpis.update(category_dict)
+        return all_kpis
+    
+    def _fetch_catalog(self) -> int:
+        """Hämtar hela KPI-katalogen från /v2/kpi och uppdaterar lagret"""
+        entries = self._fetch_values(f"{self.BASE_URL}/kpi")
+        if not entries:
+            raise ValueError("Tom KPI-katalog från Kolada")
+        changed = self.store.upsert_catalog(entries)
+        print(f"🔄 Kolada KPI-katalog uppdaterad: {len(entries)} KPI:er, {changed} ändrade")
+        return changed
+    
+    def ensure_catalog(self) -> bool:
+        """
+        Ser till att KPI-katalogen finns lokalt
         
-        # Sök efter matchningar
-        matches = []
-        keywords_lower = [k.lower() for k in keywords]
+        Första gången hämtas katalogen direkt. Därefter serveras den lagrade
+        katalogen och uppdateras i bakgrunden när CATALOG_DURATION_DAYS passerats.
         
-        for kpi_id, kpi_title in all_kpis.items():
-            kpi_title_lower = kpi_title.lower()
-            
-            # Om något nyckelord finns i titeln
-            for keyword in keywords_lower:
-                if keyword in kpi_title_lower:
-                    matches.append({
-                        'id': kpi_id,
-                        'title': kpi_title,
-                        'keyword_match': keyword
-                    })
-                    break
-        
-        return matches
+        Returns:
+            True om en katalog finns i lagret
+        """
+        fetched_at = self.store.catalog_fetched_at()
+        if fetched_at is None:
+            try:
+                self._fetch_catalog()
+                return True
+            except Exception as e:
+                print(f"⚠️ Kunde inte hämta KPI-katalogen: {e}")
+                return False
+        
+        if time.time() - fetched_at > self.CATALOG_DURATION_DAYS * 86400:
+            revalidate.refresh_in_background("kolada_kpi_catalog", self._fetch_catalog)
+        return True
+    
+    def _catalog_index(self) -> Optional[KPIIndex]:
+        """Sökindex över katalogen, byggs om när katalogen ändrats"""
+        if not self.ensure_catalog():
+            return None
+        
+        generation = self.store.catalog_generation()
+        if self._index is None or self._index_generation != generation:
+            self._index = KPIIndex(self.store.catalog_entries())
+            self._index_generation = generation
+        return self._index
+    
+    def search_kpi_by_keywords(self, keywords: List[str], limit: int = 50) -> List[Dict]:
+        """
+        Söker efter KPI:er baserat på nyckelord
+        
+        Söker i hela Kolada-katalogen (titel och beskrivning) med
+        prefixmatchning och rankning. Handplockade KPI:er rankas först vid
+        lika relevans. Saknas katalogen söks bara de handplockade KPI:erna.
+        
+        Args:
+            keywords: Lista med sökord (t.ex. ["skola", "betyg"])
+            limit: Max antal träffar
+        
+        Returns:
+            Lista med matchande KPI:er med ID, titel och beskrivning
+        """
+        curated = self._curated_kpis()
+        index = self._catalog_index()
+        if index is None or not len(index):
+            index = KPIIndex({'id': kpi_id, 'title': title} for kpi_id, title in curated.items())
+        
+        return index.search(keywords, limit=limit, boost=set(curated))
     
     def get_relevant_kpis_for_question(self, question: str) -> List[Dict]:
         """
@@ -662,16 +1248,21 @@ class KoladaConnector:
         import re
         relevant_kpis = []
         
+        matched = [kpi_ids[:5] for pattern, kpi_ids in keyword_map.items()  # Max 5 per kategori
+                   if re.search(pattern, question_lower)]
+        
+        # Hämta alla matchade KPI:er i ett batchat anrop innan värdena läses ut
+        self.get_kpi_data_batch([k for kpi_ids in matched for k in kpi_ids], [self.KUNGSBACKA_KOD])
+        
         # Hitta matchande KPI:er
-        for pattern, kpi_ids in keyword_map.items():
-            if re.search(pattern, question_lower):
-                for kpi_id in kpi_ids[:5]:  # Max 5 per kategori
-                    try:
-                        value = self.get_latest_value(kpi_id)
-                        if value:
-                            relevant_kpis.append(value)
-                    except:
-                        pass
+        for kpi_ids in matched:
+            for kpi_id in kpi_ids:
+                try:
+                    value = self.get_latest_value(kpi_id)
+                    if value:
+                        relevant_kpis.append(value)
+                except:
+                    pass
         
         return relevant_kpis
 
@@ -0,0 +1,489 @@
+"""
+Lokalt KPI-lager för Kolada-data
+
+Ersätter en JSON-fil per (KPI, kommun) med en enda SQLite-fil i cache-katalogen.
+Värdena lagras i långt format (kpi, kommun, period, kön, värde) med typade
+kolumner och primärnyckel på (kpi, municipality, period, gender), så att
+uppslag, trendserier och kommunjämförelser blir en SQL-fråga istället för att
+öppna och tolka många filer vid varje omkörning.
+
+Lagret håller också hela KPI-katalogen från /v2/kpi, så att metadata och
+sökning inte kräver nätverksanrop.
+"""
+
+import glob
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import pandas as pd
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kpi_values (
+    kpi TEXT NOT NULL,
+    municipality TEXT NOT NULL,
+    period INTEGER NOT NULL,
+    gender TEXT NOT NULL,
+    value REAL,
+    PRIMARY KEY (kpi, municipality, period, gender)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS series (
+    kpi TEXT NOT NULL,
+    municipality TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    high_water INTEGER,
+    version INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (kpi, municipality)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS idx_kpi_values_period ON kpi_values (kpi, period);
+
+CREATE TABLE IF NOT EXISTS panels (
+    kpi TEXT PRIMARY KEY,
+    from_period INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS kpi_catalog (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    description TEXT,
+    metadata TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS catalog_state (
+    name TEXT PRIMARY KEY,
+    fetched_at REAL NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS url_validators (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    digest TEXT
+) WITHOUT ROWID;
+"""
+
+
+# Kommunkod för versionen av en KPI:s rikspanel (alla kommuner)
+PANEL_KEY = "*"
+
+
+class KoladaStore:
+    """SQLite-baserat lager för Kolada-värden i långt format"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+            self._migrate(conn)
+
+    def _migrate(self, conn: sqlite3.Connection):
+        """Lägger till kolumner som saknas i lager skapade av äldre versioner"""
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(series)")}
+        if 'high_water' not in columns:
+            conn.execute("ALTER TABLE series ADD COLUMN high_water INTEGER")
+            conn.execute(
+                "UPDATE series SET high_water = ("
+                "SELECT MAX(period) FROM kpi_values v "
+                "WHERE v.kpi = series.kpi AND v.municipality = series.municipality)"
+            )
+        # Seriens version räknas upp i samma transaktion som värdena skrivs, så
+        # att minnescachade kopior i alla processer ser ändringen
+        if 'version' not in columns:
+            conn.execute("ALTER TABLE series ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        panel_columns = {row[1] for row in conn.execute("PRAGMA table_info(panels)")}
+        if 'version' not in panel_columns:
+            conn.execute("ALTER TABLE panels ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        catalog_columns = {row[1] for row in conn.execute("PRAGMA table_info(catalog_state)")}
+        if 'version' not in catalog_columns:
+            conn.execute("ALTER TABLE catalog_state ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+
+    def _connect(self) -> sqlite3.Connection:
+        """En anslutning per tråd (sqlite3-anslutningar får inte delas mellan trådar)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def fresh_pairs(self, pairs: Iterable[Tuple[str, str]], max_age_seconds: float) -> Set[Tuple[str, str]]:
+        """Returnerar de (kpi, kommun)-par som hämtats inom max_age_seconds"""
+        pairs = list(pairs)
+        if not pairs:
+            return set()
+
+        cutoff = time.time() - max_age_seconds
+        kpis = sorted({p[0] for p in pairs})
+        kommuner = sorted({p[1] for p in pairs})
+        sql = (
+            f"SELECT kpi, municipality FROM series "
+            f"WHERE kpi IN ({','.join('?' * len(kpis))}) "
+            f"AND municipality IN ({','.join('?' * len(kommuner))}) "
+            f"AND fetched_at >= ?"
+        )
+        rows = self._connect().execute(sql, [*kpis, *kommuner, cutoff]).fetchall()
+        return set(rows) & set(pairs)
+
+    def replace_series(self, pairs: Iterable[Tuple[str, str]], rows: Iterable[Tuple],
+                       fetched_at: Optional[float] = None):
+        """
+        Ersätter alla värden för de angivna (kpi, kommun)-paren
+
+        Args:
+            pairs: Par som hämtats (även de som saknade data, så att de inte hämtas om direkt)
+            rows: Tupler (kpi, kommun, period, kön, värde)
+            fetched_at: Hämtningstid (default: nu)
+        """
+        pairs = list(pairs)
+        rows = list(rows)
+        if fetched_at is None:
+            fetched_at = time.time()
+
+        high_water = self._max_periods(rows)
+        with self._write_lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    "DELETE FROM kpi_values WHERE kpi = ? AND municipality = ?", pairs
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO kpi_values (kpi, municipality, period, gender, value) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    rows
+                )
+                conn.executemany(
+                    "INSERT INTO series (kpi, municipality, fetched_at, high_water) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT (kpi, municipality) DO UPDATE SET fetched_at = excluded.fetched_at, "
+                    "high_water = excluded.high_water, version = series.version + 1",
+                    [(kpi, kommun, fetched_at, high_water.get((kpi, kommun))) for kpi, kommun in pairs]
+                )
+
+    def merge_series(self, pairs: Iterable[Tuple[str, str]], rows: Iterable[Tuple],
+                     from_period: int, fetched_at: Optional[float] = None):
+        """
+        Slår in nyare perioder i befintliga serier (inkrementell uppdatering)
+
+        Värden från och med from_period ersätts med rows, äldre perioder
+        lämnas orörda. Seriernas high water mark flyttas fram om nya perioder
+        tillkommit.
+
+        Args:
+            pairs: Par som uppdaterats
+            rows: Tupler (kpi, kommun, period, kön, värde) för perioder >= from_period
+            from_period: Första perioden som hämtades
+            fetched_at: Hämtningstid (default: nu)
+        """
+        pairs = list(pairs)
+        rows = list(rows)
+        if fetched_at is None:
+            fetched_at = time.time()
+
+        high_water = self._max_periods(rows)
+        with self._write_lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    "DELETE FROM kpi_values WHERE kpi = ? AND municipality = ? AND period >= ?",
+                    [(kpi, kommun, int(from_period)) for kpi, kommun in pairs]
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO kpi_values (kpi, municipality, period, gender, value) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    rows
+                )
+                conn.executemany(
+                    "UPDATE series SET fetched_at = ?, high_water = MAX(high_water, ?), version = version + 1 "
+                    "WHERE kpi = ? AND municipality = ?",
+                    [(fetched_at, high_water.get(pair, from_period - 1), *pair) for pair in pairs]
+                )
+
+    @staticmethod
+    def _max_periods(rows: List[Tuple]) -> Dict[Tuple[str, str], int]:
+        """Senaste period per (kpi, kommun) bland rader"""
+        latest: Dict[Tuple[str, str], int] = {}
+        for kpi, kommun, period, _, _ in rows:
+            pair = (kpi, kommun)
+            if pair not in latest or period > latest[pair]:
+                latest[pair] = period
+        return latest
+
+    def _clear_high_water(self, pairs: List[Tuple[str, str]]):
+        """Tvingar fram en fullständig nedladdning vid nästa uppdatering"""
+        with self._write_lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    "UPDATE series SET high_water = NULL WHERE kpi = ? AND municipality = ?", pairs
+                )
+
+    def touch_series(self, pairs: Iterable[Tuple[str, str]], fetched_at: Optional[float] = None):
+        """Markerar serier som färska utan att ändra värdena (oförändrat svar vid uppdatering)"""
+        pairs = list(pairs)
+        if fetched_at is None:
+            fetched_at = time.time()
+        with self._write_lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    "UPDATE series SET fetched_at = ? WHERE kpi = ? AND municipality = ?",
+                    [(fetched_at, *pair) for pair in pairs]
+                )
+
+    def validators(self, urls: Iterable[str]) -> Dict[str, Dict[str, str]]:
+        """ETag, Last-Modified och innehållshash från senaste svaret per URL"""
+        urls = list(dict.fromkeys(urls))
+        if not urls:
+            return {}
+        sql = (
+            f"SELECT url, etag, last_modified, digest FROM url_validators "
+            f"WHERE url IN ({','.join('?' * len(urls))})"
+        )
+        return {
+            url: {k: v for k, v in (("etag", etag), ("last_modified", last_modified), ("digest", digest)) if v}
+            for url, etag, last_modified, digest in self._connect().execute(sql, urls)
+        }
+
+    def save_validators(self, entries: Dict[str, Dict[str, str]]):
+        """Sparar validerare och innehållshash per URL"""
+        with self._write_lock:
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO url_validators (url, etag, last_modified, digest) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(url, v.get("etag"), v.get("last_modified"), v.get("digest")) for url, v in entries.items()]
+                )
+
+    def generation(self, kpi_id: str, kommun_kod: str) -> int:
+        """Aktuell version för en serie eller rikspanel (för att validera minnescachade kopior)"""
+        return self.generations([(kpi_id, kommun_kod)])[(kpi_id, kommun_kod)]
+
+    def generations(self, pairs: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], int]:
+        """
+        Aktuell version per (kpi, kommun) i en fråga
+
+        Versionen ligger i lagret och räknas upp vid varje skrivning, även från
+        andra processer. Par med kommun PANEL_KEY avser KPI:ns rikspanel. Par
+        som saknas i lagret får version 0.
+        """
+        pairs = list(dict.fromkeys(pairs))
+        versions = {pair: 0 for pair in pairs}
+        conn = self._connect()
+        panel_kpis = sorted({kpi for kpi, kommun in pairs if kommun == PANEL_KEY})
+        if panel_kpis:
+            sql = f"SELECT kpi, version FROM panels WHERE kpi IN ({','.join('?' * len(panel_kpis))})"
+            for kpi, version in conn.execute(sql, panel_kpis):
+                versions[(kpi, PANEL_KEY)] = version
+        series = [pair for pair in pairs if pair[1] != PANEL_KEY]
+        if series:
+            kpis = sorted({p[0] for p in series})
+            kommuner = sorted({p[1] for p in series})
+            sql = (
+                f"SELECT kpi, municipality, version FROM series "
+                f"WHERE kpi IN ({','.join('?' * len(kpis))}) "
+                f"AND municipality IN ({','.join('?' * len(kommuner))})"
+            )
+            for kpi, kommun, version in conn.execute(sql, [*kpis, *kommuner]):
+                if (kpi, kommun) in versions:
+                    versions[(kpi, kommun)] = version
+        return versions
+
+    def fetched_at(self, pairs: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], float]:
+        """Hämtningstid per (kpi, kommun) för de par som finns i lagret"""
+        pairs = list(pairs)
+        if not pairs:
+            return {}
+        kpis = sorted({p[0] for p in pairs})
+        kommuner = sorted({p[1] for p in pairs})
+        sql = (
+            f"SELECT kpi, municipality, fetched_at FROM series "
+            f"WHERE kpi IN ({','.join('?' * len(kpis))}) "
+            f"AND municipality IN ({','.join('?' * len(kommuner))})"
+        )
+        wanted = set(pairs)
+        return {
+            (kpi, kommun): ts
+            for kpi, kommun, ts in self._connect().execute(sql, [*kpis, *kommuner])
+            if (kpi, kommun) in wanted
+        }
+
+    def high_water(self, pairs: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], int]:
+        """Senaste lagrade period per (kpi, kommun) för serier som har data"""
+        pairs = list(pairs)
+        if not pairs:
+            return {}
+        kpis = sorted({p[0] for p in pairs})
+        kommuner = sorted({p[1] for p in pairs})
+        sql = (
+            f"SELECT kpi, municipality, high_water FROM series "
+            f"WHERE kpi IN ({','.join('?' * len(kpis))}) "
+            f"AND municipality IN ({','.join('?' * len(kommuner))}) "
+            f"AND high_water IS NOT NULL"
+        )
+        wanted = set(pairs)
+        return {
+            (kpi, kommun): period
+            for kpi, kommun, period in self._connect().execute(sql, [*kpis, *kommuner])
+            if (kpi, kommun) in wanted
+        }
+
+    def query(self, kpi_ids: List[str], kommun_koder: Optional[List[str]], gender: str = 'T',
+              year: Optional[int] = None) -> pd.DataFrame:
+        """
+        Hämtar värden som DataFrame med kolumnerna kpi, kommun, år, värde
+
+        Args:
+            kpi_ids: KPI-ID:n
+            kommun_koder: Kommunkoder (None = alla lagrade kommuner)
+            gender: Kön (T = totalt, M = män, K = kvinnor)
+            year: Begränsa till ett år (default: alla)
+        """
+        sql = (
+            f"SELECT kpi, municipality AS kommun, period AS år, value AS värde FROM kpi_values "
+            f"WHERE kpi IN ({','.join('?' * len(kpi_ids))}) "
+        )
+        params = [*kpi_ids]
+        if kommun_koder is not None:
+            sql += f"AND municipality IN ({','.join('?' * len(kommun_koder))}) "
+            params.extend(kommun_koder)
+        sql += "AND gender = ?"
+        params.append(gender)
+        if year is not None:
+            sql += " AND period = ?"
+            params.append(int(year))
+        sql += " ORDER BY kpi, municipality, period"
+
+        df = pd.read_sql_query(sql, self._connect(), params=params)
+        df['värde'] = df['värde'].astype(float)
+        return df
+
+    def mark_panel(self, kpi_id: str, from_period: int, fetched_at: Optional[float] = None):
+        """Noterar att en KPI hämtats för alla kommuner från och med from_period"""
+        if fetched_at is None:
+            fetched_at = time.time()
+        with self._write_lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT INTO panels (kpi, from_period, fetched_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT (kpi) DO UPDATE SET from_period = excluded.from_period, "
+                    "fetched_at = excluded.fetched_at, version = panels.version + 1",
+                    (kpi_id, int(from_period), fetched_at)
+                )
+
+    def panel_state(self, kpi_id: str) -> Optional[Tuple[int, float]]:
+        """(första period, hämtningstid) för en rikspanel, eller None"""
+        return self._connect().execute(
+            "SELECT from_period, fetched_at FROM panels WHERE kpi = ?", (kpi_id,)
+        ).fetchone()
+
+    def upsert_catalog(self, entries: Iterable[Dict], fetched_at: Optional[float] = None) -> int:
+        """
+        Uppdaterar KPI-katalogen från en fullständig listning
+
+        Bara poster vars metadata ändrats skrivs om, och KPI:er som inte längre
+        finns i listningen tas bort.
+
+        Returns:
+            Antal tillagda, ändrade eller borttagna KPI:er
+        """
+        if fetched_at is None:
+            fetched_at = time.time()
+
+        entries = {e['id']: e for e in entries if e.get('id')}
+        incoming = {kpi_id: json.dumps(e, ensure_ascii=False, sort_keys=True) for kpi_id, e in entries.items()}
+        with self._write_lock:
+            conn = self._connect()
+            existing = dict(conn.execute("SELECT id, metadata FROM kpi_catalog"))
+            changed = [kpi_id for kpi_id, meta in incoming.items() if existing.get(kpi_id) != meta]
+            removed = [kpi_id for kpi_id in existing if kpi_id not in incoming]
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO kpi_catalog (id, title, description, metadata) VALUES (?, ?, ?, ?)",
+                    [
+                        (kpi_id, entries[kpi_id].get('title') or '', entries[kpi_id].get('description'),
+                         incoming[kpi_id])
+                        for kpi_id in changed
+                    ]
+                )
+                conn.executemany("DELETE FROM kpi_catalog WHERE id = ?", [(kpi_id,) for kpi_id in removed])
+                # Versionen räknas bara upp när katalogen faktiskt ändrats
+                conn.execute(
+                    "INSERT INTO catalog_state (name, fetched_at, version) VALUES ('kpi', ?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET fetched_at = excluded.fetched_at, "
+                    "version = catalog_state.version + excluded.version",
+                    (fetched_at, 1 if changed or removed else 0)
+                )
+        return len(changed) + len(removed)
+
+    def catalog_fetched_at(self) -> Optional[float]:
+        """När katalogen senast hämtades, eller None om den aldrig hämtats"""
+        row = self._connect().execute("SELECT fetched_at FROM catalog_state WHERE name = 'kpi'").fetchone()
+        return row[0] if row else None
+
+    def catalog_generation(self) -> int:
+        """Aktuell version av katalogen (för att validera sökindex byggda ur den)"""
+        row = self._connect().execute("SELECT version FROM catalog_state WHERE name = 'kpi'").fetchone()
+        return row[0] if row else 0
+
+    def catalog_entries(self) -> List[Dict]:
+        """Id, titel och beskrivning för alla KPI:er i katalogen"""
+        return [
+            {'id': kpi_id, 'title': title, 'description': description}
+            for kpi_id, title, description in self._connect().execute(
+                "SELECT id, title, description FROM kpi_catalog"
+            )
+        ]
+
+    def catalog_entry(self, kpi_id: str) -> Optional[Dict]:
+        """Fullständig metadata för en KPI ur katalogen"""
+        row = self._connect().execute("SELECT metadata FROM kpi_catalog WHERE id = ?", (kpi_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def import_legacy_json(self, cache_dir: str) -> int:
+        """
+        Läser in kolada_kpi_data_<KPI>_<kommun>.json-filer i lagret
+
+        Filerna versionshanteras som förifylld data, så en ny utcheckning
+        slipper hämta varje serie vid första körningen. Bara serier som
+        saknas i lagret importeras, och filerna lämnas orörda. Filernas
+        ändringstid används som hämtningstid så att TTL:en behålls. De
+        innehåller bara totalvärden, så serierna markeras för fullständig
+        nedladdning (med alla kön) vid nästa uppdatering istället för
+        inkrementell. Returnerar antal importerade filer.
+        """
+        files = {}
+        for path in glob.glob(os.path.join(cache_dir, "kolada_kpi_data_*_*.json")):
+            name = os.path.basename(path)[len("kolada_kpi_data_"):-len(".json")]
+            kpi_id, _, kommun_kod = name.rpartition("_")
+            files[(kpi_id, kommun_kod)] = path
+        stored = self.fetched_at(files)
+
+        imported = 0
+        for pair, path in files.items():
+            if pair in stored:
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    records = json.load(f)
+                rows = [
+                    (r['kpi'], str(r['kommun']), int(r['år']), 'T', r.get('värde'))
+                    for r in records
+                ]
+                self.replace_series([pair], rows, fetched_at=os.path.getmtime(path))
+                self._clear_high_water([pair])
+                imported += 1
+            except Exception as e:
+                print(f"Kunde inte importera {os.path.basename(path)}: {e}")
+        return imported
@@ -0,0 +1,117 @@
+"""
+Sökindex för Koladas KPI-katalog
+
+Ett inverterat index från ord till KPI:er, byggt i minnet från den lokalt
+lagrade katalogen. Ordförrådet hålls sorterat så att prefixsökning blir en
+binärsökning, och träffar rankas efter var och hur väl sökorden matchar.
+"""
+
+import re
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Set
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+# Poäng per sökord beroende på var och hur det matchar
+TITLE_EXACT = 4.0
+TITLE_PREFIX = 3.0
+TITLE_INFIX = 1.5
+DESCRIPTION_EXACT = 1.0
+DESCRIPTION_PREFIX = 0.5
+
+MIN_INFIX_LENGTH = 4
+
+
+def tokenize(text: str) -> List[str]:
+    """Delar upp text i gemena ord"""
+    return _TOKEN_PATTERN.findall((text or "").lower())
+
+
+class KPIIndex:
+    """Inverterat index över KPI-titlar och beskrivningar"""
+
+    def __init__(self, entries: Iterable[Dict]):
+        self.titles: Dict[str, str] = {}
+        self._title_postings: Dict[str, Set[str]] = {}
+        self._description_postings: Dict[str, Set[str]] = {}
+
+        for entry in entries:
+            kpi_id = entry.get('id')
+            if not kpi_id:
+                continue
+            title = entry.get('title') or ''
+            self.titles[kpi_id] = title
+            for token in set(tokenize(title)):
+                self._title_postings.setdefault(token, set()).add(kpi_id)
+            for token in set(tokenize(entry.get('description'))):
+                self._description_postings.setdefault(token, set()).add(kpi_id)
+
+        self._title_vocabulary = sorted(self._title_postings)
+        self._description_vocabulary = sorted(self._description_postings)
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    @staticmethod
+    def _prefixed(vocabulary: List[str], prefix: str) -> List[str]:
+        """Alla ord i det sorterade ordförrådet som börjar med prefix"""
+        start = bisect_left(vocabulary, prefix)
+        end = start
+        while end < len(vocabulary) and vocabulary[end].startswith(prefix):
+            end += 1
+        return vocabulary[start:end]
+
+    def _score_token(self, token: str, scores: Dict[str, float], matched: Dict[str, str]):
+        """Lägger till ett sökords poäng för alla KPI:er det matchar"""
+        hits: Dict[str, float] = {}
+
+        def add(postings: Dict[str, Set[str]], words: Iterable[str], weight: float):
+            for word in words:
+                for kpi_id in postings.get(word, ()):
+                    if weight > hits.get(kpi_id, 0.0):
+                        hits[kpi_id] = weight
+
+        add(self._title_postings, [token], TITLE_EXACT)
+        add(self._title_postings, self._prefixed(self._title_vocabulary, token), TITLE_PREFIX)
+        add(self._description_postings, [token], DESCRIPTION_EXACT)
+        add(self._description_postings, self._prefixed(self._description_vocabulary, token), DESCRIPTION_PREFIX)
+
+        # Sammansättningar (t.ex. "grundskola" för "skola") hittas inte med prefix
+        if len(token) >= MIN_INFIX_LENGTH:
+            add(self._title_postings, [w for w in self._title_vocabulary if token in w], TITLE_INFIX)
+
+        for kpi_id, weight in hits.items():
+            scores[kpi_id] = scores.get(kpi_id, 0.0) + weight
+            matched.setdefault(kpi_id, token)
+
+    def search(self, keywords: Iterable[str], limit: int = 50, boost: Set[str] = frozenset()) -> List[Dict]:
+        """
+        Söker efter KPI:er som matchar något av sökorden
+
+        Args:
+            keywords: Sökord eller fraser (delas upp i ord)
+            limit: Max antal träffar
+            boost: KPI-ID:n som rankas högre vid lika relevans (t.ex. kurerade KPI:er)
+
+        Returns:
+            Lista med id, title, keyword_match och score, bäst först
+        """
+        tokens = list(dict.fromkeys(t for keyword in keywords for t in tokenize(keyword)))
+        scores: Dict[str, float] = {}
+        matched: Dict[str, str] = {}
+        for token in tokens:
+            self._score_token(token, scores, matched)
+
+        ranked = sorted(
+            scores.items(),
+            key=lambda item: (-item[1], item[0] not in boost, len(self.titles[item[0]]), item[0])
+        )
+        return [
+            {
+                'id': kpi_id,
+                'title': self.titles[kpi_id],
+                'keyword_match': matched[kpi_id],
+                'score': score,
+            }
+            for kpi_id, score in ranked[:limit]
+        ]
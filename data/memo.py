@@ -0,0 +1,68 @@
+"""
+Begränsad LRU-minnescache för tolkade data
+
+Delas av alla Streamlit-sessioner i processen. Varje post sparas tillsammans
+med den version av underliggande data den byggdes från och en utgångstid, så
+att en omkörning med varma data slipper läsa och tolka om dem.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class LRUMemo:
+    """Trådsäker LRU-cache med versionskontroll och träff/miss-räknare"""
+
+    def __init__(self, maxsize: int = 512):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, version: Any) -> Optional[Any]:
+        """
+        Returnerar värdet om det finns, har rätt version och inte gått ut
+
+        Returns:
+            Cachat värde eller None
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, entry_version, expires_at = entry
+                if entry_version == version and now < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, version: Any, value: Any, expires_at: float):
+        """Sparar ett värde och tar bort de minst nyligen använda vid behov"""
+        with self._lock:
+            self._entries[key] = (value, version, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Tömmer cachen (räknarna behålls)"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Träffar, missar och aktuell storlek"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+            }
@@ -0,0 +1,282 @@
+"""
+Lokal befolkningskub för SCB:s tabell BefolkningNy
+
+Befolkningen hämtades tidigare som många smala utsnitt (totaler per år, en
+åldersfördelning för ett år, äldre åldrar för tre år ...) som cachades var
+för sig. Här lagras istället en kub per region med folkmängd per ålder, kön
+och år som en NumPy-array (.npz i cachekatalogen). Saknade år hämtas vid
+behov i en fråga med alla åldrar och båda könen, och alla utsnitt och
+summeringar görs sedan lokalt utan fler anrop. Kubens åldersaxel följer
+AGES (0..100+), så åldersgrupper kan summeras direkt på arrayen.
+
+Kuben sparar när varje år hämtades. SCB reviderar publicerade siffror, så
+ett år som är äldre än REFRESH_SECONDS hämtas om när det efterfrågas; det
+lagrade året serveras under tiden och uppdateras i bakgrunden. Varje koppling
+hämtar via sin egen fetch, men kuberna i minnet och låsen per region delas av
+alla kopplingar mot samma cachekatalog (se get_cube).
+"""
+
+import io
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from data import age_bins, cache_store, pxweb, revalidate
+
+ENDPOINT = "BE/BE0101/BE0101A/BefolkningNy"
+CONTENT = "BE0101N1"  # Folkmängd
+AGES = [str(age) for age in range(100)] + ["100+"]
+SEXES = ["1", "2"]
+SEX_LABELS = {"1": "Män", "2": "Kvinnor"}
+CUBE_PREFIX = "scb_cube_BefolkningNy_"
+REFRESH_SECONDS = 7 * 86400  # Som SCB-cachens ttl
+
+
+class _SharedCubes:
+    """Kuber i minnet och ett lås per region för en cachekatalog"""
+
+    def __init__(self):
+        self.cubes: Dict[str, Dict] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def region_lock(self, region: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(region, threading.Lock())
+
+
+_shared: Dict[str, _SharedCubes] = {}
+_shared_lock = threading.Lock()
+
+
+def _shared_for(cache_dir: str) -> _SharedCubes:
+    key = os.path.abspath(cache_dir)
+    with _shared_lock:
+        shared = _shared.get(key)
+        if shared is None:
+            shared = _shared[key] = _SharedCubes()
+        return shared
+
+
+class PopulationCube:
+    """Folkmängd per region som array med axlarna ålder × kön × år"""
+
+    def __init__(self, cache_dir: str, fetch: Callable[[str, Dict], Dict],
+                 available_years: Optional[Callable[[], List[str]]] = None,
+                 refresh_seconds: float = REFRESH_SECONDS):
+        """
+        Args:
+            cache_dir: Katalog där kuberna sparas
+            fetch: Hämtar ett PxWeb-svar för (endpoint, fråga)
+            available_years: Ger tabellens år enligt metadata (okända år hämtas då inte)
+            refresh_seconds: Ålder då ett lagrat år hämtas om
+        """
+        self.cache_dir = cache_dir
+        self._fetch = fetch
+        self._available_years = available_years
+        self.refresh_seconds = refresh_seconds
+        # Serverar inaktuella år direkt och hämtar om dem i bakgrunden
+        self.stale_while_revalidate = True
+        self._shared = _shared_for(cache_dir)
+
+    def _path(self, region: str) -> str:
+        return os.path.join(self.cache_dir, f"{CUBE_PREFIX}{region}.npz")
+
+    def _load(self, region: str) -> Dict:
+        """Regionens kub från minnet eller disken (tom om den saknas), anropas med regionens lås"""
+        path = self._path(region)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = None
+        cube = self._shared.cubes.get(region)
+        # Läs om filen om en annan process skrivit den sedan den lästes
+        if cube is not None and cube["mtime"] == mtime:
+            return cube
+        try:
+            with np.load(path, allow_pickle=False) as stored:
+                years = [str(y) for y in stored["years"]]
+                # Kuber sparade före fetched_at räknas som hämtade när filen skrevs
+                fetched_at = stored["fetched_at"] if "fetched_at" in stored.files else np.full(len(years), mtime)
+                cube = {"years": years, "values": stored["values"], "fetched_at": fetched_at}
+        except (OSError, ValueError, KeyError):
+            cube = {"years": [], "values": np.empty((len(AGES), len(SEXES), 0)), "fetched_at": np.empty(0)}
+        cube["mtime"] = mtime
+        self._shared.cubes[region] = cube
+        return cube
+
+    def _save(self, region: str, cube: Dict):
+        path = self._path(region)
+        buffer = io.BytesIO()
+        np.savez(buffer, years=np.array(cube["years"], dtype=str), values=cube["values"],
+                 fetched_at=cube["fetched_at"])
+        try:
+            cache_store.write_atomic(path, buffer.getvalue())
+            cube["mtime"] = os.path.getmtime(path)
+        except OSError as e:
+            print(f"⚠️ Kunde inte spara befolkningskub: {e}")
+
+    def _download(self, region: str, years: List[str]) -> Tuple[List[str], np.ndarray]:
+        """
+        Hämtar years för region (alla åldrar, båda könen)
+
+        Returns:
+            De år som kom tillbaka och deras värden (ålder × kön × år)
+        """
+        query = {
+            "query": [
+                {"code": "Region", "selection": {"filter": "item", "values": [region]}},
+                {"code": "Alder", "selection": {"filter": "item", "values": AGES}},
+                {"code": "Kon", "selection": {"filter": "item", "values": SEXES}},
+                {"code": "ContentsCode", "selection": {"filter": "item", "values": [CONTENT]}},
+                {"code": "Tid", "selection": {"filter": "item", "values": years}}
+            ],
+            "response": {"format": "json"}
+        }
+        df = pxweb.decode(self._fetch(ENDPOINT, query), names=["Region", "Ålder", "Kön", "År"],
+                          value_names=["Antal"])
+
+        added = np.full((len(AGES), len(SEXES), len(years)), np.nan)
+        age_index = pd.Index(AGES).get_indexer(df["Ålder"].astype(str))
+        sex_index = pd.Index(SEXES).get_indexer(df["Kön"].astype(str))
+        year_index = pd.Index(years).get_indexer(df["År"].astype(str))
+        known = (age_index >= 0) & (sex_index >= 0) & (year_index >= 0)
+        added[age_index[known], sex_index[known], year_index[known]] = df["Antal"].to_numpy()[known]
+
+        # Bara år som faktiskt kom tillbaka läggs in, och ersätter då lagrade värden
+        returned = [i for i in range(len(years)) if (year_index[known] == i).any()]
+        return [years[i] for i in returned], added[:, :, returned]
+
+    def _update(self, region: str, years: List[str]) -> Dict:
+        """Hämtar years utan lås och lägger sedan in dem i regionens aktuella kub"""
+        returned, added = self._download(region, years)
+        with self._shared.region_lock(region):
+            cube = self._load(region)
+            replaced = set(returned)
+            keep = [i for i, year in enumerate(cube["years"]) if year not in replaced]
+            all_years = [cube["years"][i] for i in keep] + returned
+            values = np.concatenate([cube["values"][:, :, keep], added], axis=2)
+            fetched_at = np.concatenate([cube["fetched_at"][keep], np.full(len(returned), time.time())])
+            order = np.argsort(all_years, kind="stable")
+            cube = {"years": [all_years[i] for i in order], "values": values[:, :, order],
+                    "fetched_at": fetched_at[order], "mtime": cube["mtime"]}
+            self._shared.cubes[region] = cube
+            self._save(region, cube)
+            return cube
+
+    def ensure(self, region: str, years: Iterable[str]) -> Dict:
+        """
+        Kuben för region med years ifyllda (så långt SCB har dem)
+
+        År som saknas hämtas direkt, tillsammans med lagrade år äldre än
+        refresh_seconds. Saknas inga år serveras de inaktuella och hämtas om
+        i bakgrunden (med stale_while_revalidate avstängt hämtas de direkt,
+        och misslyckas det används de lagrade värdena).
+
+        Returns:
+            Dict med years (sorterade), values (ålder × kön × år) och
+            fetched_at (hämtningstid per år)
+        """
+        years = list(dict.fromkeys(str(y) for y in years))
+        with self._shared.region_lock(region):
+            cube = self._load(region)
+        stored = dict(zip(cube["years"], cube["fetched_at"]))
+        missing = [y for y in years if y not in stored]
+        if missing and self._available_years is not None:
+            available = set(self._available_years() or [])
+            if available:
+                missing = [y for y in missing if y in available]
+        cutoff = time.time() - self.refresh_seconds
+        stale = [y for y in years if y in stored and stored[y] < cutoff]
+
+        if missing:
+            return self._update(region, missing + stale)
+        if stale and self.stale_while_revalidate:
+            key = (CUBE_PREFIX, os.path.abspath(self.cache_dir), region)
+            revalidate.refresh_in_background(key, lambda: self._update(region, stale))
+        elif stale:
+            try:
+                return self._update(region, stale)
+            except Exception as e:
+                print(f"⚠️ Kunde inte uppdatera befolkningskub för {region}, använder lagrade år: {e}")
+        return cube
+
+    def frame(self, region: str, years: Iterable[str], ages: Iterable[str] = AGES) -> pd.DataFrame:
+        """
+        Långt utsnitt med Ålder, Kön, År och Antal (saknade värden som 0)
+
+        Raderna kommer i ordningen ålder, kön, år som i SCB:s svar.
+        """
+        years = [str(y) for y in years]
+        cube = self.ensure(region, years)
+        year_index = [cube["years"].index(y) for y in years if y in cube["years"]]
+        age_index = pd.Index(AGES).get_indexer([str(a) for a in ages])
+        age_index = age_index[age_index >= 0]
+
+        values = cube["values"][np.ix_(age_index, range(len(SEXES)), year_index)]
+        shape = values.shape
+        return pd.DataFrame({
+            "Ålder": np.repeat(np.asarray(AGES)[age_index], shape[1] * shape[2]),
+            "Kön": np.tile(np.repeat([SEX_LABELS[s] for s in SEXES], shape[2]), shape[0]),
+            "År": np.tile(np.asarray(cube["years"])[year_index], shape[0] * shape[1]),
+            "Antal": pxweb.counts(pd.Series(values.reshape(-1))).to_numpy()
+        })
+
+    def totals(self, region: str, years: Iterable[str]) -> pd.DataFrame:
+        """Folkmängd per kön och år (summa över åldrar), kön för kön"""
+        years = [str(y) for y in years]
+        cube = self.ensure(region, years)
+        year_index = [cube["years"].index(y) for y in years if y in cube["years"]]
+        summed = np.nansum(cube["values"][:, :, year_index], axis=0)  # kön × år
+        return pd.DataFrame({
+            "År": np.tile(np.asarray(cube["years"])[year_index], len(SEXES)),
+            "Kön": np.repeat([SEX_LABELS[s] for s in SEXES], len(year_index)),
+            "Antal": summed.reshape(-1).astype(int)
+        })
+
+    def binned(self, region: str, years: Iterable[str],
+               bands: Union[str, age_bins.AgeBands, Sequence[int]] = age_bins.FIVE_YEAR) -> pd.DataFrame:
+        """
+        Folkmängd per åldersgrupp, kön och år (saknade värden som 0)
+
+        Args:
+            region: Regionkod
+            years: År att ta med
+            bands: Åldersindelning (namn i age_bins.BAND_SETS, AgeBands eller nedre gränser)
+
+        Returns:
+            DataFrame med Åldersgrupp (ordnad kategori), Kön, År och Antal
+        """
+        bands = age_bins.get_bands(bands)
+        years = [str(y) for y in years]
+        cube = self.ensure(region, years)
+        year_index = [cube["years"].index(y) for y in years if y in cube["years"]]
+        summed = age_bins.bin_array(cube["values"][:, :, year_index], bands)  # grupp × kön × år
+        shape = summed.shape
+        return pd.DataFrame({
+            "Åldersgrupp": pd.Categorical.from_codes(
+                np.repeat(np.arange(shape[0]), shape[1] * shape[2]), categories=bands.labels, ordered=True),
+            "Kön": np.tile(np.repeat([SEX_LABELS[s] for s in SEXES], shape[2]), shape[0]),
+            "År": np.tile(np.asarray(cube["years"])[year_index], shape[0] * shape[1]),
+            "Antal": summed.reshape(-1).astype(int)
+        })
+
+
+def get_cube(cache_dir: str, fetch: Callable[[str, Dict], Dict],
+             available_years: Optional[Callable[[], List[str]]] = None) -> PopulationCube:
+    """
+    Befolkningskub för cachekatalogen som hämtar via anroparens fetch
+
+    Kuberna i minnet och låsen per region delas med alla andra kopplingar
+    mot samma katalog, så en region hämtas och sparas på ett ställe.
+
+    Args:
+        cache_dir: Anroparens cachekatalog
+        fetch: Hämtar ett PxWeb-svar för (endpoint, fråga)
+        available_years: Ger tabellens år enligt metadata
+    """
+    return PopulationCube(cache_dir, fetch, available_years)
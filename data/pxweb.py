@@ -0,0 +1,192 @@
+"""
+Avkodning av PxWeb-svar till DataFrames
+
+Ett PxWeb-svar (format json) består av columns med metadata och data med en
+rad per kombination: {"key": [koder...], "values": [värden...]}. Istället för
+att bygga upp en DataFrame rad för rad transponeras svaret här i ett svep:
+nycklarna blir kategoriska kolumner (koder mappas till etiketter via
+kategorierna, inte per rad) och värdena konverteras till float med NumPy,
+där SCB:s symboler för saknade värden blir NaN.
+
+Formatet json-stat2 skickar istället en tät värdevektor plus ett index per
+dimension, vilket är betydligt mindre för frågor med många dimensioner.
+Vektorn formas om direkt med NumPy till samma långa DataFrame. CSV-svar
+(etiketter istället för koder) kan läsas med decode_csv.
+"""
+
+import io
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# SCB:s symboler för värden som saknas, är sekretessbelagda eller inte kan förekomma
+MISSING_SYMBOLS = ["..", ".", "-", "…"]
+
+# Format som kan begäras och avkodas
+FORMATS = ("json", "json-stat2", "csv")
+
+
+def is_jsonstat2(data: Dict) -> bool:
+    """True om svaret är i formatet json-stat2"""
+    return isinstance(data, dict) and data.get("class") == "dataset"
+
+
+def _metric_dimension(data: Dict) -> Optional[str]:
+    """Innehållsdimensionen i ett json-stat2-svar"""
+    metric = data.get("role", {}).get("metric") or []
+    if metric:
+        return metric[0]
+    return "ContentsCode" if "ContentsCode" in data.get("id", []) else None
+
+
+def dimension_codes(data: Dict) -> List[str]:
+    """Koder för dimensionerna i den ordning de står i varje rads key"""
+    if is_jsonstat2(data):
+        metric = _metric_dimension(data)
+        return [code for code in data.get("id", []) if code != metric]
+    return [c.get("code") for c in data.get("columns", []) if c.get("type") != "c"]
+
+
+def content_codes(data: Dict) -> List[str]:
+    """Koder för innehållskolumnerna i den ordning de står i varje rads values"""
+    if is_jsonstat2(data):
+        metric = _metric_dimension(data)
+        return _category_codes(data, metric) if metric else ["value"]
+    return [c.get("code") for c in data.get("columns", []) if c.get("type") == "c"]
+
+
+def _category_codes(data: Dict, dimension: str) -> List[str]:
+    """Kategorikoder för en json-stat2-dimension i indexordning"""
+    index = data["dimension"][dimension]["category"].get("index")
+    if isinstance(index, list):
+        return list(index)
+    if isinstance(index, dict):
+        return sorted(index, key=index.get)
+    # En dimension med en enda kategori kan sakna index
+    return list(data["dimension"][dimension]["category"].get("label", {}))
+
+
+def to_float(values) -> np.ndarray:
+    """Konverterar PxWeb-värden (strängar) till float, saknade värden blir NaN"""
+    arr = np.asarray(values, dtype=object)
+    result = np.full(arr.shape, np.nan)
+    present = ~np.isin(arr, MISSING_SYMBOLS) & pd.notna(arr)
+    result[present] = arr[present].astype(float)
+    return result
+
+
+def _categorical(codes, mapping: Optional[Dict[str, str]]) -> pd.Categorical:
+    """Kategorisk kolumn av koder, med etiketter från mapping"""
+    cat = pd.Categorical(codes)
+    if mapping:
+        labels = [mapping.get(code, code) for code in cat.categories]
+        if len(set(labels)) == len(labels):
+            cat = cat.rename_categories(labels)
+        else:
+            # Flera koder med samma etikett: mappa via kategorierna ändå
+            cat = pd.Categorical(np.asarray(labels, dtype=object)[cat.codes])
+    return cat
+
+
+def decode(data: Dict, names: Optional[List[str]] = None,
+           labels: Optional[Dict[str, Dict[str, str]]] = None,
+           value_names: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Avkodar ett PxWeb-svar till en DataFrame i långt format
+
+    Fungerar för både json och json-stat2 och ger samma kolumner för båda.
+
+    Args:
+        data: PxWeb-svar (json med columns och data, eller json-stat2)
+        names: Kolumnnamn för dimensionerna i key-ordning (default: koderna)
+        labels: Kolumnnamn -> {kod: etikett} för dimensioner som ska få etiketter
+        value_names: Kolumnnamn för innehållet i values-ordning (default: koderna).
+            Innehåll utan namn i listan tas inte med.
+
+    Returns:
+        DataFrame med en kategorisk kolumn per dimension och en float-kolumn
+        per innehåll
+    """
+    dims = dimension_codes(data)
+    contents = content_codes(data)
+    names = list(names) if names else dims
+    value_names = list(value_names) if value_names else contents
+    labels = labels or {}
+
+    if is_jsonstat2(data):
+        return _decode_jsonstat2(data, names, labels, value_names)
+
+    rows = data.get("data", [])
+    if not rows:
+        return pd.DataFrame(
+            {**{name: pd.Categorical([]) for name in names},
+             **{name: np.array([], dtype=float) for name in value_names}}
+        )
+
+    key_columns = list(zip(*(row["key"] for row in rows)))
+    value_columns = list(zip(*(row["values"] for row in rows)))
+
+    frame = {}
+    for name, codes in zip(names, key_columns):
+        frame[name] = _categorical(codes, labels.get(name))
+    for name, values in zip(value_names, value_columns):
+        frame[name] = to_float(values)
+    return pd.DataFrame(frame)
+
+
+def _decode_jsonstat2(data: Dict, names: List[str], labels: Dict[str, Dict[str, str]],
+                      value_names: List[str]) -> pd.DataFrame:
+    """Formar om json-stat2:s täta värdevektor till långt format"""
+    ids = data.get("id", [])
+    sizes = data.get("size", [])
+    metric = _metric_dimension(data)
+
+    values = np.array(data.get("value", []), dtype=float).reshape(sizes)
+    # Saknade värden markeras med status och null i värdevektorn
+    for position, symbol in (data.get("status") or {}).items():
+        if symbol in MISSING_SYMBOLS:
+            values.flat[int(position)] = np.nan
+
+    # Innehållet läggs sist så att varje rad får ett värde per innehåll
+    if metric is not None:
+        values = np.moveaxis(values, ids.index(metric), -1)
+    else:
+        values = values[..., np.newaxis]
+    dim_ids = [code for code in ids if code != metric]
+    dim_sizes = [sizes[ids.index(code)] for code in dim_ids]
+    values = values.reshape(-1, values.shape[-1])
+
+    frame = {}
+    n_rows = values.shape[0]
+    inner = n_rows
+    for name, code, size in zip(names, dim_ids, dim_sizes):
+        inner //= size
+        codes = np.tile(np.repeat(np.arange(size), inner), n_rows // (size * inner))
+        categories = _category_codes(data, code)
+        mapping = labels.get(name)
+        frame[name] = _categorical(np.asarray(categories, dtype=object)[codes], mapping)
+    for position, name in enumerate(value_names[:values.shape[1]]):
+        frame[name] = values[:, position]
+    return pd.DataFrame(frame)
+
+
+def decode_csv(text: str) -> pd.DataFrame:
+    """
+    Läser ett CSV-svar från PxWeb till långt format
+
+    PxWeb lägger textkolumnerna (etiketter, inte koder) först och en
+    värdekolumn per tid och innehåll därefter. Värdekolumnerna smälts ihop
+    till kolumnerna variabel och värde.
+    """
+    df = pd.read_csv(io.StringIO(text), na_values=MISSING_SYMBOLS, keep_default_na=False)
+    label_columns = [c for c in df.columns if not pd.api.types.is_numeric_dtype(df[c])]
+    long = df.melt(id_vars=label_columns, var_name="variabel", value_name="värde")
+    for column in label_columns + ["variabel"]:
+        long[column] = long[column].astype("category")
+    return long
+
+
+def counts(series: pd.Series) -> pd.Series:
+    """Antal som heltal, med saknade värden som 0 (så som sidorna visar dem)"""
+    return series.fillna(0).astype(int)
@@ -0,0 +1,140 @@
+"""
+Klient för SCB:s PxWebApi 2.0
+
+I v2 ställs frågor med GET (urvalet ligger i URL:en som valueCodes[kod]=...)
+istället för POST med en JSON-kropp. Det gör svaren cachebara i vanliga
+HTTP-cachar och gör det säkert att slå ihop samtidiga identiska anrop: den
+första tråden hämtar och övriga väntar på samma svar.
+
+Frågor byggs fortfarande i v1-format i resten av koden och översätts här.
+Frågor som inte kan uttryckas i v2 (t.ex. vs:- och agg:-filter) och tabeller
+utan känt v2-id returnerar None, så att anroparen använder v1 istället.
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+from data import http_transport
+from data.single_flight import SingleFlight
+
+V2_BASE_URL = "https://api.scb.se/ov0104/v2beta/api/v2"
+
+# v1-sökväg -> tabell-id i v2 (tabeller som saknas här hämtas via v1)
+TABLE_IDS = {
+    "BE/BE0101/BE0101A/BefolkningNy": "TAB638",
+}
+
+# Svarsformat i v1 -> outputFormat i v2 (v2 har inget v1-json)
+OUTPUT_FORMATS = {
+    "json-stat2": "json-stat2",
+    "csv": "csv",
+}
+
+
+def table_id(endpoint: str) -> Optional[str]:
+    """Tabellens id i v2, eller None om det inte är känt"""
+    return TABLE_IDS.get(endpoint.strip("/"))
+
+
+def selection_expression(selection: Dict) -> Optional[str]:
+    """
+    Ett v1-urval som v2-uttryck för valueCodes
+
+    Returns:
+        Uttrycket (t.ex. "1384,1380", "*" eller "top(3)"), eller None om
+        filtret inte har någon motsvarighet i v2
+    """
+    spec = selection.get("selection", {})
+    filter_type = spec.get("filter", "item")
+    values = [str(v) for v in spec.get("values", [])]
+
+    if filter_type in ("item", "all"):
+        # Jokertecken (*, 20*) tolkas likadant i v2
+        return ",".join(values) if values else None
+    if filter_type == "top" and len(values) == 1:
+        return f"top({values[0]})"
+    return None
+
+
+def build_params(query: Dict, lang: str = "sv") -> Optional[List[Tuple[str, str]]]:
+    """
+    GET-parametrar för en fråga i v1-format
+
+    Returns:
+        Lista med (namn, värde) i kanonisk ordning, eller None om frågan
+        inte kan ställas i v2
+    """
+    output_format = OUTPUT_FORMATS.get(query.get("response", {}).get("format", "json"))
+    if output_format is None:
+        return None
+
+    params = [("lang", lang), ("outputFormat", output_format)]
+    for selection in sorted(query.get("query", []), key=lambda s: str(s.get("code", ""))):
+        expression = selection_expression(selection)
+        if expression is None:
+            return None
+        params.append((f"valueCodes[{selection.get('code')}]", expression))
+    return params
+
+
+class PxWebV2Client:
+    """GET-baserade uttag ur PxWebApi 2.0 med sammanslagning av samtidiga anrop"""
+
+    def __init__(self, base_url: str = V2_BASE_URL, timeout: float = 30):
+        self.base_url = base_url
+        self.timeout = timeout
+        self._flight = SingleFlight()
+
+    def url(self, table: str) -> str:
+        return f"{self.base_url}/tables/{table}/data"
+
+    def _get(self, url: str, params: List[Tuple[str, str]], output_format: str,
+             validators: Optional[Dict] = None) -> Tuple[Optional[Dict], Dict]:
+        response = http_transport.get(url, params=params, timeout=self.timeout,
+                                      headers=http_transport.conditional_headers(validators))
+        if response.status_code == 304:
+            return None, {**(validators or {}), **http_transport.response_validators(response)}
+        response.raise_for_status()
+        received = http_transport.response_validators(response)
+        if output_format == "csv":
+            # Samma inslagning som v1-klienten, så att diskcachen förblir JSON
+            return {"csv": response.text}, received
+        return response.json(), received
+
+    def fetch(self, endpoint: str, query: Dict) -> Optional[Dict]:
+        """
+        Hämtar en fråga via v2
+
+        Identiska anrop som pågår samtidigt i andra trådar delar på ett svar.
+
+        Returns:
+            Svaret (json-stat2, eller {"csv": text}), eller None om tabellen
+            eller frågan inte stöds i v2
+
+        Raises:
+            requests.exceptions.RequestException, ValueError: vid fel från v2
+        """
+        result = self.fetch_conditional(endpoint, query)
+        return None if result is None else result[0]
+
+    def fetch_conditional(self, endpoint: str, query: Dict,
+                          validators: Optional[Dict] = None) -> Optional[Tuple[Optional[Dict], Dict]]:
+        """
+        Hämtar en fråga via v2 med If-None-Match/If-Modified-Since
+
+        Args:
+            endpoint: Tabellens v1-sökväg
+            query: Fråga i v1-format
+            validators: ETag/Last-Modified från förra svaret
+
+        Returns:
+            (svar, validerare), där svaret är None om SCB svarade 304 (oförändrat),
+            eller None om tabellen eller frågan inte stöds i v2
+        """
+        table = table_id(endpoint)
+        params = build_params(query) if table else None
+        if params is None:
+            return None
+
+        url = self.url(table)
+        key = (url, tuple(params), tuple(sorted((validators or {}).items())))
+        return self._flight.do(key, lambda: self._get(url, params, dict(params)["outputFormat"], validators))
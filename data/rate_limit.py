@@ -0,0 +1,114 @@
+"""
+Token bucket per värd med prioritetskö
+
+SCB:s API tillåter ett begränsat antal anrop per tidsfönster (10 anrop per
+10 sekunder) och svarar med 429 när gränsen överskrids. Schemaläggaren här
+delas av alla kopplingar i processen: varje anrop tar en token från värdens
+hink, och när hinken är tom köar anropen istället för att misslyckas.
+Interaktiva anrop från sidorna går före bakgrundsuppdateringar, och en
+Retry-After från servern pausar hela värden.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class _Bucket:
+    """Tillstånd för en värd (skyddas av schemaläggarens lås)"""
+
+    def __init__(self, capacity: int, per_seconds: float):
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.queue = []  # heap med (prioritet, löpnummer)
+
+    def refill(self, now: float):
+        # Inga tokens fylls på under en paus
+        start = max(self.updated, self.paused_until)
+        if now > start:
+            self.tokens = min(self.capacity, self.tokens + (now - start) * self.rate)
+        self.updated = max(self.updated, now)
+
+    def wait_time(self, now: float) -> float:
+        """Sekunder tills nästa token finns och eventuell paus är över"""
+        token_wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(token_wait, self.paused_until - now, 0.0)
+
+
+class TokenBucketScheduler:
+    """Processgemensam hastighetsbegränsning per värd"""
+
+    def __init__(self, limits: Dict[str, Tuple[int, float]]):
+        """
+        Args:
+            limits: värd -> (antal anrop, per antal sekunder); värdar som saknas begränsas inte
+        """
+        self.limits = dict(limits)
+        self._buckets: Dict[str, _Bucket] = {}
+        self._condition = threading.Condition()
+        self._counter = itertools.count()
+
+    def _bucket(self, host: str) -> Optional[_Bucket]:
+        bucket = self._buckets.get(host)
+        if bucket is None and host in self.limits:
+            bucket = _Bucket(*self.limits[host])
+            self._buckets[host] = bucket
+        return bucket
+
+    def acquire(self, host: str, priority: int = INTERACTIVE):
+        """
+        Väntar tills värden har en ledig token och anropet står först i kön
+
+        Anrop med lägre prioritetsvärde går först; lika prioritet tas i
+        ankomstordning.
+        """
+        with self._condition:
+            bucket = self._bucket(host)
+            if bucket is None:
+                return
+
+            entry = (priority, next(self._counter))
+            heapq.heappush(bucket.queue, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    bucket.refill(now)
+                    wait = bucket.wait_time(now)
+                    if bucket.queue[0] == entry and wait <= 0:
+                        heapq.heappop(bucket.queue)
+                        bucket.tokens -= 1
+                        return
+                    # Den som står först väntar på token, övriga på att kön rör sig
+                    self._condition.wait(timeout=wait if bucket.queue[0] == entry else None)
+            except BaseException:
+                if entry in bucket.queue:
+                    bucket.queue.remove(entry)
+                    heapq.heapify(bucket.queue)
+                raise
+            finally:
+                self._condition.notify_all()
+
+    def pause(self, host: str, seconds: float):
+        """Pausar värden (t.ex. efter 429 med Retry-After) och tömmer hinken"""
+        with self._condition:
+            bucket = self._bucket(host)
+            if bucket is None:
+                return
+            now = time.monotonic()
+            bucket.refill(now)
+            bucket.paused_until = max(bucket.paused_until, now + seconds)
+            bucket.tokens = 0.0
+            self._condition.notify_all()
+
+    def queue_depth(self) -> Dict[str, int]:
+        """Antal väntande anrop per begränsad värd"""
+        with self._condition:
+            return {host: len(bucket.queue) for host, bucket in self._buckets.items()}
@@ -0,0 +1,90 @@
+"""
+Stale-while-revalidate för diskcacharna
+
+När en cachepost passerat sin TTL serveras den ändå direkt och markeras som
+inaktuell, medan en uppdatering körs i transportens trådpool. Samtidiga
+uppdateringar av samma nyckel slås ihop till en, så att flera sessioner som
+läser samma inaktuella data bara ger ett anrop mot SCB eller Kolada.
+"""
+
+import threading
+import time
+from typing import Callable, Hashable, Iterable, List, Optional
+
+from data import http_transport
+
+_lock = threading.Lock()
+_pending = set()
+
+
+def refresh_in_background(key: Hashable, func: Callable[[], None]) -> bool:
+    """
+    Kör func i bakgrunden om ingen uppdatering av key redan pågår
+
+    Fel skrivs ut och sväljs, eftersom den inaktuella posten fortfarande
+    finns kvar och kan serveras.
+
+    Returns:
+        True om en ny uppdatering startades
+    """
+    return bool(refresh_many_in_background([key], lambda claimed: func()))
+
+
+def refresh_many_in_background(keys: Iterable[Hashable], func: Callable[[List], None]) -> List:
+    """
+    Uppdaterar flera nycklar i en gemensam bakgrundskörning
+
+    Nycklar som redan uppdateras hoppas över. func anropas med de nycklar som
+    återstår, så att de kan hämtas batchat i ett anrop.
+
+    Returns:
+        Nycklarna som den här körningen tog ansvar för
+    """
+    with _lock:
+        claimed = [key for key in dict.fromkeys(keys) if key not in _pending]
+        _pending.update(claimed)
+    if not claimed:
+        return claimed
+
+    def run():
+        try:
+            with http_transport.priority(http_transport.BACKGROUND):
+                func(claimed)
+        except Exception as e:
+            print(f"⚠️ Bakgrundsuppdatering misslyckades: {e}")
+        finally:
+            with _lock:
+                _pending.difference_update(claimed)
+
+    http_transport.get_executor().submit(run)
+    return claimed
+
+
+def is_refreshing(key: Hashable) -> bool:
+    """True om en bakgrundsuppdatering av key pågår"""
+    with _lock:
+        return key in _pending
+
+
+def describe_age(fetched_at: Optional[float], stale: bool = False) -> str:
+    """
+    Kort text om hur gammal data är, för visning i gränssnittet
+
+    Args:
+        fetched_at: Hämtningstid (Unix-tid) eller None om okänd
+        stale: True om datan är äldre än sin TTL
+    """
+    if fetched_at is None:
+        return "Hämtningstid okänd"
+
+    age = max(0, time.time() - fetched_at)
+    if age < 3600:
+        text = f"Data hämtad för {int(age // 60)} min sedan"
+    elif age < 86400:
+        text = f"Data hämtad för {int(age // 3600)} h sedan"
+    else:
+        text = f"Data hämtad för {int(age // 86400)} dagar sedan"
+
+    if stale:
+        text += " – uppdateras i bakgrunden"
+    return text
@@ -7,10 +7,18 @@ import requests
 import pandas as pd
 import json
 import os
+import time
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
 import streamlit as st
 
+from data import age_bins, cache_store, http_transport, pxweb, revalidate, scb_metadata, single_flight
+from data.cache_store import CacheEntry
+from data.cache_keys import adopt_legacy_entry, migrate_legacy_cache, query_digest
+from data.population_cube import ENDPOINT as POPULATION_ENDPOINT, PopulationCube, get_cube as get_population_cube
+from data.pxweb_v2 import PxWebV2Client
+from data.scb_query import MAX_CELLS, merge_responses, split_query, validate_query
+
 
 class SCBConnector:
     """Komplett SCB API-integration med caching"""
@@ -20,6 +28,13 @@ class SCBConnector:
         self.cache_dir = cache_dir
         self.cache_days = 7  # Cache i 7 dagar
         self.timeout = 30
+        self.stale_while_revalidate = True  # Servera inaktuell cache direkt och uppdatera i bakgrunden
+        self._data_ages: Dict[str, Dict] = {}
+        self.max_cells = MAX_CELLS  # Större frågor delas upp automatiskt
+        self.response_format = "json-stat2"  # Tät värdevektor; json används som reserv
+        self.api_version = "v2"  # GET-uttag via PxWebApi 2.0 där tabellen stöds, annars v1
+        self.v2 = PxWebV2Client(timeout=self.timeout)
+        self.metadata_recheck_seconds = 3600  # Ogiltig fråga: hämta om metadata äldre än så
         
         # Kommuner
         self.KUNGSBACKA_KOD = "1384"
@@ -33,211 +48,400 @@ class SCBConnector:
         }
         
         os.makedirs(cache_dir, exist_ok=True)
+        migrate_legacy_cache(cache_dir)
+        self.cache = cache_store.get_store(cache_dir)
+        self._flight = single_flight.get_flight(cache_dir, "scb")
+        self._metadata = scb_metadata.get_cache(cache_dir)
+    
+    @property
+    def population_cube(self) -> PopulationCube:
+        """Befolkning per ålder, kön och år, fylls på lokalt istället för smala utsnitt"""
+        return get_population_cube(
+            self.cache_dir,
+            lambda endpoint, query: self.get_data(endpoint, query, allow_stale=False),
+            lambda: self.get_variable_values(POPULATION_ENDPOINT, "Tid")
+        )
     
     def _get_cache_path(self, endpoint: str, params_hash: str) -> str:
         """Skapar cache-filväg"""
         safe_endpoint = endpoint.replace('/', '_')
         return os.path.join(self.cache_dir, f"scb_{safe_endpoint}_{params_hash}.json")
     
-    def _is_cache_valid(self, cache_path: str) -> bool:
-        """Kontrollerar om cache är giltig"""
-        if not os.path.exists(cache_path):
-            return False
-        
-        modified_time = datetime.fromtimestamp(os.path.getmtime(cache_path))
-        age = datetime.now() - modified_time
-        
-        return age < timedelta(days=self.cache_days)
+    def _load_cache(self, cache_path: str) -> Optional[CacheEntry]:
+        """Läser en post ur den gemensamma cachen (inaktuell efter cache_days)"""
+        return self.cache.get("scb", os.path.basename(cache_path), max_age=self.cache_days * 86400)
     
-    def _load_cache(self, cache_path: str) -> Optional[dict]:
-        """Laddar data från cache"""
-        try:
-            with open(cache_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"⚠️ Cache-läsfel: {e}")
-            return None
-    
-    def _save_cache(self, cache_path: str, data: dict):
-        """Sparar data till cache"""
-        try:
-            with open(cache_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"⚠️ Cache-skrivfel: {e}")
+    def _save_cache(self, cache_path: str, data: dict, validators: Dict = None) -> bool:
+        """Sparar data i den gemensamma cachen (False om innehållet var oförändrat)"""
+        return self.cache.put("scb", os.path.basename(cache_path), data, validators=validators)
     
     def _fetch_from_api(self, endpoint: str, query: dict) -> dict:
-        """Hämtar data från SCB API"""
+        """Hämtar data från SCB API (v2 med GET om möjligt, annars v1 med POST)"""
+        return self._fetch_from_api_conditional(endpoint, query)[0]
+    
+    def _fetch_from_api_conditional(self, endpoint: str, query: dict,
+                                    validators: Dict = None) -> Tuple[Optional[dict], Dict]:
+        """
+        Som _fetch_from_api, men med svarets validerare och villkorlig GET i v2
+        
+        v1-anropen är POST och kan inte villkoras (en matchande If-None-Match
+        ger 412 på POST), så där avgörs oförändrade svar av innehållshashen i
+        cachen istället.
+        
+        Returns:
+            (svar, validerare), där svaret är None om v2 svarade 304
+        """
+        if self.api_version == "v2":
+            try:
+                result = self.v2.fetch_conditional(endpoint, self._complete_query(endpoint, query), validators)
+                if result is not None:
+                    return result
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"⚠️ PxWebApi v2 misslyckades för {endpoint}, använder v1: {e}")
+        
         url = f"{self.base_url}/{endpoint}"
         
         try:
-            response = requests.post(
+            response = http_transport.post(
                 url,
                 json=query,
                 headers={"User-Agent": "Kungsbacka-Dashboard/2.0"},
                 timeout=self.timeout
             )
             response.raise_for_status()
-            return response.json()
+            if self._response_format(query) == "csv":
+                # CSV sparas inslaget så att diskcachen kan fortsätta vara JSON
+                return {"csv": response.text}, {}
+            return response.json(), {}
         
         except requests.exceptions.RequestException as e:
             print(f"❌ SCB API-fel: {e}")
             raise
     
-    def get_data(self, endpoint: str, query: dict, use_cache: bool = True) -> dict:
-        """Generisk metod för att hämta data med cache"""
-        params_hash = str(hash(json.dumps(query, sort_keys=True)))
-        cache_path = self._get_cache_path(endpoint, params_hash)
+    def _complete_query(self, endpoint: str, query: dict) -> dict:
+        """
+        Frågan med alla värden utskrivna för utelämnade variabler som inte kan elimineras
+        
+        v1 väljer alla värden för sådana variabler, medan v2 använder tabellens
+        standardurval, så de skrivs ut innan frågan skickas till v2.
+        """
+        selected = {s.get("code") for s in query.get("query", [])}
+        missing = [
+            {"code": variable["code"], "selection": {"filter": "all", "values": ["*"]}}
+            for variable in (self.get_metadata(endpoint) or {}).get("variables", [])
+            if variable.get("code") not in selected and not variable.get("elimination")
+        ]
+        return {**query, "query": query.get("query", []) + missing} if missing else query
+    
+    @staticmethod
+    def _response_format(query: dict) -> str:
+        """Svarsformatet som en fråga begär"""
+        return query.get("response", {}).get("format", "json")
+    
+    @staticmethod
+    def _with_format(query: dict, response_format: str) -> dict:
+        """Kopia av frågan med ett annat svarsformat"""
+        return {**query, "response": {**query.get("response", {}), "format": response_format}}
+    
+    def get_metadata(self, endpoint: str, max_age: float = None) -> Optional[dict]:
+        """
+        Hämtar tabellens metadata (variabler och deras värden)
         
-        # Försök läsa från cache
-        if use_cache:
-            cached_data = self._load_cache(cache_path)
-            if cached_data and self._is_cache_valid(cache_path):
-                return cached_data
+        Metadatan cachas på disk i scb_metadata.METADATA_TTL (max_age sekunder
+        om angivet) och delas mellan processer.
+        """
+        url = f"{self.base_url}/{endpoint}"
         
-        # Hämta från API
-        data = self._fetch_from_api(endpoint, query)
+        def fetch():
+            response = http_transport.get(url, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
         
-        # Spara till cache
-        if use_cache:
-            self._save_cache(cache_path, data)
+        return self._metadata.get(url, fetch, max_age=max_age)
+    
+    def get_variable_values(self, endpoint: str, code: str) -> List[str]:
+        """Värdekoder för en variabel enligt tabellens metadata (tom om okänd)"""
+        for variable in (self.get_metadata(endpoint) or {}).get("variables", []):
+            if variable.get("code") == code:
+                return list(variable.get("values", []))
+        return []
+    
+    def validate(self, endpoint: str, query: dict) -> List[str]:
+        """
+        Kontrollerar en fråga mot tabellens metadata innan den skickas
+        
+        Ger frågan fel mot metadata som hunnit bli en stund gammal hämtas
+        metadatan om en gång, ifall SCB har bytt koder sedan den sparades.
+        
+        Returns:
+            Lista med fel (tom om frågan är giltig eller metadata saknas)
+        """
+        metadata = self.get_metadata(endpoint)
+        if not metadata:
+            return []
+        problems = validate_query(query, metadata)
+        age = self._metadata.age(f"{self.base_url}/{endpoint}")
+        if problems and age is not None and age > self.metadata_recheck_seconds:
+            metadata = self.get_metadata(endpoint, max_age=0)
+            problems = validate_query(query, metadata) if metadata else []
+        return problems
+    
+    def _fetch_query(self, endpoint: str, query: dict) -> dict:
+        """
+        Hämtar en fråga, uppdelad i delfrågor om den överskrider cellgränsen
+        
+        Delfrågorna körs parallellt och svaren slås ihop till ett. Utan
+        metadata skickas frågan som den är. Om SCB inte kan leverera det
+        begärda formatet hämtas frågan som json istället.
+        
+        Raises:
+            ValueError: Om frågan inte stämmer med tabellens metadata (skickas inte)
+        """
+        return self._fetch_query_conditional(endpoint, query)[0]
+    
+    def _fetch_query_conditional(self, endpoint: str, query: dict,
+                                 validators: Dict = None) -> Tuple[Optional[dict], Dict]:
+        """
+        Som _fetch_query, men villkorlig mot validators när frågan går i ett anrop
+        
+        Returns:
+            (svar, validerare), där svaret är None om det är oförändrat (304)
+        """
+        problems = self.validate(endpoint, query)
+        if problems:
+            raise ValueError(f"Ogiltig SCB-fråga mot {endpoint}: {'; '.join(problems)}")
+        
+        metadata = self.get_metadata(endpoint)
+        parts = split_query(query, metadata, self.max_cells) if metadata else [query]
+        if len(parts) == 1:
+            response_format = self._response_format(query)
+            try:
+                return self._fetch_from_api_conditional(endpoint, query, validators)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                client_error = status is not None and 400 <= status < 500
+                if response_format == "json" or not (client_error or isinstance(e, ValueError)):
+                    raise
+                print(f"⚠️ SCB kunde inte svara i formatet {response_format}, hämtar som json")
+                return self._fetch_from_api(endpoint, self._with_format(query, "json")), {}
+        
+        # Delsvaren slås ihop rad för rad, vilket kräver formatet json
+        parts = [self._with_format(part, "json") for part in parts]
+        print(f"🔄 Delar upp SCB-fråga mot {endpoint} i {len(parts)} delar")
+        responses = http_transport.map_concurrent(lambda part: self._fetch_from_api(endpoint, part), parts)
+        return merge_responses(responses), {}
+    
+    def get_data(self, endpoint: str, query: dict, use_cache: bool = True,
+                 response_format: str = None, allow_stale: bool = True) -> dict:
+        """
+        Generisk metod för att hämta data med cache
+        
+        Args:
+            endpoint: Tabellens sökväg under base_url
+            query: PxWeb-fråga (svarsformatet i frågan ersätts)
+            use_cache: Läs och skriv diskcachen
+            response_format: "json-stat2", "json" eller "csv" (default: self.response_format)
+            allow_stale: Servera en inaktuell post medan den uppdateras (False: vänta på SCB)
+        
+        Returns:
+            Svaret som det kom från SCB; avkodas med pxweb.decode (csv: pxweb.decode_csv).
+            En json-stat2-fråga kan besvaras med json om bara det formatet finns i cachen
+        """
+        response_format = response_format or self.response_format
+        if response_format not in pxweb.FORMATS:
+            raise ValueError(f"Okänt svarsformat: {response_format}")
+        query = self._with_format(query, response_format)
+        cache_path = self._get_cache_path(endpoint, query_digest(endpoint, query))
         
+        # Försök läsa från cache
+        if use_cache:
+            if not os.path.exists(cache_path) and response_format != "csv":
+                # Svar från de gamla hash()-nycklarna har formatet json och tas
+                # över under json-frågans nyckel, inte den begärda
+                json_query = self._with_format(query, "json")
+                json_path = self._get_cache_path(endpoint, query_digest(endpoint, json_query))
+                if not os.path.exists(json_path):
+                    adopt_legacy_entry(self.cache_dir, endpoint, json_query, json_path)
+                if json_path != cache_path:
+                    # pxweb.decode tolkar båda formaten, så ett färskt json-svar
+                    # används tills frågan hämtats i det begärda formatet
+                    cached = self._load_cache(json_path)
+                    if cached and cached.value and not cached.stale:
+                        self._record_age(endpoint, json_path, cached.fetched_at, stale=False)
+                        return cached.value
+            cached = self._load_cache(cache_path)
+            if cached and cached.value:
+                if not cached.stale:
+                    self._record_age(endpoint, cache_path, cached.fetched_at, stale=False)
+                    return cached.value
+                if self.stale_while_revalidate and allow_stale:
+                    # Inaktuell cache serveras direkt medan SCB frågas i bakgrunden
+                    revalidate.refresh_in_background(
+                        cache_path,
+                        lambda: self._fetch_shared(endpoint, query, cache_path)
+                    )
+                    self._record_age(endpoint, cache_path, cached.fetched_at, stale=True)
+                    return cached.value
+        
+        if not use_cache:
+            return self._fetch_query(endpoint, query)
+        
+        # Hämta från API (en hämtning per nyckel oavsett antal sessioner och processer)
+        data = self._fetch_shared(endpoint, query, cache_path)
+        self._record_age(endpoint, cache_path, time.time(), stale=False)
         return data
     
-    # ==================== BEFOLKNING ====================
+    def _fetch_shared(self, endpoint: str, query: dict, cache_path: str) -> dict:
+        """
+        Hämtar en fråga och sparar den i cachen, sammanslaget per cachenyckel
+        
+        Samtidiga anrop för samma nyckel väntar på den första hämtningen. Hann
+        en annan arbetsprocess skriva posten medan fillåset väntade används den.
+        Finns posten redan frågas SCB villkorligt med dess validerare, och ett
+        304-svar förlänger posten utan att svaret överförs.
+        """
+        name = os.path.basename(cache_path)
+        
+        def fetch():
+            data, validators = self._fetch_query_conditional(endpoint, query, self.cache.validators(name))
+            if data is None:
+                cached = self._load_cache(cache_path) if self.cache.revalidated(name, validators) else None
+                if cached is not None:
+                    return cached.value
+                # Posten försvann under tiden: hämta hela svaret
+                data, validators = self._fetch_query_conditional(endpoint, query)
+            self._save_cache(cache_path, data, validators)
+            return data
+        
+        def recheck():
+            cached = self._load_cache(cache_path)
+            return cached.value if cached and cached.value and not cached.stale else None
+        
+        return self._flight.do(cache_path, fetch, recheck=recheck)
     
-    def get_population_total(self, kommun_kod: str = None, years: List[str] = None) -> pd.DataFrame:
-        """Hämtar total befolkning per år och kön"""
-        if kommun_kod is None:
-            kommun_kod = self.KUNGSBACKA_KOD
+    def download_table(self, endpoint: str, region: str, use_cache: bool = True) -> pd.DataFrame:
+        """
+        Hämtar hela tabellen för en region (alla värden för övriga variabler)
         
-        if years is None:
-            current_year = datetime.now().year
-            # SCB har ofta endast föregående års data tillgänglig
-            years = [str(y) for y in range(current_year - 10, current_year)]
+        Frågan byggs från tabellens metadata och går via get_data, så den
+        cachas, delas upp vid behov och hämtas med v2 där tabellen stöds.
+        
+        Returns:
+            DataFrame med en kolumn per variabel (koder) och en per innehåll
+        """
+        metadata = self.get_metadata(endpoint)
+        if not metadata:
+            return pd.DataFrame()
         
-        endpoint = "BE/BE0101/BE0101A/BefolkningNy"
         query = {
             "query": [
-                {"code": "Region", "selection": {"filter": "item", "values": [kommun_kod]}},
+                {
+                    "code": variable["code"],
+                    "selection": {"filter": "item", "values": [region]} if variable["code"] == "Region"
+                    else {"filter": "all", "values": ["*"]}
+                }
+                for variable in metadata.get("variables", [])
+            ],
+            "response": {"format": "json"}
+        }
+        return pxweb.decode(self.get_data(endpoint, query, use_cache=use_cache))
+    
+    def _record_age(self, endpoint: str, cache_path: str, fetched_at: float, stale: bool):
+        """Noterar hämtningstid för senast serverade data per endpoint"""
+        self._data_ages[endpoint] = {
+            'fetched_at': fetched_at,
+            'stale': stale,
+            'refreshing': revalidate.is_refreshing(cache_path),
+        }
+    
+    def data_age(self, endpoint: str = None) -> Optional[Dict]:
+        """
+        Hur gammal serverad data är
+        
+        Args:
+            endpoint: Endpoint att fråga om (default: äldsta data som serverats)
+        
+        Returns:
+            Dict med fetched_at, stale och refreshing, eller None om inget serverats
+        """
+        if endpoint is not None:
+            return self._data_ages.get(endpoint)
+        if not self._data_ages:
+            return None
+        return min(self._data_ages.values(), key=lambda a: a['fetched_at'])
+    
+    # ==================== FRÅGOR ====================
+    # Frågorna tar en lista med regioner så att jämförelser kan hämta alla
+    # kommuner i samma anrop som de enskilda hämtningarna använder.
+    
+    @staticmethod
+    def _population_query(regions: List[str], years: List[str]) -> Tuple[str, dict]:
+        """Fråga för total befolkning per region, kön och år"""
+        return "BE/BE0101/BE0101A/BefolkningNy", {
+            "query": [
+                {"code": "Region", "selection": {"filter": "item", "values": list(regions)}},
                 {"code": "Alder", "selection": {"filter": "item", "values": ["tot"]}},
                 {"code": "Kon", "selection": {"filter": "item", "values": ["1", "2"]}},
-                {"code": "Tid", "selection": {"filter": "item", "values": years}}
+                {"code": "Tid", "selection": {"filter": "item", "values": list(years)}}
+            ],
+            "response": {"format": "json"}
+        }
+    
+    @staticmethod
+    def _housing_stock_query(regions: List[str], years: List[str]) -> Tuple[str, dict]:
+        """Fråga för bostadsbestånd per region, hustyp och år"""
+        return "BO/BO0104/BO0104D/BO0104T01", {
+            "query": [
+                {"code": "Region", "selection": {"filter": "item", "values": list(regions)}},
+                {"code": "Hustyp", "selection": {"filter": "item", "values": ["FLERBOST", "SMÅHUS"]}},
+                {"code": "ContentsCode", "selection": {"filter": "item", "values": ["BO0104AG"]}},
+                {"code": "Tid", "selection": {"filter": "item", "values": list(years)}}
             ],
             "response": {"format": "json"}
         }
+    
+    @staticmethod
+    def _new_construction_query(regions: List[str], years: List[str]) -> Tuple[str, dict]:
+        """Fråga för färdigställda bostäder per region, hustyp och år"""
+        return "BO/BO0101/BO0101A/NyByggBostLghAr", {
+            "query": [
+                {"code": "Region", "selection": {"filter": "item", "values": list(regions)}},
+                {"code": "Hustyp", "selection": {"filter": "item", "values": ["FLERB", "SMÅ"]}},
+                {"code": "ContentsCode", "selection": {"filter": "item", "values": ["BO0101N1"]}},  # Färdigställda
+                {"code": "Tid", "selection": {"filter": "item", "values": list(years)}}
+            ],
+            "response": {"format": "json"}
+        }
+    
+    # ==================== BEFOLKNING ====================
+    
+    def get_population_total(self, kommun_kod: str = None, years: List[str] = None) -> pd.DataFrame:
+        """Hämtar total befolkning per år och kön (summerad ur befolkningskuben)"""
+        if kommun_kod is None:
+            kommun_kod = self.KUNGSBACKA_KOD
         
-        data = self.get_data(endpoint, query)
-        
-        # Parsa respons
-        rows = []
-        for item in data.get("data", []):
-            # values[0] är folkmängd, values[1] är folkökning (om det finns)
-            value = item["values"][0]
-            rows.append({
-                "År": item["key"][3],
-                "Kön": "Män" if item["key"][2] == "1" else "Kvinnor",
-                "Antal": int(value) if value != ".." else 0
-            })
+        if years is None:
+            current_year = datetime.now().year
+            # SCB har ofta endast föregående års data tillgänglig
+            years = [str(y) for y in range(current_year - 10, current_year)]
         
-        return pd.DataFrame(rows)
+        return self.population_cube.totals(kommun_kod, years)
     
     def get_age_distribution(self, kommun_kod: str = None, year: str = None) -> pd.DataFrame:
-        """Hämtar åldersfördelning för ett specifikt år"""
+        """Hämtar åldersfördelning i 5-årsgrupper för ett specifikt år (yngst först)"""
         if kommun_kod is None:
             kommun_kod = self.KUNGSBACKA_KOD
         
         if year is None:
             year = str(datetime.now().year - 1)  # Senaste kompletta året
         
-        endpoint = "BE/BE0101/BE0101A/BefolkningNy"
-        
-        # SCB har gräns på antal värden - dela upp i batchar
-        all_rows = []
-        
-        # Batch åldrar i grupper om 50
-        for batch_start in range(0, 100, 50):
-            batch_end = min(batch_start + 50, 100)
-            ages = [str(i) for i in range(batch_start, batch_end)]
-            
-            query = {
-                "query": [
-                    {"code": "Region", "selection": {"filter": "item", "values": [kommun_kod]}},
-                    {"code": "Alder", "selection": {"filter": "item", "values": ages}},
-                    {"code": "Kon", "selection": {"filter": "item", "values": ["1", "2"]}},
-                    {"code": "Tid", "selection": {"filter": "item", "values": [year]}}
-                ],
-                "response": {"format": "json"}
-            }
-            
-            try:
-                data = self.get_data(endpoint, query)
-                
-                # Parsa respons och gruppera i åldersintervall
-                for item in data.get("data", []):
-                    age = item["key"][1]
-                    if age == "100+":
-                        age_num = 100
-                    else:
-                        age_num = int(age)
-                    
-                    # Gruppera i 5-årsintervall
-                    if age_num < 5:
-                        age_group = "0-4"
-                    elif age_num < 10:
-                        age_group = "5-9"
-                    elif age_num < 15:
-                        age_group = "10-14"
-                    elif age_num < 20:
-                        age_group = "15-19"
-                    elif age_num < 25:
-                        age_group = "20-24"
-                    elif age_num < 30:
-                        age_group = "25-29"
-                    elif age_num < 35:
-                        age_group = "30-34"
-                    elif age_num < 40:
-                        age_group = "35-39"
-                    elif age_num < 45:
-                        age_group = "40-44"
-                    elif age_num < 50:
-                        age_group = "45-49"
-                    elif age_num < 55:
-                        age_group = "50-54"
-                    elif age_num < 60:
-                        age_group = "55-59"
-                    elif age_num < 65:
-                        age_group = "60-64"
-                    elif age_num < 70:
-                        age_group = "65-69"
-                    elif age_num < 75:
-                        age_group = "70-74"
-                    elif age_num < 80:
-                        age_group = "75-79"
-                    elif age_num < 85:
-                        age_group = "80-84"
-                    elif age_num < 90:
-                        age_group = "85-89"
-                    elif age_num < 95:
-                        age_group = "90-94"
-                    else:
-                        age_group = "95+"
-                    
-                    value = item["values"][0]
-                    all_rows.append({
-                        "Åldersgrupp": age_group,
-                        "Kön": "Män" if item["key"][2] == "1" else "Kvinnor",
-                        "Antal": int(value) if value != ".." else 0
-                    })
-            except Exception as e:
-                print(f"⚠️ Fel vid hämtning av åldrar {batch_start}-{batch_end}: {e}")
-        
-        # Aggregera per åldersgrupp
-        df = pd.DataFrame(all_rows)
-        if not df.empty:
-            df = df.groupby(["Åldersgrupp", "Kön"], as_index=False)["Antal"].sum()
-        
-        return df
+        try:
+            # Alla åldrar ur befolkningskuben, summerade per 5-årsgrupp
+            df = self.population_cube.binned(kommun_kod, [year], age_bins.FIVE_YEAR)
+            return df[["Åldersgrupp", "Kön", "Antal"]].astype({"Åldersgrupp": str})
+        except Exception as e:
+            print(f"⚠️ Fel vid hämtning av åldersfördelning: {e}")
+            return pd.DataFrame(columns=["Åldersgrupp", "Kön", "Antal"])
     
     def get_population_change(self, kommun_kod: str = None, years: List[str] = None) -> pd.DataFrame:
         """Hämtar befolkningsförändringar (födda, döda, inflyttade, utflyttade)"""
@@ -264,7 +468,6 @@ class SCBConnector:
             
             # Parsa respons - ny struktur
             # Key[0]=Region, Key[1]=Förändringskod, Key[2]=Period, Key[3]=År
-            rows = []
             forandringar_map = {
                 "110": "Folkökning",
                 "115": "Födda",
@@ -275,20 +478,15 @@ class SCBConnector:
                 "230": "Flyttnetto"
             }
             
-            for item in data.get("data", []):
-                period = item["key"][2]
-                # Filtrera endast helårsdata
-                if period == "hel":
-                    forandring_code = item["key"][1]
-                    # Bara relevanta koder
-                    if forandring_code in forandringar_map:
-                        rows.append({
-                            "År": item["key"][3],
-                            "Typ": forandringar_map[forandring_code],
-                            "Antal": int(item["values"][0]) if item["values"][0] != ".." else 0
-                        })
+            df = pxweb.decode(data, names=["Region", "Typ", "Period", "År"], value_names=["Antal"])
             
-            return pd.DataFrame(rows)
+            # Endast helårsdata och relevanta koder
+            df = df[(df["Period"] == "hel") & df["Typ"].isin(list(forandringar_map))]
+            return pd.DataFrame({
+                "År": df["År"].astype(str),
+                "Typ": df["Typ"].astype(str).map(forandringar_map),
+                "Antal": pxweb.counts(df["Antal"])
+            }).reset_index(drop=True)
         
         except Exception as e:
             print(f"⚠️ Kunde inte hämta befolkningsförändringar: {e}")
@@ -306,32 +504,19 @@ class SCBConnector:
             # Använd bara år där data finns (2013-2024)
             years = [str(y) for y in range(max(2013, current_year - 5), min(2025, current_year + 1))]
         
-        endpoint = "BO/BO0104/BO0104D/BO0104T01"
-        query = {
-            "query": [
-                {"code": "Region", "selection": {"filter": "item", "values": [kommun_kod]}},
-                {"code": "Hustyp", "selection": {"filter": "item", "values": ["FLERBOST", "SMÅHUS"]}},
-                {"code": "ContentsCode", "selection": {"filter": "item", "values": ["BO0104AG"]}},
-                {"code": "Tid", "selection": {"filter": "item", "values": years}}
-            ],
-            "response": {"format": "json"}
-        }
+        endpoint, query = self._housing_stock_query([kommun_kod], years)
         
         try:
             data = self.get_data(endpoint, query)
             
             # Parsa respons
-            rows = []
             hustyp_mapping = {"FLERBOST": "Flerbostadshus", "SMÅHUS": "Småhus"}
-            
-            for item in data.get("data", []):
-                rows.append({
-                    "År": item["key"][2],  # Index 2 är år i denna tabell
-                    "Hustyp": hustyp_mapping.get(item["key"][1], item["key"][1]),
-                    "Antal": int(item["values"][0]) if item["values"][0] != ".." else 0
-                })
-            
-            return pd.DataFrame(rows)
+            df = pxweb.decode(data, labels={"Hustyp": hustyp_mapping}, value_names=["Antal"])
+            return pd.DataFrame({
+                "År": df["Tid"].astype(str),
+                "Hustyp": df["Hustyp"].astype(str),
+                "Antal": pxweb.counts(df["Antal"])
+            })
         
         except Exception as e:
             print(f"⚠️ Kunde inte hämta bostadsbestånd: {e}")
@@ -346,32 +531,19 @@ class SCBConnector:
             current_year = datetime.now().year
             years = [str(y) for y in range(current_year - 5, current_year)]
         
-        endpoint = "BO/BO0101/BO0101A/NyByggBostLghAr"
-        query = {
-            "query": [
-                {"code": "Region", "selection": {"filter": "item", "values": [kommun_kod]}},
-                {"code": "Hustyp", "selection": {"filter": "item", "values": ["FLERB", "SMÅ"]}},
-                {"code": "ContentsCode", "selection": {"filter": "item", "values": ["BO0101N1"]}},  # Färdigställda
-                {"code": "Tid", "selection": {"filter": "item", "values": years}}
-            ],
-            "response": {"format": "json"}
-        }
+        endpoint, query = self._new_construction_query([kommun_kod], years)
         
         try:
             data = self.get_data(endpoint, query)
             
             # Parsa respons
-            rows = []
             hustyp_mapping = {"FLERB": "Flerbostadshus", "SMÅ": "Småhus"}
-            
-            for item in data.get("data", []):
-                rows.append({
-                    "År": item["key"][3],
-                    "Hustyp": hustyp_mapping.get(item["key"][1], item["key"][1]),
-                    "Antal": int(item["values"][0]) if item["values"][0] != ".." else 0
-                })
-            
-            return pd.DataFrame(rows)
+            df = pxweb.decode(data, labels={"Hustyp": hustyp_mapping}, value_names=["Antal"])
+            return pd.DataFrame({
+                "År": df["Tid"].astype(str),
+                "Hustyp": df["Hustyp"].astype(str),
+                "Antal": pxweb.counts(df["Antal"])
+            })
         
         except Exception as e:
             print(f"⚠️ Kunde inte hämta nybyggnation: {e}")
@@ -379,28 +551,56 @@ class SCBConnector:
     
     # ==================== JÄMFÖRELSER ====================
     
+    # Nyckeltal som kan jämföras: metric -> fråga (summeras per region)
+    COMPARISON_METRICS = {
+        "befolkning": "_population_query",
+        "bostadsbestand": "_housing_stock_query",
+        "nybyggnation": "_new_construction_query",
+    }
+    
     def compare_municipalities(self, metric: str, kommun_koder: List[str] = None, year: str = None) -> pd.DataFrame:
-        """Jämför kommuner för ett specifikt nyckeltal"""
+        """
+        Jämför kommuner för ett specifikt nyckeltal
+        
+        Alla kommuner hämtas i en fråga (delas upp av get_data om den blir för
+        stor), och värdet summeras per kommun över kön respektive hustyp.
+        
+        Args:
+            metric: "befolkning", "bostadsbestand" eller "nybyggnation"
+            kommun_koder: Kommunkoder att jämföra (default: Hallands kommuner)
+            year: År att jämföra (default: föregående år)
+        
+        Returns:
+            DataFrame med Kommun, Kod och Värde, i samma ordning som kommun_koder
+        """
         if kommun_koder is None:
             kommun_koder = list(self.HALLAND_KOMMUNER.keys())
         
         if year is None:
             year = str(datetime.now().year - 1)
         
-        if metric == "befolkning":
-            results = []
-            for kod in kommun_koder:
-                df = self.get_population_total(kod, [year])
-                if not df.empty:
-                    total = df['Antal'].sum()
-                    results.append({
-                        "Kommun": self.HALLAND_KOMMUNER.get(kod, kod),
-                        "Kod": kod,
-                        "Värde": total
-                    })
-            return pd.DataFrame(results)
-        
-        return pd.DataFrame()
+        builder = self.COMPARISON_METRICS.get(metric)
+        if builder is None or not kommun_koder:
+            return pd.DataFrame()
+        
+        endpoint, query = getattr(self, builder)(kommun_koder, [year])
+        try:
+            data = self.get_data(endpoint, query)
+            df = pxweb.decode(data, value_names=["Värde"])
+        except Exception as e:
+            print(f"⚠️ Kunde inte jämföra kommuner ({metric}): {e}")
+            return pd.DataFrame()
+        
+        if df.empty:
+            return pd.DataFrame()
+        
+        totals = pxweb.counts(df["Värde"]).groupby(df["Region"].astype(str)).sum()
+        codes = [kod for kod in kommun_koder if kod in totals.index]
+        return pd.DataFrame({
+            "Kommun": [self.HALLAND_KOMMUNER.get(kod, kod) for kod in codes],
+            "Kod": codes,
+            "Värde": totals.loc[codes].to_numpy()
+        })
     
     def get_kommun_namn(self, kod: str) -> str:
         """Hämtar kommunnamn från kod"""
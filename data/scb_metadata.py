@@ -0,0 +1,107 @@
+"""
+Diskcache för PxWeb-tabellers metadata
+
+Metadatan (variabler, deras koder och värden) ändras sällan men behövs för
+att validera och dela upp frågor innan de skickas. Den hämtas därför en gång
+per tabell och sparas som en fil i cachekatalogen med hämtningstid, så att
+alla sidor och processer delar den tills TTL:en gått ut. Går en ny hämtning
+inte att göra serveras den inaktuella metadatan hellre än ingen alls. Filerna
+skrivs i samma komprimerade format som den gemensamma cachen.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from data import cache_store
+
+METADATA_TTL = 7 * 86400  # Tabellernas variabler ändras sällan
+METADATA_PREFIX = "scb_meta_"
+
+
+class MetadataCache:
+    """Metadata per tabell-URL, i minnet och på disk"""
+
+    def __init__(self, cache_dir: str = "cache", ttl: float = METADATA_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self._entries: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, url: str) -> str:
+        digest = hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.cache_dir, f"{METADATA_PREFIX}{digest}.json")
+
+    def _load(self, url: str) -> Optional[Dict]:
+        """Posten för url från minnet eller disken"""
+        entry = self._entries.get(url)
+        if entry is not None:
+            return entry
+        try:
+            with open(self._path(url), "rb") as f:
+                entry = cache_store.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        self._entries[url] = entry
+        return entry
+
+    def _store(self, url: str, metadata: Dict):
+        entry = {"url": url, "fetched_at": time.time(), "metadata": metadata}
+        self._entries[url] = entry
+        try:
+            cache_store.write_atomic(self._path(url), cache_store.dumps(entry))
+        except OSError as e:
+            print(f"⚠️ Kunde inte spara metadata: {e}")
+
+    def age(self, url: str) -> Optional[float]:
+        """Sekunder sedan metadatan för url hämtades, eller None om den saknas"""
+        with self._lock:
+            entry = self._load(url)
+        return None if entry is None else time.time() - entry["fetched_at"]
+
+    def get(self, url: str, fetch: Callable[[], Dict], max_age: Optional[float] = None) -> Optional[Dict]:
+        """
+        Metadata för en tabell, hämtad med fetch när cachen saknas eller är för gammal
+
+        Args:
+            url: Tabellens URL (cachenyckel)
+            fetch: Hämtar metadatan; får kasta vid fel
+            max_age: Största tillåtna ålder i sekunder (default: ttl, 0 tvingar en hämtning)
+
+        Returns:
+            Metadatan, inaktuell metadata om hämtningen misslyckas, eller None
+        """
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            entry = self._load(url)
+        if entry is not None and time.time() - entry["fetched_at"] < max_age:
+            return entry["metadata"]
+
+        try:
+            metadata = fetch()
+        except Exception as e:
+            if entry is not None:
+                print(f"⚠️ Kunde inte uppdatera metadata, använder sparad: {e}")
+                return entry["metadata"]
+            print(f"⚠️ Kunde inte hämta metadata för {url}: {e}")
+            return None
+
+        with self._lock:
+            self._store(url, metadata)
+        return metadata
+
+
+_caches: Dict[str, MetadataCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(cache_dir: str = "cache") -> MetadataCache:
+    """Processgemensam metadatacache för en cachekatalog"""
+    with _caches_lock:
+        cache = _caches.get(cache_dir)
+        if cache is None:
+            cache = _caches[cache_dir] = MetadataCache(cache_dir)
+        return cache
@@ -0,0 +1,169 @@
+"""
+Uppdelning av stora PxWeb-frågor
+
+SCB:s API svarar med fel när en fråga ger fler celler än tillåtet. Här räknas
+antalet celler ut från tabellens metadata (antal värden per variabel) och
+frågan delas vid behov längs sin största dimension tills varje delfråga
+håller sig under gränsen. Delsvaren slås sedan ihop till ett svar med samma
+form som om frågan ställts på en gång.
+
+Samma metadata används för att validera frågan lokalt innan den skickas, så
+att en felstavad kod eller ett värde som bytt namn ger ett fel direkt
+istället för ett misslyckat anrop.
+"""
+
+import copy
+import fnmatch
+import math
+from typing import Dict, List, Optional
+
+# SCB:s gräns är 150 000 celler per fråga. Vi delar medvetet redan vid
+# 100 000 som säkerhetsmarginal, eftersom cellräkningen här bygger på
+# metadata och gränsen kan sänkas utan förvarning.
+MAX_CELLS = 100_000
+
+
+def _variables(metadata: Dict) -> Dict[str, Dict]:
+    """Tabellens variabler per kod"""
+    return {v.get("code"): v for v in metadata.get("variables", [])}
+
+
+def resolve_values(selection: Dict, variable: Dict) -> Optional[List[str]]:
+    """
+    Explicita värden för ett urval, eller None om de inte kan avgöras
+
+    Hanterar filtren item, all (med jokertecken, t.ex. * eller 20*) och top.
+    Övriga filter (t.ex. agg: och vs:) lämnas som de är eftersom deras värden
+    inte finns i metadatan.
+    """
+    spec = selection.get("selection", {})
+    filter_type = spec.get("filter", "item")
+    values = spec.get("values", [])
+    all_values = variable.get("values", [])
+
+    if filter_type == "item":
+        return list(values)
+    if filter_type == "all":
+        return [v for v in all_values if any(fnmatch.fnmatchcase(v, pattern) for pattern in values)]
+    if filter_type == "top" and values:
+        count = int(values[0])
+        return list(all_values[-count:]) if count else []
+    return None
+
+
+def selection_sizes(query: Dict, metadata: Dict) -> Dict[str, int]:
+    """
+    Antal värden per variabel i svaret
+
+    Variabler som inte finns med i frågan elimineras om tabellen tillåter
+    det, annars räknas alla deras värden.
+    """
+    variables = _variables(metadata)
+    selected = {s.get("code"): s for s in query.get("query", [])}
+    sizes = {}
+
+    for code, variable in variables.items():
+        selection = selected.get(code)
+        if selection is None:
+            sizes[code] = 1 if variable.get("elimination") else len(variable.get("values", []))
+            continue
+        values = resolve_values(selection, variable)
+        sizes[code] = len(values) if values is not None else len(selection.get("selection", {}).get("values", []))
+
+    return sizes
+
+
+def validate_query(query: Dict, metadata: Dict) -> List[str]:
+    """
+    Kontrollerar en fråga mot tabellens metadata utan att skicka den
+
+    Returns:
+        Lista med fel (tom om frågan ser giltig ut)
+    """
+    variables = _variables(metadata)
+    problems = []
+
+    # Variabler som saknas i frågan elimineras eller får alla värden, så bara
+    # de urval som faktiskt skickas kontrolleras
+    for selection in query.get("query", []):
+        code = selection.get("code")
+        variable = variables.get(code)
+        if variable is None:
+            problems.append(f"Okänd variabel {code} (finns: {', '.join(variables)})")
+            continue
+
+        spec = selection.get("selection", {})
+        filter_type = spec.get("filter", "item")
+        values = spec.get("values", [])
+        if filter_type == "top":
+            if len(values) != 1 or not str(values[0]).isdigit():
+                problems.append(f"{code}: top kräver ett heltal, fick {values}")
+            continue
+        if filter_type not in ("item", "all"):
+            continue
+
+        if filter_type == "item":
+            known = set(variable.get("values", []))
+            unknown = [v for v in values if v not in known]
+            if unknown:
+                problems.append(f"{code}: okända värden {unknown}")
+        elif not resolve_values(selection, variable):
+            problems.append(f"{code}: {values} matchar inga värden")
+
+    return problems
+
+
+def cell_count(query: Dict, metadata: Dict) -> int:
+    """Antal celler som frågan ger"""
+    return math.prod(selection_sizes(query, metadata).values())
+
+
+def split_query(query: Dict, metadata: Dict, max_cells: int = MAX_CELLS) -> List[Dict]:
+    """
+    Delar upp en fråga så att varje del ger högst max_cells celler
+
+    Frågan delas längs den största dimension som har explicita värden.
+    Räcker inte det (t.ex. bara ett värde kvar) delas nästa dimension.
+
+    Returns:
+        Lista med delfrågor (bara den ursprungliga frågan om ingen uppdelning behövs)
+    """
+    sizes = selection_sizes(query, metadata)
+    total = math.prod(sizes.values())
+    if total <= max_cells:
+        return [query]
+
+    variables = _variables(metadata)
+    candidates = []
+    for index, selection in enumerate(query.get("query", [])):
+        code = selection.get("code")
+        values = resolve_values(selection, variables.get(code, {}))
+        if values is not None and len(values) > 1:
+            candidates.append((len(values), index, values))
+
+    if not candidates:
+        # Inget att dela längs; låt API:t svara med sitt eget fel
+        return [query]
+
+    size, index, values = max(candidates, key=lambda c: c[0])
+    rest = total // size
+    chunk_size = max(1, max_cells // rest)
+
+    parts = []
+    for start in range(0, size, chunk_size):
+        part = copy.deepcopy(query)
+        part["query"][index]["selection"] = {"filter": "item", "values": values[start:start + chunk_size]}
+        parts.extend(split_query(part, metadata, max_cells))
+    return parts
+
+
+def merge_responses(responses: List[Dict]) -> Dict:
+    """Slår ihop delsvar (samma kolumner) till ett svar"""
+    if not responses:
+        return {}
+    if len(responses) == 1:
+        return responses[0]
+
+    merged = copy.copy(responses[0])
+    merged["data"] = [row for response in responses for row in response.get("data", [])]
+    return merged
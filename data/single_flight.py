@@ -0,0 +1,243 @@
+"""
+Sammanslagning av samtidiga hämtningar av samma nyckel (single flight)
+
+När en cachepost gått ut och flera sessioner öppnar samma sida samtidigt
+skulle var och en hämta samma data och skriva samma cachefil. Här blir den
+första anroparen för en nyckel ägare och gör hämtningen, medan övriga trådar
+i processen väntar på ägarens Future och får samma svar.
+
+Med flera arbetsprocesser (t.ex. flera Streamlit-instanser mot samma
+cachekatalog) tar ägaren dessutom ett fillås innan hämtningen, och kontrollerar
+efter låset om en annan process redan hunnit fylla cachen. Låsen är ett fast
+antal filer per namnrymd (nycklarna fördelas på dem med en hash), så att
+katalogen inte växer med antalet nycklar och SCB- och Koladahämtningar inte
+väntar på varandras lås. En tråd som redan håller en låsfil eller äger en
+nyckel (nästlade anrop) tar dem inte en gång till. Saknas fcntl (Windows)
+slås anrop bara ihop inom processen.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Set
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LOCK_DIR = "locks"
+LOCK_STRIPES = 64
+LOCK_TIMEOUT = 120  # Sekunder; därefter hämtas utan lås hellre än att vänta för evigt
+LOCK_POLL_SECONDS = 0.05
+
+
+def lock_stripe(key: Hashable, stripes: int = LOCK_STRIPES) -> int:
+    """Låsfil för en nyckel (stabil mellan processer, till skillnad från hash())"""
+    digest = hashlib.sha1(repr(key).encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") % stripes
+
+
+class SingleFlight:
+    """En pågående hämtning per nyckel, i processen och (med lock_dir) mellan processer"""
+
+    def __init__(self, lock_dir: Optional[str] = None, stripes: int = LOCK_STRIPES,
+                 timeout: float = LOCK_TIMEOUT, namespace: str = "default"):
+        """
+        Args:
+            lock_dir: Katalog för låsfilerna (None: bara sammanslagning inom processen)
+            stripes: Antal låsfiler som nycklarna fördelas på
+            timeout: Längsta väntan på ett fillås i sekunder
+            namespace: Prefix för låsfilerna, så att olika källor har egna lås
+        """
+        self.lock_dir = lock_dir
+        self.stripes = stripes
+        self.timeout = timeout
+        self.namespace = namespace
+        self._inflight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._calls = 0
+        self._shared = 0
+        if lock_dir is not None:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def _held_stripes(self) -> Set[int]:
+        """Låsfiler som den aktuella tråden redan håller"""
+        held = getattr(self._local, "stripes", None)
+        if held is None:
+            held = self._local.stripes = set()
+        return held
+
+    def _owned_keys(self) -> Set[Hashable]:
+        """Nycklar som den aktuella tråden håller på att hämta"""
+        owned = getattr(self._local, "keys", None)
+        if owned is None:
+            owned = self._local.keys = set()
+        return owned
+
+    @contextmanager
+    def _file_lock(self, keys: Iterable[Hashable]):
+        """
+        Tar låsfilerna för keys i stigande ordning (så att två ägare inte låser varandra)
+
+        Låsfiler som tråden redan håller hoppas över. flock gäller per öppnad
+        fil, så ett andra försök från samma tråd skulle annars vänta på sig
+        självt tills tidsgränsen gått ut.
+        """
+        if self.lock_dir is None or fcntl is None:
+            yield
+            return
+
+        held = self._held_stripes()
+        handles = []
+        acquired = []
+        try:
+            for stripe in sorted({lock_stripe(key, self.stripes) for key in keys} - held):
+                handle = open(os.path.join(self.lock_dir, f"{self.namespace}_{stripe:02d}.lock"), "a+")
+                handles.append(handle)
+                deadline = time.monotonic() + self.timeout
+                while True:
+                    try:
+                        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        held.add(stripe)
+                        acquired.append(stripe)
+                        break
+                    except BlockingIOError:
+                        if time.monotonic() >= deadline:
+                            print(f"⚠️ Fillås {stripe} upptaget i {self.timeout} s, hämtar ändå")
+                            handles.pop().close()
+                            break
+                        time.sleep(LOCK_POLL_SECONDS)
+            yield
+        finally:
+            held.difference_update(acquired)
+            for handle in handles:
+                try:
+                    fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+                finally:
+                    handle.close()
+
+    def do(self, key: Hashable, func: Callable[[], Any],
+           recheck: Optional[Callable[[], Any]] = None) -> Any:
+        """
+        Kör func för key, eller väntar på en hämtning av key som redan pågår
+
+        Args:
+            key: Nyckel för hämtningen (t.ex. cachefilens sökväg)
+            func: Gör hämtningen (och skriver cachen)
+            recheck: Anropas av ägaren när låset tagits; ett svar som inte är
+                None (t.ex. en cachepost som en annan process just skrivit)
+                returneras utan att func körs
+
+        Returns:
+            Svaret från func (eller recheck), samma för alla som väntat
+
+        Raises:
+            Samma undantag som func, även hos dem som väntat
+        """
+        owned_keys = self._owned_keys()
+        if key in owned_keys:
+            # Nästlat anrop från ägaren själv: att vänta på den egna hämtningen låser sig
+            result = recheck() if recheck is not None else None
+            return func() if result is None else result
+
+        with self._lock:
+            self._calls += 1
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+            else:
+                self._shared += 1
+
+        if not owner:
+            return future.result()
+
+        owned_keys.add(key)
+        try:
+            with self._file_lock([key]):
+                result = recheck() if recheck is not None else None
+                if result is None:
+                    result = func()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            owned_keys.discard(key)
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def do_many(self, keys: Iterable[Hashable], func: Callable[[List], None],
+                recheck: Optional[Callable[[List], List]] = None):
+        """
+        Hämtar flera nycklar i ett anrop, utan de som någon annan redan hämtar
+
+        func anropas med nycklarna som ingen annan hämtar, så att de kan
+        hämtas batchat. Därefter väntar anropet på övriga nycklars hämtningar.
+
+        Args:
+            keys: Nycklar som behövs
+            func: Hämtar en lista med nycklar (svaret skrivs till ett lager)
+            recheck: Anropas av ägaren när låsen tagits och returnerar de
+                nycklar som fortfarande behöver hämtas
+        """
+        keys = list(dict.fromkeys(keys))
+        owned_keys = self._owned_keys()
+        # Nycklar som tråden själv redan hämtar (nästlat anrop) hämtas direkt
+        nested = [key for key in keys if key in owned_keys]
+        with self._lock:
+            self._calls += 1
+            waiting = [self._inflight[key] for key in keys if key in self._inflight and key not in owned_keys]
+            claimed = [key for key in keys if key not in self._inflight]
+            owned = {key: Future() for key in claimed}
+            self._inflight.update(owned)
+            if waiting:
+                self._shared += 1
+
+        fetching = claimed + nested
+        owned_keys.update(claimed)
+        try:
+            if fetching:
+                with self._file_lock(fetching):
+                    remaining = recheck(fetching) if recheck is not None else fetching
+                    if remaining:
+                        func(remaining)
+            for future in owned.values():
+                future.set_result(None)
+        except BaseException as e:
+            for future in owned.values():
+                future.set_exception(e)
+            raise
+        finally:
+            owned_keys.difference_update(claimed)
+            with self._lock:
+                for key in claimed:
+                    self._inflight.pop(key, None)
+
+        for future in waiting:
+            future.result()
+
+    def stats(self) -> Dict:
+        """Antal anrop, hur många som delade en annans hämtning och pågående nycklar"""
+        with self._lock:
+            return {"calls": self._calls, "shared": self._shared, "inflight": len(self._inflight)}
+
+
+_flights: Dict[tuple, SingleFlight] = {}
+_flights_lock = threading.Lock()
+
+
+def get_flight(cache_dir: str = "cache", namespace: str = "default") -> SingleFlight:
+    """Processgemensam sammanslagning per namnrymd med låsfiler under cache_dir/locks"""
+    key = (os.path.abspath(cache_dir), namespace)
+    with _flights_lock:
+        flight = _flights.get(key)
+        if flight is None:
+            flight = _flights[key] = SingleFlight(os.path.join(cache_dir, LOCK_DIR), namespace=namespace)
+        return flight
@@ -10,6 +10,8 @@ import os
 import time
 from config import SCB_CONFIG, SCB_TABLES, GIS_SOURCES, EXTERNAL_APIS, get_standard_query, KOMMUN_KOD
 from pathlib import Path
+from data import http_transport, population_cube, pxweb
+from data.circuit_breaker import CircuitOpenError
 
 # PPTX loader (infonet)
 try:
@@ -28,6 +30,15 @@ class SCBDataSource:
         
         # Skapa cache-katalog om den inte finns
         os.makedirs(self.cache_dir, exist_ok=True)
+        self.population_cube = population_cube.get_cube(self.cache_dir, self._fetch_pxweb)
+
+    def _fetch_pxweb(self, endpoint: str, query: Dict) -> Dict:
+        """Hämtar ett PxWeb-svar för befolkningskuben (fel lyfts till anroparen)"""
+        response = http_transport.post(f"{self.base_url}/{endpoint}", json=query,
+                                       headers={"User-Agent": self.user_agent},
+                                       timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
 
     def fetch_population_data(self, region_code: str = "1380") -> pd.DataFrame:
         """Hämtar befolkningsdata från SCB"""
@@ -38,7 +49,7 @@ class SCBDataSource:
             # Standard query för befolkning med aktuella år
             query = get_standard_query("befolkning", region_code)
             
-            response = requests.post(url, json=query, 
+            response = http_transport.post(url, json=query, 
                                    headers={"User-Agent": self.user_agent},
                                    timeout=self.timeout)
             response.raise_for_status()
@@ -59,7 +70,7 @@ class SCBDataSource:
         query = get_standard_query("befolkning", region_code)
         try:
             url = f"{self.base_url}/{endpoint}"
-            response = requests.post(url, json=query, headers={"User-Agent": self.user_agent}, timeout=self.timeout)
+            response = http_transport.post(url, json=query, headers={"User-Agent": self.user_agent}, timeout=self.timeout)
             response.raise_for_status()
             data = response.json()
             return self._parse_population_response(data)
@@ -73,7 +84,7 @@ class SCBDataSource:
             query = get_standard_query("hushall", region_code)
             try:
                 url = f"{self.base_url}/{endpoint}"
-                response = requests.post(url, json=query, headers={"User-Agent": self.user_agent}, timeout=self.timeout)
+                response = http_transport.post(url, json=query, headers={"User-Agent": self.user_agent}, timeout=self.timeout)
                 response.raise_for_status()
                 data = response.json()
                 # Anpassa parser om nödvändigt
@@ -88,7 +99,7 @@ class SCBDataSource:
             query = get_standard_query("bostader", region_code)
             try:
                 url = f"{self.base_url}/{endpoint}"
-                response = requests.post(url, json=query, headers={"User-Agent": self.user_agent}, timeout=self.timeout)
+                response = http_transport.post(url, json=query, headers={"User-Agent": self.user_agent}, timeout=self.timeout)
                 response.raise_for_status()
                 data = response.json()
                 return pd.DataFrame(data.get("data", []))
@@ -102,7 +113,7 @@ class SCBDataSource:
             query = get_standard_query("arbetslöshet", region_code)
             try:
                 url = f"{self.base_url}/{endpoint}"
-                response = requests.post(url, json=query, headers={"User-Agent": self.user_agent}, timeout=self.timeout)
+                response = http_transport.post(url, json=query, headers={"User-Agent": self.user_agent}, timeout=self.timeout)
                 response.raise_for_status()
                 data = response.json()
                 return pd.DataFrame(data.get("data", []))
@@ -116,7 +127,7 @@ class SCBDataSource:
             query = get_standard_query("inkomst", region_code)
             try:
                 url = f"{self.base_url}/{endpoint}"
-                response = requests.post(url, json=query, headers={"User-Agent": self.user_agent}, timeout=self.timeout)
+                response = http_transport.post(url, json=query, headers={"User-Agent": self.user_agent}, timeout=self.timeout)
                 response.raise_for_status()
                 data = response.json()
                 return pd.DataFrame(data.get("data", []))
@@ -130,7 +141,7 @@ class SCBDataSource:
             query = get_standard_query("utbildning", region_code)
             try:
                 url = f"{self.base_url}/{endpoint}"
-                response = requests.post(url, json=query, headers={"User-Agent": self.user_agent}, timeout=self.timeout)
+                response = http_transport.post(url, json=query, headers={"User-Agent": self.user_agent}, timeout=self.timeout)
                 response.raise_for_status()
                 data = response.json()
                 return pd.DataFrame(data.get("data", []))
@@ -141,80 +152,19 @@ class SCBDataSource:
     def fetch_age_distribution(self, region_code: str = "1380") -> pd.DataFrame:
         """Hämtar åldersfördelning från SCB för ålderspyramid"""
         try:
-            # Använd korrekt SCB API URL
-            url = f"{EXTERNAL_APIS['scb']['base_url']}/BE/BE0101/BE0101A/BefolkningNy"
-            
-            # Query för att få åldersfördelning per kön med aktuella år
-            query = {
-                "query": [
-                    {
-                        "code": "Region",
-                        "selection": {"filter": "vs:RegionKommun07", "values": [region_code]}
-                    },
-                    {
-                        "code": "Alder",
-                        "selection": {"filter": "item", "values": [
-                            "0", "1", "2", "3", "4", "5-9", "10-14", "15-19", 
-                            "20-24", "25-29", "30-34", "35-39", "40-44", "45-49",
-                            "50-54", "55-59", "60-64", "65-69", "70-74", "75-79",
-                            "80-84", "85-89", "90-94", "95+"
-                        ]}
-                    },
-                    {
-                        "code": "Kon",
-                        "selection": {"filter": "item", "values": ["1", "2"]}  # Män och kvinnor
-                    },
-                    {
-                        "code": "ContentsCode",
-                        "selection": {"filter": "item", "values": ["BE0101N1"]}
-                    },
-                    {
-                        "code": "Tid",
-                        "selection": {"filter": "item", "values": ["2024", "2023"]}
-                    }
-                ],
-                "response": {"format": "json"}
-            }
-            
-            response = requests.post(url, json=query, 
-                                   headers={"User-Agent": self.user_agent},
-                                   timeout=self.timeout)
-            
-            if response.status_code == 200:
-                data = response.json()
-                return self._parse_age_distribution_response(data)
-            else:
-                # Fallback till grundläggande data
-                print(f"Fel vid hämtning av åldersdata: {response.status_code}")
+            # Ettåriga grupper under 5 år, därefter 5-årsgrupper (summeras ur befolkningskuben)
+            bands = [0, 1, 2, 3, 4] + list(range(5, 100, 5))
+            df = self.population_cube.binned(region_code, ["2024", "2023"], bands)
+            if df.empty:
                 return self._create_dummy_age_data()
+            df = df.rename(columns={"Åldersgrupp": "Ålder"})
+            df.insert(0, "Region", region_code)
+            return df[["Region", "Ålder", "Kön", "År", "Antal"]]
                 
         except Exception as e:
             print(f"Fel vid hämtning av åldersfördelning: {e}")
             return self._create_dummy_age_data()
 
-    def _parse_age_distribution_response(self, data: dict) -> pd.DataFrame:
-        """Parsar SCB-respons för åldersfördelning"""
-        rows = []
-        
-        for item in data.get("data", []):
-            region = item["key"][0]
-            alder = item["key"][1]
-            kon_code = item["key"][2]
-            ar = item["key"][3]
-            antal = int(item["values"][0]) if item["values"][0] != ".." else 0
-            
-            kon = "Män" if kon_code == "1" else "Kvinnor"
-            
-            rows.append({
-                "Region": region,
-                "Ålder": alder,
-                "Kön": kon,
-                "År": ar,
-                "Antal": antal
-            })
-        
-        return pd.DataFrame(rows)
-
     def _create_dummy_age_data(self) -> pd.DataFrame:
         """Skapar exempel-data för ålderspyramid när API inte fungerar"""
         age_groups = ["0-4", "5-9", "10-14", "15-19", "20-24", "25-29", "30-34", 
@@ -240,7 +190,7 @@ class SCBDataSource:
         
         try:
             url = f"{self.base_url}/{endpoint}"
-            response = requests.post(url, json=query, 
+            response = http_transport.post(url, json=query, 
                                    headers={"User-Agent": self.user_agent},
                                    timeout=self.timeout)
             response.raise_for_status()
@@ -253,31 +203,14 @@ class SCBDataSource:
             return pd.DataFrame()
     
     def fetch_age_groups_data(self, region_code: str = "1384") -> pd.DataFrame:
-        """Hämtar åldersgrupperade befolkningsdata från SCB"""
-        endpoint = SCB_TABLES["befolkning"]["endpoint"]
-        
-        # Skapa query för enskilda åldrar (65+)
-        elderly_ages = [str(age) for age in range(65, 101)] + ["100+"]
-        
-        query = {
-            "query": [
-                {"code": "Region", "selection": {"filter": "item", "values": [region_code]}},
-                {"code": "Alder", "selection": {"filter": "item", "values": elderly_ages}},
-                {"code": "Kon", "selection": {"filter": "item", "values": ["1", "2"]}},
-                {"code": "Tid", "selection": {"filter": "item", "values": ["2023", "2022", "2021"]}}
-            ],
-            "response": {"format": "json"}
-        }
+        """Hämtar åldersgrupperade befolkningsdata från SCB (utsnitt ur befolkningskuben)"""
+        # Enskilda åldrar (65+)
+        elderly_ages = [str(age) for age in range(65, 100)] + ["100+"]
         
         try:
-            url = f"{self.base_url}/{endpoint}"
-            response = requests.post(url, json=query, 
-                                   headers={"User-Agent": self.user_agent},
-                                   timeout=self.timeout)
-            response.raise_for_status()
-            
-            data = response.json()
-            return self._parse_population_response(data)
+            df = self.population_cube.frame(region_code, ["2023", "2022", "2021"], ages=elderly_ages)
+            df.insert(0, "Region", region_code)
+            return df[["Region", "Kön", "Ålder", "År", "Antal"]]
             
         except Exception as e:
             print(f"Fel vid hämtning av åldersgruppdata: {e}")
@@ -285,26 +218,19 @@ class SCBDataSource:
     
     def _parse_population_response(self, data: Dict) -> pd.DataFrame:
         """Parsar SCB-svar för befolkningsdata"""
-        rows = []
-        for item in data.get("data", []):
-            region = item["key"][0]
-            alder = item["key"][1]  # Ålder är andra positionen
-            kon_code = item["key"][2]  # Kön är tredje positionen
-            ar = item["key"][3]
-            antal = int(item["values"][0]) if item["values"][0] != ".." else 0
-            
-            # Konvertera kön-kod till text
-            kon = "Män" if kon_code == "1" else "Kvinnor" if kon_code == "2" else "Totalt"
-            
-            rows.append({
-                "Region": region,
-                "Kön": kon,
-                "Ålder": alder,
-                "År": ar,
-                "Antal": antal
-            })
+        df = pxweb.decode(data, names=["Region", "Ålder", "Kön", "År"], value_names=["Antal"],
+                          labels={"Kön": {"1": "Män", "2": "Kvinnor"}})
+        # Övriga könskoder (t.ex. "1+2") är totaler
+        kon = df["Kön"].astype(str)
+        kon = kon.where(kon.isin(["Män", "Kvinnor"]), "Totalt")
         
-        return pd.DataFrame(rows)
+        return pd.DataFrame({
+            "Region": df["Region"].astype(str),
+            "Kön": kon,
+            "Ålder": df["Ålder"].astype(str),
+            "År": df["År"].astype(str),
+            "Antal": pxweb.counts(df["Antal"])
+        })
 
     def fetch_kolada_data(self, indicator_codes: List[str], region_code: str = "1384") -> pd.DataFrame:
         """Hämtar data från Kolada API"""
@@ -314,7 +240,7 @@ class SCBDataSource:
             all_data = []
             for code in indicator_codes:
                 url = f"{base_url}/v2/data/kpi/{code}/municipality/{region_code}"
-                response = requests.get(url, timeout=self.timeout)
+                response = http_transport.get(url, timeout=self.timeout)
                 
                 if response.status_code == 200:
                     data = response.json()
@@ -337,24 +263,33 @@ class SCBDataSource:
         for attempt in range(max_retries):
             try:
                 if json_data:
-                    response = requests.post(url, json=json_data, 
+                    response = http_transport.post(url, json=json_data, 
                                            headers={"User-Agent": self.user_agent},
                                            timeout=self.timeout)
                 else:
-                    response = requests.get(url, 
+                    response = http_transport.get(url, 
                                           headers={"User-Agent": self.user_agent},
                                           timeout=self.timeout)
                 
                 response.raise_for_status()
                 return response.json()
                 
+            except CircuitOpenError as e:
+                # Brytaren är öppen; omförsök och väntan här ger bara samma avvisning
+                print(f"API-anrop avvisades: {e}")
+                return None
             except requests.exceptions.RequestException as e:
+                # Kvoter (429) hanteras redan i transporten; övriga klientfel blir inte bättre av omförsök
+                status = getattr(e.response, 'status_code', None)
+                if status is not None and 400 <= status < 500:
+                    print(f"API-anrop misslyckades: {e}")
+                    return None
                 if attempt == max_retries - 1:
                     print(f"API-anrop misslyckades efter {max_retries} försök: {e}")
                     return None
                 else:
                     print(f"Försök {attempt + 1} misslyckades, försöker igen...")
-                    time.sleep(1)
+                    time.sleep(2 ** attempt)
         
         return None
 
@@ -377,7 +312,7 @@ class SCBDataSource:
                 'outSR': '4326'
             }
             
-            response = requests.get(base_url, params=params, timeout=self.timeout)
+            response = http_transport.get(base_url, params=params, timeout=self.timeout)
             
             if response.status_code == 200:
                 data = response.json()
@@ -445,7 +380,7 @@ class KoladaAPI:
         """Hämtar lista över tillgängliga indikatorer"""
         try:
             url = f"{self.base_url}/v2/kpi"
-            response = requests.get(url, timeout=self.timeout)
+            response = http_transport.get(url, timeout=self.timeout)
             response.raise_for_status()
             
             data = response.json()
@@ -459,7 +394,7 @@ class KoladaAPI:
         """Hämtar data för specifik kommun och indikator"""
         try:
             url = f"{self.base_url}/v2/data/kpi/{kpi_id}/municipality/{municipality_id}"
-            response = requests.get(url, timeout=self.timeout)
+            response = http_transport.get(url, timeout=self.timeout)
             response.raise_for_status()
             
             data = response.json()
@@ -489,7 +424,7 @@ class TrafikverketAPI:
                 "Authorization": f"Bearer {self.api_key}"
             }
             
-            response = requests.post(self.base_url, data=query, 
+            response = http_transport.post(self.base_url, data=query, 
                                    headers=headers, timeout=self.timeout)
             response.raise_for_status()
             
@@ -10,6 +10,9 @@ import os
 from pathlib import Path
 import streamlit as st
 
+from data import cache_store, http_transport, scb_metadata
+from data.scb_query import validate_query
+
 class SCB_PXWeb_API:
     """
     SCB PX-Web API 2.0 implementation
@@ -18,31 +21,43 @@ class SCB_PXWeb_API:
     
     def __init__(self):
         self.base_url = "https://api.scb.se/OV0104/v1/doris/sv/ssd"
-        self.session = requests.Session()
-        self.session.headers.update({
+        # Delad transport med SCB:s anropskvot istället för en egen Session
+        self.headers = {
             'User-Agent': 'Kungsbacka-Dashboard/2.0',
             'Accept': 'application/json',
             'Content-Type': 'application/json'
-        })
+        }
         self.timeout = 60
         self.cache_duration = 3600  # 1 timme cache
+        # Metadata delas med SCBConnector via diskcachen
+        self.metadata_cache = scb_metadata.get_cache("cache")
         
     def get_table_metadata(self, table_path: str) -> Dict:
-        """Hämtar metadata för en SCB-tabell"""
-        try:
-            url = f"{self.base_url}/{table_path}"
-            response = self.session.get(url, timeout=self.timeout)
+        """Hämtar metadata för en SCB-tabell (cachad på disk)"""
+        url = f"{self.base_url}/{table_path}"
+        
+        def fetch():
+            response = http_transport.get(url, headers=self.headers, timeout=self.timeout)
             response.raise_for_status()
             return response.json()
-        except Exception as e:
-            st.error(f"Fel vid hämtning av metadata för {table_path}: {e}")
+        
+        metadata = self.metadata_cache.get(url, fetch)
+        if metadata is None:
+            st.error(f"Fel vid hämtning av metadata för {table_path}")
             return {}
+        return metadata
 
     def query_table(self, table_path: str, query: Dict) -> pd.DataFrame:
-        """Gör en query mot en SCB-tabell"""
+        """Gör en query mot en SCB-tabell (valideras mot metadata innan den skickas)"""
+        metadata = self.get_table_metadata(table_path)
+        problems = validate_query(query, metadata) if metadata else []
+        if problems:
+            st.error(f"Ogiltig query mot {table_path}: {'; '.join(problems)}")
+            return pd.DataFrame()
+        
         try:
             url = f"{self.base_url}/{table_path}"
-            response = self.session.post(url, json=query, timeout=self.timeout)
+            response = http_transport.post(url, json=query, headers=self.headers, timeout=self.timeout)
             response.raise_for_status()
             
             data = response.json()
@@ -192,7 +207,6 @@ class KoladaDataSource:
     
     def __init__(self):
         self.base_url = "http://api.kolada.se"
-        self.session = requests.Session()
         self.timeout = 30
         
     def get_all_kpi_for_municipality(self, municipality_id: str = "1380") -> pd.DataFrame:
@@ -200,7 +214,7 @@ class KoladaDataSource:
         try:
             # Först, hämta alla tillgängliga KPI:er
             kpi_url = f"{self.base_url}/v2/kpi"
-            response = self.session.get(kpi_url, timeout=self.timeout)
+            response = http_transport.get(kpi_url, timeout=self.timeout)
             response.raise_for_status()
             
             all_kpis = response.json().get('values', [])
@@ -239,7 +253,7 @@ class KoladaDataSource:
                     progress_bar.progress((i + 1) / len(important_kpis))
                     
                     data_url = f"{self.base_url}/v2/data/kpi/{kpi_id}/municipality/{municipality_id}"
-                    data_response = self.session.get(data_url, timeout=self.timeout)
+                    data_response = http_transport.get(data_url, timeout=self.timeout)
                     
                     if data_response.status_code == 200:
                         kpi_data = data_response.json().get('values', [])
@@ -295,7 +309,7 @@ class KoladaDataSource:
             for kpi_id in kpi_ids:
                 try:
                     url = f"{self.base_url}/v2/data/kpi/{kpi_id}/municipality/{municipality_id}"
-                    response = self.session.get(url, timeout=self.timeout)
+                    response = http_transport.get(url, timeout=self.timeout)
                     
                     if response.status_code == 200:
                         data = response.json().get('values', [])
@@ -393,6 +407,8 @@ class EnhancedDataManager:
         self.boendebarometer = BoendebarometerData()
         self.cache_dir = Path("cache")
         self.cache_dir.mkdir(exist_ok=True)
+        # Dagliga ögonblicksbilder rensas av den gemensamma cachen efter en vecka
+        self.cache = cache_store.get_store(str(self.cache_dir))
         
     def get_all_kungsbacka_data(self) -> Dict[str, pd.DataFrame]:
         """Hämtar ALL tillgänglig data för Kungsbacka från alla källor"""
@@ -436,8 +452,7 @@ class EnhancedDataManager:
                 if not df.empty:
                     json_data[key] = df.to_json(orient='records', date_format='iso')
             
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                json.dump(json_data, f, ensure_ascii=False, indent=2)
+            self.cache.put("snapshot", cache_file.name, json_data)
                 
             st.success(f"✅ Data cachad: {cache_file}")
             
@@ -451,12 +466,12 @@ class EnhancedDataManager:
         
         cache_file = self.cache_dir / f"{cache_key}.json"
         
-        if not cache_file.exists():
+        cached = self.cache.get("snapshot", cache_file.name)
+        if cached is None:
             return {}
         
         try:
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                json_data = json.load(f)
+            json_data = cached.value
             
             data = {}
             for key, json_str in json_data.items():
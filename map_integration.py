@@ -3,12 +3,13 @@
 import streamlit as st
 import folium
 from streamlit_folium import st_folium
-import requests
 import geopandas as gpd
 import pandas as pd
 from typing import Dict, List, Optional, Tuple
 import json
 
+from data import http_transport
+
 class KungsbackaMapIntegration:
     """
     Förbättrad kartintegration för Kungsbacka kommun
@@ -82,7 +83,7 @@ class KungsbackaMapIntegration:
                 'returnGeometry': 'true'
             }
             
-            response = requests.get(scb_kommun_url, params=params, timeout=30)
+            response = http_transport.get(scb_kommun_url, params=params, timeout=30)
             
             if response.status_code == 200:
                 geojson_data = response.json()
@@ -143,7 +144,7 @@ class KungsbackaMapIntegration:
                 'returnGeometry': 'true'
             }
             
-            response = requests.get(wfs_url, params=params, timeout=30)
+            response = http_transport.get(wfs_url, params=params, timeout=30)
             
             if response.status_code == 200:
                 data = response.json()
@@ -334,7 +335,7 @@ def get_kommun_wfs_data(layer_name: str) -> Optional[gpd.GeoDataFrame]:
             'srsName': 'EPSG:4326'
         }
         
-        response = requests.get(wfs_base, params=params, timeout=30)
+        response = http_transport.get(wfs_base, params=params, timeout=30)
         
         if response.status_code == 200:
             return gpd.read_file(response.text)
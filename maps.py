@@ -10,6 +10,7 @@ import requests
 from typing import Dict, List, Optional, Tuple
 import numpy as np
 from config import ORTER, COLORS, GIS_SOURCES
+from data import http_transport
 
 class InteractiveMap:
     """Klass för att skapa interaktiva kartor med olika lager"""
@@ -131,12 +132,15 @@ class InteractiveMap:
                 "bbox": "11.5,57.0,12.5,58.0,EPSG:4326"  # Kungsbacka-området
             }
             
-            # Läs direkt med geopandas
-            gdf = gpd.read_file(wfs_url, bbox=(11.5, 57.0, 12.5, 58.0))
+            # Via den delade transporten, så att en WFS som inte svarar stängs
+            # av kretsbrytaren istället för att kosta hela timeouten varje gång
+            response = http_transport.get(wfs_url, params=params, timeout=30)
+            response.raise_for_status()
+            geojson = response.json()
             
-            if not gdf.empty:
+            if geojson.get("features"):
                 folium.GeoJson(
-                    gdf.to_json(),
+                    geojson,
                     style_function=lambda feature: {
                         "fillColor": "green",
                         "color": "darkgreen",
@@ -12,6 +12,7 @@ from datetime import datetime
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from data.scb_connector import SCBConnector
+from data.revalidate import describe_age
 
 st.set_page_config(page_title="Befolkning - Kungsbacka", page_icon="👥", layout="wide")
 
@@ -273,5 +274,9 @@ if not flyttnetto_df.empty and not naturlig_df.empty:
 # RÅDATA
 with st.expander("📋 Rådata"):
     st.dataframe(pop_change, use_container_width=True)
-    st.caption(f"Källa: SCB, hämtad {datetime.now().strftime('%Y-%m-%d %H:%M')}")
+    age = scb.data_age()
+    if age:
+        st.caption(f"Källa: SCB – {describe_age(age['fetched_at'], age['stale'])}")
+    else:
+        st.caption(f"Källa: SCB, hämtad {datetime.now().strftime('%Y-%m-%d %H:%M')}")
 
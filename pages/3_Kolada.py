@@ -15,6 +15,7 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # Import av Kolada connector
 from data.kolada_connector import kolada
+from data.revalidate import describe_age
 
 st.set_page_config(
     page_title="Kolada - Kungsbacka",
@@ -59,6 +60,32 @@ st.markdown("""
 st.title("📈 Kolada - Kommunala Nyckeltal")
 st.markdown("Aktuella nyckeltal och KPI:er för Kungsbacka kommun från Kolada-databasen")
 
+# Alla serier som sidan visar, så att de kan hämtas i en gemensam omgång
+# innan flikarna ritas istället för ett anrop i taget under renderingen
+PREFETCH_MANIFEST = [
+    # Nyckeltal, trender och flikar för Kungsbacka
+    {"kpis": [
+        "N01951", "N00945", "N07925", "N07924", "N00974", "N00956", "N00913",
+        "N11800", "N01720", "N01004", "N02201",
+        "N15413", "N15446", "N15447", "N15533", "N15427", "N18216", "N18605",
+        "N15011", "N00530", "N03201", "N00204", "N00205",
+        "N00911", "N00910", "N00909", "N00908",
+        "N00302", "N00371", "N17425", "N00304", "N00305", "N07951",
+        "N00593", "N00594", "N11801", "N11929", "N00595", "N00596",
+        "N09001", "N09007",
+    ]},
+    # Jämförelse inom Halland
+    {"kpis": ["N01951"], "kommuner": list(kolada.HALLAND_KOMMUNER.keys())},
+    # Jämförelse inom Göteborgsregionen (alla val i rullistan)
+    {"kpis": ["N01951", "N00913", "N07932", "N00945"],
+     "kommuner": list(kolada.GOTEBORGSREGIONEN_KOMMUNER.keys())},
+    # Jämförelser i flikarna Arbetsmarknad och Utbildning
+    {"kpis": ["N11800", "N01720", "N15413"], "kommuner": list(kolada.JAMFORELSE_KOMMUNER.keys())},
+]
+
+with st.spinner("Hämtar nyckeltal från Kolada..."):
+    kolada.prefetch(PREFETCH_MANIFEST)
+
 # API Status i toppen
 col_status1, col_status2 = st.columns([3, 1])
 with col_status1:
@@ -69,6 +96,9 @@ with col_status2:
         test_data = kolada.get_latest_value("N01951")  # Folkmängd
         if test_data:
             st.success("✅ API Aktiv")
+            age = kolada.data_age("N01951")
+            if age:
+                st.caption(describe_age(age['fetched_at'], age['stale']))
         else:
             st.warning("⚠️ Ingen data")
     except:
@@ -293,7 +323,7 @@ st.subheader("📊 Regionala jämförelser")
 st.markdown("**Jämför Kungsbacka med kommuner i Halland och Göteborgsregionen**")
 
 # Tabs för olika jämförelser
-tab1, tab2 = st.tabs(["Hallands kommuner", "Göteborgsregionen (GR)"])
+tab1, tab2, tab3 = st.tabs(["Hallands kommuner", "Göteborgsregionen (GR)", "Hela Sverige"])
 
 with tab1:
     st.markdown("### Jämförelse med kommuner i Halland")
@@ -417,6 +447,65 @@ with tab2:
     except Exception as e:
         st.error(f"❌ Kunde inte hämta data: {e}")
 
+with tab3:
+    st.markdown("### Jämförelse med alla Sveriges kommuner")
+    
+    # (KPI, namn, högre är bättre)
+    riks_choice = st.selectbox(
+        "Välj nyckeltal att jämföra:",
+        options=[
+            ("N01951", "Folkmängd", True),
+            ("N00913", "Nybyggda lägenheter", True),
+            ("N11800", "Förvärvsarbetande 20-64 år (%)", True),
+            ("N01720", "Arbetslösa 16-64 år (%)", False),
+            ("N15413", "Meritvärde åk 9", True)
+        ],
+        format_func=lambda x: x[1],
+        key="riks_kpi"
+    )
+    
+    try:
+        # Hela riket hämtas i ett anrop
+        riks_panel = kolada.get_national_panel(riks_choice[0], higher_is_better=riks_choice[2])
+        position = kolada.get_national_position(riks_choice[0], higher_is_better=riks_choice[2])
+        
+        if not riks_panel.empty and position:
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("🏅 Placering", f"{position['rank']} av {position['antal']}")
+            with col2:
+                st.metric("📊 Percentil", f"{position['percentil']:.0f}")
+            with col3:
+                st.metric("📅 År", int(position['år']))
+            
+            # Alla kommuner sorterade, Kungsbacka markerad
+            fig = px.bar(
+                riks_panel,
+                x='kommun_namn',
+                y='värde',
+                title=f'{riks_choice[1]} - alla kommuner ({int(position["år"])})',
+                labels={'kommun_namn': 'Kommun', 'värde': riks_choice[1]},
+            )
+            fig.update_traces(
+                marker_color=['#ff8c42' if k == kolada.KUNGSBACKA_KOD else '#c7d3e0' for k in riks_panel['kommun']]
+            )
+            fig.update_layout(showlegend=False, height=450, xaxis_showticklabels=False)
+            st.plotly_chart(fig, use_container_width=True)
+            
+            # Medianer för jämförelsegrupper
+            st.markdown("**Medianvärden per grupp:**")
+            median_df = pd.DataFrame([
+                {'Grupp': grupp, 'Median': median}
+                for grupp, median in position['medianer'].items()
+            ])
+            median_df.loc[len(median_df)] = {'Grupp': 'Kungsbacka', 'Median': position['värde']}
+            st.dataframe(median_df, use_container_width=True, hide_index=True)
+            st.caption("Liknande kommuner = de kommuner som ligger närmast Kungsbacka i folkmängd")
+        else:
+            st.warning("⚠️ Ingen riksdata tillgänglig för valt nyckeltal")
+    except Exception as e:
+        st.error(f"❌ Kunde inte hämta data: {e}")
+
 st.markdown("---")
 
 # === INFO OM KOLADA ===
@@ -109,7 +109,7 @@ try:
             tatorter_geojson = resp.json()
 
             with open(geojson_path, "w", encoding="utf-8") as f:
-                json.dump(tatorter_geojson, f, ensure_ascii=False, indent=2)
+                json.dump(tatorter_geojson, f, ensure_ascii=False, separators=(",", ":"))
         st.caption("📊 Data hämtad från SCB Geodatatjänst (Tätorter 2023).")
 except FileNotFoundError as e:
     st.error("❌ Kunde inte ladda tätortsdata.")
@@ -173,4 +173,71 @@ if os.path.exists(cache_dir):
 else:
     st.warning("⚠️ Ingen cache-katalog hittad")
 
+# Gemensam diskcache (budget och utrensning)
+try:
+    from data import cache_store
+    usage = cache_store.get_store(cache_dir).stats()
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Diskcache", f"{usage['bytes'] / 1024 / 1024:.1f} / {usage['max_bytes'] / 1024 / 1024:.0f} MB")
+    col2.metric("Poster", f"{usage['entries']} / {usage['max_entries']}")
+    col3.metric("Vräkta poster", usage['evictions'])
+    st.caption(f"Uppdateringar utan ändrat innehåll: {usage['revalidated']} via 304, "
+               f"{usage['unchanged']} med samma innehållshash")
+    if usage['namespaces']:
+        st.dataframe(pd.DataFrame([
+            {"Namnrymd": ns, "Poster": info["entries"], "MB": round(info["bytes"] / 1024 / 1024, 2)}
+            for ns, info in sorted(usage['namespaces'].items())
+        ]), use_container_width=True, hide_index=True)
+except Exception as e:
+    st.warning(f"⚠️ Kunde inte läsa diskcachens status: {e}")
+
+# Minnescache för Kolada-serier (delas av alla sessioner i processen)
+try:
+    from data.kolada_connector import kolada
+    memo = kolada.memo_stats()
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Kolada minnescache", f"{memo['size']} / {memo['maxsize']} serier")
+    col2.metric("Träffar / missar", f"{memo['hits']} / {memo['misses']}")
+    col3.metric("Träffgrad", f"{memo['hit_rate']:.0%}")
+except Exception as e:
+    st.warning(f"⚠️ Kunde inte läsa minnescachens status: {e}")
+
+# Anropskö per värd med kvot (SCB)
+try:
+    from data import http_transport
+    depth = http_transport.queue_depth()
+    if depth:
+        cols = st.columns(len(depth))
+        for col, (host, waiting) in zip(cols, depth.items()):
+            col.metric(f"Kö mot {host}", f"{waiting} anrop")
+    else:
+        st.caption("Inga anrop mot kvotbegränsade API:er ännu")
+except Exception as e:
+    st.warning(f"⚠️ Kunde inte läsa anropskön: {e}")
+
+# Kretsbrytare och negativ cache per endpoint
+try:
+    from data import http_transport
+    breakers = http_transport.breaker_status()
+    st.metric("Anrop i negativ cache", http_transport.negative_cache_size())
+    if breakers:
+        st.dataframe(pd.DataFrame([
+            {
+                "Endpoint": b["endpoint"],
+                "Brytare": b["state"],
+                "Fel i rad": b["failures"],
+                "Nytt försök om (s)": round(b["retry_in"]),
+                "Avvisade anrop": b["rejected"],
+                "Senaste fel": b["last_error"],
+            }
+            for b in breakers
+        ]), use_container_width=True, hide_index=True)
+        if st.button("🔄 Återställ kretsbrytare"):
+            http_transport.reset_breakers()
+            st.rerun()
+    else:
+        st.caption("Inga endpoints med fel sedan start")
+except Exception as e:
+    st.warning(f"⚠️ Kunde inte läsa kretsbrytarnas status: {e}")
+
 st.caption("System-administration och teknisk information | Kungsbacka kommun")
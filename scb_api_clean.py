@@ -6,15 +6,27 @@ from typing import Dict, List, Optional
 import json
 from datetime import datetime
 
+from data import age_bins, population_cube, pxweb
+
 class SCBDataSource:
     """Ren SCB-klass för aktuell data från 2024-2025"""
     
-    def __init__(self):
+    def __init__(self, cache_dir: str = "cache"):
         self.base_url = "https://api.scb.se/OV0104/v1/doris/sv/ssd"
         self.user_agent = "Kungsbacka-Dashboard/1.0"
         self.timeout = 30
         self.kommun_kod = "1380"  # Kungsbacka kommun
+        self.cache_dir = cache_dir
+        self.population_cube = population_cube.get_cube(cache_dir, self._fetch_pxweb)
         
+    def _fetch_pxweb(self, endpoint: str, query: Dict) -> Dict:
+        """Hämtar ett PxWeb-svar för befolkningskuben (fel lyfts till anroparen)"""
+        response = requests.post(f"{self.base_url}/{endpoint}", json=query,
+                                 headers={"User-Agent": self.user_agent},
+                                 timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+    
     def fetch_population_data(self, region_code: str = None) -> pd.DataFrame:
         """Hämtar befolkningsdata från SCB för 2024"""
         if region_code is None:
@@ -58,47 +70,18 @@ class SCBDataSource:
             return self._create_fallback_population_data()
     
     def fetch_age_distribution(self, region_code: str = None) -> pd.DataFrame:
-        """Hämtar åldersfördelning för 2024"""
+        """Hämtar åldersfördelning i 5-årsgrupper för 2024"""
         if region_code is None:
             region_code = self.kommun_kod
             
         try:
-            url = f"{self.base_url}/BE/BE0101/BE0101A/BefolkningNy"
-            
-            query = {
-                "query": [
-                    {
-                        "code": "Region",
-                        "selection": {"filter": "vs:RegionKommun07", "values": [region_code]}
-                    },
-                    {
-                        "code": "Alder",
-                        "selection": {"filter": "item", "values": [
-                            "0-4", "5-9", "10-14", "15-19", "20-24", "25-29", 
-                            "30-34", "35-39", "40-44", "45-49", "50-54", 
-                            "55-59", "60-64", "65-69", "70-74", "75-79",
-                            "80-84", "85-89", "90-94", "95+"
-                        ]}
-                    },
-                    {
-                        "code": "Kon",
-                        "selection": {"filter": "item", "values": ["1", "2"]}
-                    },
-                    {
-                        "code": "Tid",
-                        "selection": {"filter": "item", "values": ["2024"]}
-                    }
-                ],
-                "response": {"format": "json"}
-            }
-            
-            response = requests.post(url, json=query,
-                                   headers={"User-Agent": self.user_agent},
-                                   timeout=self.timeout)
-            response.raise_for_status()
-            
-            data = response.json()
-            return self._parse_age_distribution_response(data)
+            # Summeras ur befolkningskuben istället för en egen fast gruppering
+            df = self.population_cube.binned(region_code, ["2024"], age_bins.FIVE_YEAR)
+            if df.empty:
+                return self._create_fallback_age_data()
+            df = df.rename(columns={"Åldersgrupp": "Ålder"})
+            df.insert(0, "Region", region_code)
+            return df[["Region", "Ålder", "Kön", "År", "Antal"]]
             
         except Exception as e:
             print(f"Fel vid hämtning av åldersdata från SCB: {e}")
@@ -106,49 +89,15 @@ class SCBDataSource:
     
     def _parse_population_response(self, data: dict) -> pd.DataFrame:
         """Parsar SCB-respons för befolkningsdata"""
-        rows = []
+        df = pxweb.decode(data, names=["Region", "Ålder", "Kön", "År"], value_names=["Antal"])
         
-        for item in data.get("data", []):
-            region = item["key"][0]
-            alder = item["key"][1]
-            kon_code = item["key"][2]
-            ar = item["key"][3]
-            antal = int(item["values"][0]) if item["values"][0] != ".." else 0
-            
-            kon = "Män" if kon_code == "1" else "Kvinnor"
-            
-            rows.append({
-                "Region": region,
-                "Ålder": alder,
-                "Kön": kon,
-                "År": ar,
-                "Antal": antal
-            })
-        
-        return pd.DataFrame(rows)
-    
-    def _parse_age_distribution_response(self, data: dict) -> pd.DataFrame:
-        """Parsar SCB-respons för åldersfördelning"""
-        rows = []
-        
-        for item in data.get("data", []):
-            region = item["key"][0]
-            alder = item["key"][1]
-            kon_code = item["key"][2]
-            ar = item["key"][3]
-            antal = int(item["values"][0]) if item["values"][0] != ".." else 0
-            
-            kon = "Män" if kon_code == "1" else "Kvinnor"
-            
-            rows.append({
-                "Region": region,
-                "Ålder": alder,
-                "Kön": kon,
-                "År": ar,
-                "Antal": antal
-            })
-        
-        return pd.DataFrame(rows)
+        return pd.DataFrame({
+            "Region": df["Region"].astype(str),
+            "Ålder": df["Ålder"].astype(str),
+            "Kön": (df["Kön"] == "1").map({True: "Män", False: "Kvinnor"}).astype(str),
+            "År": df["År"].astype(str),
+            "Antal": pxweb.counts(df["Antal"])
+        })
     
     def _create_fallback_population_data(self) -> pd.DataFrame:
         """Skapar fallback-data när SCB API inte svarar"""
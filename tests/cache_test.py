@@ -0,0 +1,103 @@
+"""Regressionstester för cachenycklar och cachens binära format"""
+
+import json
+import os
+import zlib
+
+import pytest
+
+from data import cache_store
+from data.cache_keys import cache_filename, canonical_query, query_digest
+
+ENDPOINT = "BE/BE0101/BE0101A/BefolkningNy"
+
+QUERY = {
+    "query": [
+        {"code": "Region", "selection": {"filter": "item", "values": ["1384"]}},
+        {"code": "ContentsCode", "selection": {"filter": "item", "values": ["BE0101N1"]}},
+        {"code": "Tid", "selection": {"filter": "item", "values": ["2023", "2024"]}},
+    ],
+    "response": {"format": "json"},
+}
+
+
+def test_digest_ignores_selection_and_key_order():
+    """Samma fråga i annan ordning ger samma nyckel"""
+    reordered = {
+        "response": {"format": "json"},
+        "query": [
+            {"selection": {"values": ["2023", "2024"], "filter": "item"}, "code": "Tid"},
+            {"code": "ContentsCode", "selection": {"filter": "item", "values": ["BE0101N1"]}},
+            {"code": "Region", "selection": {"filter": "item", "values": ["1384"]}},
+        ],
+    }
+    assert canonical_query(reordered) == canonical_query(QUERY)
+    assert query_digest(ENDPOINT, reordered) == query_digest(ENDPOINT, QUERY)
+
+
+def test_digest_separates_endpoint_format_and_values():
+    """Endpoint, svarsformat och värdenas ordning ingår i nyckeln"""
+    digest = query_digest(ENDPOINT, QUERY)
+    assert query_digest(f"/{ENDPOINT}/", QUERY) == digest
+    assert query_digest("BE/BE0101/BE0101A/FolkmangdNov", QUERY) != digest
+
+    stat2 = {**QUERY, "response": {"format": "json-stat2"}}
+    assert query_digest(ENDPOINT, stat2) != digest
+
+    # Värdenas ordning styr svarets ordning och ska inte normaliseras bort
+    swapped = json.loads(json.dumps(QUERY))
+    swapped["query"][2]["selection"]["values"].reverse()
+    assert query_digest(ENDPOINT, swapped) != digest
+
+
+def test_digest_is_stable_and_does_not_mutate_query():
+    """Nyckeln är en fast hexsträng och frågan lämnas orörd"""
+    before = json.dumps(QUERY)
+    digest = query_digest(ENDPOINT, QUERY)
+    assert digest == query_digest(ENDPOINT, json.loads(before))
+    assert len(digest) == 32 and int(digest, 16) >= 0
+    assert json.dumps(QUERY) == before
+    assert cache_filename(ENDPOINT, QUERY) == f"scb_BE_BE0101_BE0101A_BefolkningNy_{digest}.json"
+
+
+VALUE = {"columns": [{"code": "Tid"}], "data": [{"key": ["2024"], "values": ["85000"]}], "å": None}
+
+
+def test_dumps_writes_versioned_header():
+    """Posten börjar med MAGIC, formatversion och kodningsbyte"""
+    data = cache_store.dumps(VALUE)
+    assert data.startswith(cache_store.MAGIC)
+    assert data[len(cache_store.MAGIC)] == cache_store.FORMAT_VERSION
+    encoding = data[len(cache_store.MAGIC) + 1]
+    assert encoding >> 4 in (cache_store.SERIALIZER_JSON, cache_store.SERIALIZER_MSGPACK)
+    assert encoding & 0x0F in (cache_store.COMPRESSION_ZLIB, cache_store.COMPRESSION_ZSTD)
+    assert cache_store.loads(data) == VALUE
+
+
+def test_loads_reads_zlib_json_and_legacy_plain_json():
+    """Reservkodningen och äldre okomprimerade filer läses också"""
+    payload = json.dumps(VALUE).encode("utf-8")
+    encoding = cache_store.SERIALIZER_JSON << 4 | cache_store.COMPRESSION_ZLIB
+    packed = cache_store.MAGIC + bytes([cache_store.FORMAT_VERSION, encoding]) + zlib.compress(payload)
+    assert cache_store.loads(packed) == VALUE
+    assert cache_store.loads(payload) == VALUE
+
+
+def test_loads_rejects_unknown_version_and_corrupt_body():
+    """Okänd version och skadad nyttolast ger ValueError, inte fel data"""
+    data = cache_store.dumps(VALUE)
+    newer = data[:len(cache_store.MAGIC)] + bytes([cache_store.FORMAT_VERSION + 1]) + data[len(cache_store.MAGIC) + 1:]
+    with pytest.raises(ValueError):
+        cache_store.loads(newer)
+    with pytest.raises(ValueError):
+        cache_store.loads(data[:len(cache_store.MAGIC) + 2] + b"inte komprimerat")
+
+
+def test_store_round_trip_keeps_unchanged_entries(tmp_path):
+    """Samma innehåll skrivs inte om, och inga temporärfiler blir kvar"""
+    store = cache_store.CacheStore(str(tmp_path))
+    assert store.put("scb", "scb_test.json", VALUE) is True
+    assert store.put("scb", "scb_test.json", VALUE) is False
+    entry = store.get("scb", "scb_test.json")
+    assert entry.value == VALUE and not entry.stale
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
@@ -0,0 +1,85 @@
+"""Regressionstester för kretsbrytarnas tillstånd och den negativa cachen"""
+
+import time
+
+import pytest
+import requests
+
+from data.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreakers, CircuitOpenError
+
+ENDPOINT = "api.scb.se/BE"
+
+
+def _response(status: int, content: bytes = b"") -> requests.Response:
+    response = requests.Response()
+    response.status_code = status
+    response._content = content
+    return response
+
+
+def _state(breakers: CircuitBreakers) -> str:
+    return next(s["state"] for s in breakers.snapshot() if s["endpoint"] == ENDPOINT)
+
+
+def test_opens_after_threshold_and_rejects_calls():
+    """Brytaren öppnas efter failure_threshold fel i rad och avvisar sedan anrop"""
+    breakers = CircuitBreakers(failure_threshold=3, cooldown=60)
+    for attempt in range(3):
+        assert breakers.before(ENDPOINT, ("get", attempt)) is None
+        breakers.record_error(ENDPOINT, ("get", attempt), requests.exceptions.Timeout())
+    assert _state(breakers) == OPEN
+
+    with pytest.raises(CircuitOpenError):
+        breakers.before(ENDPOINT, ("get", "ny"))
+    assert breakers.snapshot()[0]["rejected"] == 1
+
+
+def test_half_open_probe_closes_on_success():
+    """Efter nedkylningen släpps ett provanrop; lyckas det stängs brytaren"""
+    breakers = CircuitBreakers(failure_threshold=1, cooldown=0.05)
+    breakers.record_response(ENDPOINT, ("get", 1), _response(503))
+    assert _state(breakers) == OPEN
+
+    time.sleep(0.06)
+    assert breakers.before(ENDPOINT, ("get", 2)) is None
+    assert _state(breakers) == HALF_OPEN
+    # Bara ett provanrop i taget
+    with pytest.raises(CircuitOpenError):
+        breakers.before(ENDPOINT, ("get", 3))
+
+    breakers.record_response(ENDPOINT, ("get", 2), _response(200))
+    assert breakers.snapshot() == []
+    assert breakers.before(ENDPOINT, ("get", 4)) is None
+
+
+def test_failed_probe_reopens_with_longer_cooldown():
+    """Ett misslyckat provanrop öppnar brytaren igen med dubbel nedkylning"""
+    breakers = CircuitBreakers(failure_threshold=1, cooldown=0.05, max_cooldown=1)
+    breakers.record_error(ENDPOINT, ("get", 1), requests.exceptions.ConnectionError())
+    time.sleep(0.06)
+    assert breakers.before(ENDPOINT, ("get", 2)) is None
+
+    breakers.record_error(ENDPOINT, ("get", 2), requests.exceptions.ConnectionError())
+    status = breakers.snapshot()[0]
+    assert status["state"] == OPEN
+    assert 0.05 < status["retry_in"] <= 0.1
+
+
+def test_client_errors_are_cached_but_do_not_trip_the_breaker():
+    """4xx besvaras ur den negativa cachen men räknas inte som fel"""
+    breakers = CircuitBreakers(failure_threshold=1)
+    not_found = _response(404, b'{"fel": "saknas"}')
+    breakers.record_response(ENDPOINT, ("get", "saknas"), not_found)
+
+    # Varje träff får ett eget svar med samma status och innehåll
+    first = breakers.before(ENDPOINT, ("get", "saknas"))
+    second = breakers.before(ENDPOINT, ("get", "saknas"))
+    assert first is not not_found and first is not second
+    assert first.status_code == second.status_code == 404
+    assert first.json() == second.json() == {"fel": "saknas"}
+    assert breakers.before(ENDPOINT, ("get", "annan")) is None
+    assert breakers.negative_entries() == 1
+    assert all(s["state"] == CLOSED for s in breakers.snapshot())
+
+    breakers.reset()
+    assert breakers.before(ENDPOINT, ("get", "saknas")) is None
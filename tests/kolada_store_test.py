@@ -0,0 +1,71 @@
+"""Regressionstester för Koladalagrets inkrementella uppdatering"""
+
+from data.kolada_store import KoladaStore
+
+PAIR = ("N00204", "1384")
+
+
+def _store(tmp_path) -> KoladaStore:
+    store = KoladaStore(str(tmp_path / "kolada.sqlite"))
+    store.replace_series([PAIR], [
+        ("N00204", "1384", 2021, "T", 100.0),
+        ("N00204", "1384", 2022, "T", 110.0),
+        ("N00204", "1384", 2023, "T", 118.0),  # Preliminärt värde
+    ], fetched_at=1000.0)
+    return store
+
+
+def test_merge_keeps_older_periods_and_replaces_from_period(tmp_path):
+    """Perioder före from_period lämnas orörda, senare ersätts och nya läggs till"""
+    store = _store(tmp_path)
+    store.merge_series([PAIR], [
+        ("N00204", "1384", 2023, "T", 120.0),
+        ("N00204", "1384", 2024, "T", 125.0),
+    ], from_period=2023, fetched_at=2000.0)
+
+    df = store.query(["N00204"], ["1384"])
+    assert dict(zip(df["år"], df["värde"])) == {2021: 100.0, 2022: 110.0, 2023: 120.0, 2024: 125.0}
+    assert store.high_water([PAIR]) == {PAIR: 2024}
+    assert store.fetched_at([PAIR]) == {PAIR: 2000.0}
+
+
+def test_merge_without_new_periods_keeps_high_water(tmp_path):
+    """Ett svar utan nyare perioder flyttar inte tillbaka high water mark"""
+    store = _store(tmp_path)
+    store.merge_series([PAIR], [], from_period=2023, fetched_at=2000.0)
+
+    df = store.query(["N00204"], ["1384"])
+    assert sorted(df["år"]) == [2021, 2022]
+    assert store.high_water([PAIR]) == {PAIR: 2023}
+
+
+def test_writes_bump_the_stored_version_for_other_connections(tmp_path):
+    """Versionen ligger i SQLite, så en annan anslutning ser skrivningen"""
+    store = _store(tmp_path)
+    other = KoladaStore(store.path)
+    before = other.generation(*PAIR)
+
+    store.merge_series([PAIR], [("N00204", "1384", 2024, "T", 125.0)], from_period=2024)
+    assert other.generation(*PAIR) == before + 1
+
+    store.touch_series([PAIR])
+    assert other.generation(*PAIR) == before + 1
+    assert other.generations([PAIR, ("N00204", "1380")]) == {PAIR: before + 1, ("N00204", "1380"): 0}
+
+
+def test_catalog_version_is_shared_and_only_bumped_on_changes(tmp_path):
+    """Katalogens version ligger i SQLite och ändras inte av en oförändrad listning"""
+    store = KoladaStore(str(tmp_path / "kolada.sqlite"))
+    other = KoladaStore(store.path)
+    assert other.catalog_generation() == 0
+
+    entries = [{"id": "N00204", "title": "Invånare"}]
+    assert store.upsert_catalog(entries, fetched_at=1000.0) == 1
+    assert other.catalog_generation() == 1
+
+    assert store.upsert_catalog(entries, fetched_at=2000.0) == 0
+    assert other.catalog_generation() == 1
+    assert other.catalog_fetched_at() == 2000.0
+
+    store.upsert_catalog([], fetched_at=3000.0)
+    assert other.catalog_generation() == 2
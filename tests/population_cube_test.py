@@ -0,0 +1,56 @@
+"""Regressionstester för befolkningskubens delade lagring och omhämtning"""
+
+import os
+import time
+
+from data import population_cube, revalidate
+
+REGION = "1384"
+
+
+class FakeSCB:
+    """Svarar på kubens frågor med värdet 10 × antal anrop i varje cell"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, endpoint, query):
+        years = query["query"][4]["selection"]["values"]
+        self.calls.append(list(years))
+        value = str(10 * len(self.calls))
+        return {
+            "columns": [{"code": "Region"}, {"code": "Alder"}, {"code": "Kon"}, {"code": "Tid"},
+                        {"code": "BE0101N1", "type": "c"}],
+            "data": [{"key": [REGION, age, sex, year], "values": [value]}
+                     for age in population_cube.AGES for sex in population_cube.SEXES for year in years],
+        }
+
+
+def test_cubes_for_the_same_directory_share_fetched_years(tmp_path):
+    """En annan koppling mot samma katalog hämtar inte om år som redan finns"""
+    first, second = FakeSCB(), FakeSCB()
+    population_cube.get_cube(str(tmp_path), first).totals(REGION, ["2023", "2024"])
+    totals = population_cube.get_cube(str(tmp_path), second).totals(REGION, ["2024"])
+
+    assert first.calls == [["2023", "2024"]] and second.calls == []
+    assert list(totals["Antal"]) == [10 * len(population_cube.AGES)] * 2
+    assert os.path.exists(tmp_path / f"{population_cube.CUBE_PREFIX}{REGION}.npz")
+
+
+def test_stale_years_are_served_while_refreshing_in_background(tmp_path):
+    """Ett inaktuellt år returneras direkt och hämtas om i bakgrunden"""
+    fetch = FakeSCB()
+    cube = population_cube.get_cube(str(tmp_path), fetch)
+    cube.refresh_seconds = 0
+    cube.ensure(REGION, ["2024"])
+
+    stale = cube.ensure(REGION, ["2024"])
+    assert stale["values"][0, 0, 0] == 10
+    key = (population_cube.CUBE_PREFIX, os.path.abspath(str(tmp_path)), REGION)
+    deadline = time.time() + 5
+    while revalidate.is_refreshing(key) and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert fetch.calls == [["2024"], ["2024"]]
+    cube.refresh_seconds = population_cube.REFRESH_SECONDS
+    assert cube.ensure(REGION, ["2024"])["values"][0, 0, 0] == 20
@@ -0,0 +1,152 @@
+"""Regressionstester för uppdelning av SCB-frågor, avkodning och åldersgrupper"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data import age_bins, pxweb
+from data.scb_query import cell_count, merge_responses, split_query
+
+METADATA = {
+    "variables": [
+        {"code": "Region", "values": ["1380", "1384"]},
+        {"code": "Alder", "values": [str(a) for a in range(100)] + ["100+"]},
+        {"code": "Kon", "values": ["1", "2"]},
+        {"code": "ContentsCode", "values": ["BE0101N1"]},
+        {"code": "Tid", "values": [str(y) for y in range(2000, 2025)]},
+    ]
+}
+
+
+def _query(**selections):
+    return {
+        "query": [
+            {"code": code, "selection": selection}
+            for code, selection in selections.items()
+        ],
+        "response": {"format": "json"},
+    }
+
+
+def test_split_query_respects_cell_limit_and_keeps_all_values():
+    """Varje delfråga ryms under gränsen och tillsammans täcker de hela frågan"""
+    query = _query(
+        Region={"filter": "item", "values": ["1380", "1384"]},
+        Alder={"filter": "all", "values": ["*"]},
+        Kon={"filter": "item", "values": ["1", "2"]},
+        ContentsCode={"filter": "item", "values": ["BE0101N1"]},
+        Tid={"filter": "all", "values": ["*"]},
+    )
+    total = cell_count(query, METADATA)
+    assert total == 2 * 101 * 2 * 25
+
+    parts = split_query(query, METADATA, max_cells=1000)
+    assert len(parts) > 1
+    assert all(cell_count(part, METADATA) <= 1000 for part in parts)
+    assert sum(cell_count(part, METADATA) for part in parts) == total
+    # Originalfrågan ändras inte
+    assert query["query"][1]["selection"] == {"filter": "all", "values": ["*"]}
+
+
+def test_split_query_leaves_small_queries_alone():
+    """En fråga under gränsen skickas som den är"""
+    query = _query(Region={"filter": "item", "values": ["1384"]}, Tid={"filter": "top", "values": ["3"]})
+    assert split_query(query, METADATA, max_cells=1000) == [query]
+
+
+def test_merge_responses_concatenates_rows():
+    """Delsvaren slås ihop rad för rad med det första svarets kolumner"""
+    columns = [{"code": "Tid", "type": "t"}, {"code": "BE0101N1", "type": "c"}]
+    merged = merge_responses([
+        {"columns": columns, "data": [{"key": ["2023"], "values": ["1"]}]},
+        {"columns": columns, "data": [{"key": ["2024"], "values": ["2"]}]},
+    ])
+    assert merged["columns"] == columns
+    assert [row["key"] for row in merged["data"]] == [["2023"], ["2024"]]
+
+
+# Samma utsnitt (region × kön × år, två innehåll) i båda formaten
+JSON_RESPONSE = {
+    "columns": [
+        {"code": "Region", "type": "d"},
+        {"code": "Kon", "type": "d"},
+        {"code": "Tid", "type": "t"},
+        {"code": "BE0101N1", "type": "c"},
+        {"code": "BE0101N2", "type": "c"},
+    ],
+    "data": [
+        {"key": ["1384", "1", "2023"], "values": ["42000", "10"]},
+        {"key": ["1384", "1", "2024"], "values": ["42500", ".."]},
+        {"key": ["1384", "2", "2023"], "values": ["41800", "12"]},
+        {"key": ["1384", "2", "2024"], "values": ["42100", "13"]},
+    ],
+}
+
+JSONSTAT2_RESPONSE = {
+    "class": "dataset",
+    "version": "2.0",
+    "id": ["Region", "Kon", "ContentsCode", "Tid"],
+    "size": [1, 2, 2, 2],
+    "role": {"time": ["Tid"], "metric": ["ContentsCode"]},
+    "dimension": {
+        "Region": {"category": {"index": {"1384": 0}}},
+        "Kon": {"category": {"index": {"1": 0, "2": 1}}},
+        "ContentsCode": {"category": {"index": {"BE0101N1": 0, "BE0101N2": 1}}},
+        "Tid": {"category": {"index": {"2023": 0, "2024": 1}}},
+    },
+    # Ordning: Kon, ContentsCode, Tid (Region har ett värde)
+    "value": [42000, 42500, 10, None, 41800, 42100, 12, 13],
+    "status": {"3": ".."},
+}
+
+
+def test_decode_gives_same_frame_for_json_and_jsonstat2():
+    """pxweb.decode ger samma kolumner, rader och värden för båda formaten"""
+    names = ["Region", "Kön", "År"]
+    labels = {"Kön": {"1": "Män", "2": "Kvinnor"}}
+    from_json = pxweb.decode(JSON_RESPONSE, names=names, labels=labels, value_names=["Antal", "Födda"])
+    from_stat2 = pxweb.decode(JSONSTAT2_RESPONSE, names=names, labels=labels, value_names=["Antal", "Födda"])
+
+    assert list(from_json.columns) == list(from_stat2.columns) == ["Region", "Kön", "År", "Antal", "Födda"]
+    pd.testing.assert_frame_equal(
+        from_json.astype({name: str for name in names}),
+        from_stat2.astype({name: str for name in names}),
+    )
+    assert np.isnan(from_stat2.loc[1, "Födda"])
+
+
+def test_decode_reports_same_codes_for_both_formats():
+    """Dimensioner och innehåll läses likadant ur båda formaten"""
+    assert pxweb.dimension_codes(JSON_RESPONSE) == pxweb.dimension_codes(JSONSTAT2_RESPONSE)
+    assert pxweb.content_codes(JSON_RESPONSE) == pxweb.content_codes(JSONSTAT2_RESPONSE)
+
+
+def test_age_bands_lookup_and_labels():
+    """Åldrar hamnar i rätt grupp, "100+" i den sista och "tot" utanför"""
+    bands = age_bins.AgeBands([0, 6, 16, 65])
+    assert bands.labels == ["0-5", "6-15", "16-64", "65+"]
+    assert list(bands.codes(["0", "5", "6", "64", "65", "100+", "tot"])) == [0, 0, 1, 2, 3, 3, -1]
+    with pytest.raises(ValueError):
+        age_bins.AgeBands([5, 10])
+    assert age_bins.get_bands("planering") is age_bins.PLANNING
+
+
+def test_bin_frame_and_bin_array_agree():
+    """Summering av en DataFrame och av kubens array ger samma grupper"""
+    ages = [str(a) for a in range(100)] + ["100+"]
+    values = np.arange(len(ages) * 2, dtype=float).reshape(len(ages), 2)  # ålder × kön
+    values[3, 0] = np.nan
+
+    frame = pd.DataFrame({
+        "Ålder": np.repeat(ages, 2),
+        "Kön": np.tile(["Män", "Kvinnor"], len(ages)),
+        "Antal": np.nan_to_num(values).reshape(-1),
+    })
+    binned = age_bins.bin_frame(frame, age_bins.FIVE_YEAR, by=["Kön"])
+    summed = age_bins.bin_array(values, age_bins.FIVE_YEAR)
+
+    assert summed.shape == (len(age_bins.FIVE_YEAR), 2)
+    men = binned[binned["Kön"] == "Män"].set_index("Åldersgrupp")["Antal"]
+    assert list(men.index) == age_bins.FIVE_YEAR.labels
+    np.testing.assert_allclose(men.to_numpy(), summed[:, 0])
+    assert summed[:, 1].sum() == np.nansum(values[:, 1])
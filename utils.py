@@ -11,6 +11,8 @@ from datetime import datetime, timedelta
 import requests
 import time
 
+from data import age_bins, http_transport
+
 def load_geospatial_data() -> tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
     """Laddar och bearbetar geospatial data (planbesked och ÖP)"""
     
@@ -86,14 +88,23 @@ def calculate_op_compliance(planbesked_gdf: gpd.GeoDataFrame, op_gdf: gpd.GeoDat
         planbesked_gdf["följer_op"] = False
         return planbesked_gdf
 
-def create_population_pyramid(df: pd.DataFrame, title: str = "Ålderspyramid") -> go.Figure:
-    """Skapar en interaktiv ålderspyramid med Plotly"""
+def create_population_pyramid(df: pd.DataFrame, title: str = "Ålderspyramid",
+                              bands=None) -> go.Figure:
+    """
+    Skapar en interaktiv ålderspyramid med Plotly
+    
+    Med bands (t.ex. "5år", "planering" eller nedre gränser) grupperas
+    ettåriga åldrar först med age_bins, och grupperna visas i åldersordning.
+    """
     
     if df.empty:
         return go.Figure().add_annotation(text="Ingen data tillgänglig", 
                                         xref="paper", yref="paper",
                                         x=0.5, y=0.5, showarrow=False)
     
+    if bands is not None:
+        df = age_bins.bin_frame(df, bands, by=["Kön"], label_column="Ålder")
+    
     # Förbered data
     df_pivot = df.pivot_table(index="Ålder", columns="Kön", values="Antal", 
                              aggfunc="sum", fill_value=0)
@@ -245,7 +256,7 @@ def safe_api_request(url: str, params: Optional[Dict] = None,
     
     for attempt in range(retries):
         try:
-            response = requests.get(url, params=params, timeout=timeout)
+            response = http_transport.get(url, params=params, timeout=timeout)
             response.raise_for_status()
             return response.json()
             